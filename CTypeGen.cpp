@@ -25,6 +25,10 @@
 #endif
 #include <structmember.h>
 
+#include <fnmatch.h>
+#include <ffi.h>
+
+#include <iomanip>
 #include <iostream>
 #include <memory>
 #include <set>
@@ -570,6 +574,170 @@ unit_macros( PyObject * self, PyObject * args ) {
    Py_RETURN_NONE;
 }
 
+/*
+ * A macro visitor that does its filtering natively. Definitions are only
+ * collected while some file on the include stack matches one of the supplied
+ * glob patterns, and each surviving #define is parsed into a
+ * ( file, line, name, args, body ) tuple. "args" is None for object-like
+ * macros, and a tuple of argument names for function-like ones. This avoids
+ * calling back into python for every event of every included file.
+ */
+struct FilteredMacros : public Dwarf::MacroVisitor {
+   std::vector< std::string > patterns;
+   std::map< std::string, bool > matches; // cache of pattern matches by filename
+   std::vector< std::pair< std::string, bool > > scope;
+   int defining = 0;
+   PyObject *result;
+
+   FilteredMacros( std::vector< std::string > &&patterns_, PyObject *result_ ) :
+      patterns { std::move( patterns_ ) }, result { result_ } {}
+
+   bool interesting( const std::string &filename ) {
+      auto it = matches.find( filename );
+      if ( it != matches.end() )
+         return it->second;
+      // Match patterns against the name as recorded in the line table, and
+      // its basename.
+      auto slash = filename.rfind( '/' );
+      std::string base = slash == std::string::npos ? filename :
+                                                      filename.substr( slash + 1 );
+      bool match = false;
+      for ( const auto &pattern : patterns ) {
+         if ( fnmatch( pattern.c_str(), filename.c_str(), 0 ) == 0 ||
+              fnmatch( pattern.c_str(), base.c_str(), 0 ) == 0 ) {
+            match = true;
+            break;
+         }
+      }
+      matches[ filename ] = match;
+      return match;
+   }
+
+   static std::string trim( const std::string &s ) {
+      auto start = s.find_first_not_of( " \t" );
+      if ( start == std::string::npos )
+         return "";
+      auto end = s.find_last_not_of( " \t" );
+      return s.substr( start, end - start + 1 );
+   }
+
+   bool define( int line, const std::string &definition ) override {
+      if ( defining == 0 )
+         return true;
+
+      auto nameEnd = definition.find_first_of( " \t(" );
+      std::string name = definition.substr( 0, nameEnd );
+      std::string body;
+      PyObject *args;
+
+      if ( nameEnd != std::string::npos && definition[ nameEnd ] == '(' ) {
+         auto closeParen = definition.find( ')', nameEnd );
+         if ( closeParen == std::string::npos )
+            return true; // malformed - ignore it.
+         std::vector< std::string > names;
+         std::istringstream argstream(
+               definition.substr( nameEnd + 1, closeParen - nameEnd - 1 ) );
+         std::string arg;
+         while ( std::getline( argstream, arg, ',' ) ) {
+            arg = trim( arg );
+            if ( !arg.empty() )
+               names.push_back( arg );
+         }
+         args = PyTuple_New( names.size() );
+         if ( args == nullptr )
+            return false;
+         for ( size_t i = 0; i < names.size(); ++i )
+            PyTuple_SET_ITEM( args, i, makeString( names[ i ] ) );
+         body = trim( definition.substr( closeParen + 1 ) );
+      } else {
+         args = Py_None;
+         Py_INCREF( args );
+         if ( nameEnd != std::string::npos )
+            body = trim( definition.substr( nameEnd + 1 ) );
+      }
+
+      PyObject *entry = Py_BuildValue( "(sisNs)", scope.back().first.c_str(),
+                                       line, name.c_str(), args, body.c_str() );
+      if ( entry == nullptr )
+         return false;
+      int rc = PyList_Append( result, entry );
+      Py_DECREF( entry );
+      return rc == 0;
+   }
+
+   bool undef( int line, const std::string &definition ) override {
+      return true;
+   }
+
+   bool startFile( int line, const std::string &dir, const Dwarf::FileEntry &ent )
+                   override {
+      bool match = interesting( ent.name );
+      scope.emplace_back( ent.name, match );
+      if ( match )
+         defining++;
+      return true;
+   }
+
+   bool endFile() override {
+      // Ignore an unbalanced end-file in malformed macro data.
+      if ( scope.empty() )
+         return true;
+      if ( scope.back().second )
+         defining--;
+      scope.pop_back();
+      return true;
+   }
+};
+
+static PyObject *
+unit_definedMacros( PyObject * self, PyObject * args ) {
+   auto unit = ( ( PyDwarfUnit * )self )->unit;
+
+   PyObject *filter;
+   if ( !PyArg_ParseTuple( args, "O", &filter ) )
+      return nullptr;
+
+   // Accept either a single pattern, or an iterable of them.
+   std::vector< std::string > patterns;
+   if ( PyUnicode_Check( filter ) ) {
+      patterns.push_back( PyUnicode_AsUTF8( filter ) );
+   } else {
+      PyObject *seq = PySequence_Fast( filter, "macro filter must be a string "
+                                               "or an iterable of strings" );
+      if ( seq == nullptr )
+         return nullptr;
+      for ( Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE( seq ); ++i ) {
+         const char *pattern = PyUnicode_AsUTF8(
+               PySequence_Fast_GET_ITEM( seq, i ) );
+         if ( pattern == nullptr ) {
+            Py_DECREF( seq );
+            return nullptr;
+         }
+         patterns.push_back( pattern );
+      }
+      Py_DECREF( seq );
+   }
+
+   PyObject *result = PyList_New( 0 );
+   if ( result == nullptr )
+      return nullptr;
+   try {
+      const Dwarf::Macros *macros = unit->getMacros();
+      if ( macros != nullptr ) {
+         FilteredMacros visitor( std::move( patterns ), result );
+         if ( !macros->visit( *unit, &visitor ) ) {
+            Py_DECREF( result );
+            return nullptr;
+         }
+      }
+   } catch ( const std::exception & ex ) {
+      Py_DECREF( result );
+      PyErr_SetString( PyExc_RuntimeError, ex.what() );
+      return nullptr;
+   }
+   return result;
+}
+
 static PyObject *
 unit_purge( PyObject * self, PyObject * args ) {
    PyDwarfUnit * unit = ( PyDwarfUnit * )self;
@@ -677,6 +845,23 @@ elf_soname( PyObject * self, PyObject * args ) {
    }
 }
 
+static PyObject *
+elf_buildId( PyObject * self, PyObject * args ) {
+   try {
+      PyElfObject * pyelf = ( PyElfObject * )self;
+      auto id = pyelf->dwarf->elf->getBuildID();
+      if ( id.empty() )
+         Py_RETURN_NONE;
+      std::ostringstream os;
+      os << std::hex << std::setfill( '0' );
+      for ( auto byte : id )
+         os << std::setw( 2 ) << unsigned( byte );
+      return makeString( os.str() );
+   } catch ( const std::exception & ex ) {
+      PyErr_SetString( PyExc_RuntimeError, ex.what() );
+      return nullptr;
+   }
+}
 
 /*
  * Returns a dict mapping names from .symtab (debug symbols) to a list of names
@@ -741,6 +926,103 @@ elf_symbol( PyObject * self, PyObject * args ) {
    return PyLong_FromLong ( sym.st_value );
 }
 
+/*
+ * Returns a list of ( type, offset, vaddr, filesz, memsz, align ) tuples for
+ * the program headers of the given type. CTypeGen.CoreFile uses this to find
+ * the memory in a core file, and the load address of the libraries mapped
+ * there.
+ */
+static PyObject *
+elf_segments( PyObject * self, PyObject * args ) {
+   PyElfObject * pyelf = ( PyElfObject * )self;
+   unsigned type;
+   if ( !PyArg_ParseTuple( args, "I", &type ) )
+      return nullptr;
+   try {
+      const auto &segments = pyelf->obj->getSegments( type );
+      PyObject * list = PyList_New( 0 );
+      if ( list == nullptr )
+         return nullptr;
+      for ( const auto &segment : segments ) {
+         PyObject * tuple = Py_BuildValue( "(kKKKKK)",
+               ( unsigned long )segment.p_type,
+               ( unsigned long long )segment.p_offset,
+               ( unsigned long long )segment.p_vaddr,
+               ( unsigned long long )segment.p_filesz,
+               ( unsigned long long )segment.p_memsz,
+               ( unsigned long long )segment.p_align );
+         if ( tuple == nullptr || PyList_Append( list, tuple ) != 0 ) {
+            Py_XDECREF( tuple );
+            Py_DECREF( list );
+            return nullptr;
+         }
+         Py_DECREF( tuple );
+      }
+      return list;
+   } catch ( const std::exception & ex ) {
+      PyErr_SetString( PyExc_RuntimeError, ex.what() );
+      return nullptr;
+   }
+}
+
+/*
+ * Returns a list of ( name, type, description ) tuples for the notes in the
+ * object, with the name as a string, and the description as bytes.
+ */
+static PyObject *
+elf_notes( PyObject * self, PyObject * args ) {
+   PyElfObject * pyelf = ( PyElfObject * )self;
+   try {
+      PyObject * list = PyList_New( 0 );
+      if ( list == nullptr )
+         return nullptr;
+      for ( const auto &note : pyelf->obj->notes() ) {
+         auto data = note.data();
+         std::string desc( data->size(), '\0' );
+         data->read( 0, desc.size(), desc.data() );
+         auto name = note.name();
+         PyObject * tuple = Py_BuildValue( "(s#iy#)", name.data(),
+               Py_ssize_t( name.size() ), int( note.type() ), desc.data(),
+               Py_ssize_t( desc.size() ) );
+         if ( tuple == nullptr || PyList_Append( list, tuple ) != 0 ) {
+            Py_XDECREF( tuple );
+            Py_DECREF( list );
+            return nullptr;
+         }
+         Py_DECREF( tuple );
+      }
+      return list;
+   } catch ( const std::exception & ex ) {
+      PyErr_SetString( PyExc_RuntimeError, ex.what() );
+      return nullptr;
+   }
+}
+
+/*
+ * Returns the bytes at the given offset in the object's file, which may be
+ * fewer than asked for at the end of the file.
+ */
+static PyObject *
+elf_read( PyObject * self, PyObject * args ) {
+   PyElfObject * pyelf = ( PyElfObject * )self;
+   unsigned long long offset;
+   Py_ssize_t size;
+   if ( !PyArg_ParseTuple( args, "Kn", &offset, &size ) )
+      return nullptr;
+   if ( size < 0 ) {
+      PyErr_SetString( PyExc_ValueError, "negative read size" );
+      return nullptr;
+   }
+   try {
+      std::string buf( size, '\0' );
+      auto got = pyelf->obj->io->read( offset, size, buf.data() );
+      return PyBytes_FromStringAndSize( buf.data(), got );
+   } catch ( const std::exception & ex ) {
+      PyErr_SetString( PyExc_RuntimeError, ex.what() );
+      return nullptr;
+   }
+}
+
 static PyObject *
 elf_findDefinition( PyObject * self, PyObject * args ) {
    PyDwarfEntry * die;
@@ -1137,9 +1419,156 @@ unititer_free( PyObject * o ) {
    unitsIteratorType.tp_free( o );
 }
 
+/*
+ * The native loop behind CTypeGenRun.batchCall: call the function at an
+ * address once for each row of a set of columns of arguments, with libffi,
+ * writing the results to an output buffer. Types are given as struct module
+ * codes, with explicit sizes for integers, and "P" for pointers. A column
+ * holding a single value is passed to every call.
+ */
+static ffi_type *
+ffiTypeForCode( char code ) {
+   switch ( code ) {
+      case 'b': case 'c': return &ffi_type_sint8;
+      case 'B': case '?': return &ffi_type_uint8;
+      case 'h': return &ffi_type_sint16;
+      case 'H': return &ffi_type_uint16;
+      case 'i': return &ffi_type_sint32;
+      case 'I': return &ffi_type_uint32;
+      case 'q': return &ffi_type_sint64;
+      case 'Q': return &ffi_type_uint64;
+      case 'f': return &ffi_type_float;
+      case 'd': return &ffi_type_double;
+      case 'P': return &ffi_type_pointer;
+      default: return nullptr;
+   }
+}
+
+namespace {
+// Releases a Py_buffer when it goes out of scope.
+struct HeldBuffer {
+   Py_buffer view;
+   bool held = false;
+   int get( PyObject * obj, int flags ) {
+      held = PyObject_GetBuffer( obj, &view, flags ) == 0;
+      return held ? 0 : -1;
+   }
+   ~HeldBuffer() {
+      if ( held )
+         PyBuffer_Release( &view );
+   }
+};
+}
+
+static PyObject *
+batch_call( PyObject * self, PyObject * args ) {
+   unsigned long long address;
+   const char * restype;
+   const char * argtypes;
+   PyObject * columns;
+   PyObject * out;
+   Py_ssize_t count;
+   if ( !PyArg_ParseTuple( args, "KssOOn", &address, &restype, &argtypes, &columns,
+                           &out, &count ) )
+      return nullptr;
+   if ( count < 0 ) {
+      PyErr_SetString( PyExc_ValueError, "negative count" );
+      return nullptr;
+   }
+
+   size_t nargs = strlen( argtypes );
+   if ( !PySequence_Check( columns ) ||
+        PySequence_Size( columns ) != Py_ssize_t( nargs ) ) {
+      PyErr_SetString( PyExc_ValueError, "need one column for each argument" );
+      return nullptr;
+   }
+   std::vector< ffi_type * > types( nargs );
+   std::vector< HeldBuffer > buffers( nargs );
+   std::vector< char * > data( nargs );
+   std::vector< size_t > strides( nargs );
+   for ( size_t i = 0; i < nargs; ++i ) {
+      types[ i ] = ffiTypeForCode( argtypes[ i ] );
+      if ( types[ i ] == nullptr ) {
+         PyErr_Format( PyExc_ValueError, "bad argument type code '%c'",
+                       argtypes[ i ] );
+         return nullptr;
+      }
+      PyObject * column = PySequence_GetItem( columns, i );
+      if ( column == nullptr )
+         return nullptr;
+      int rc = buffers[ i ].get( column, PyBUF_SIMPLE );
+      Py_DECREF( column );
+      if ( rc != 0 )
+         return nullptr;
+      size_t size = types[ i ]->size;
+      size_t len = buffers[ i ].view.len;
+      strides[ i ] = len == size ? 0 : size;
+      if ( strides[ i ] != 0 && len < size * count ) {
+         PyErr_Format( PyExc_ValueError, "column %zu has fewer than %zd values",
+                       i, count );
+         return nullptr;
+      }
+      data[ i ] = ( char * )buffers[ i ].view.buf;
+   }
+
+   ffi_type * rtype = *restype ? ffiTypeForCode( *restype ) : &ffi_type_void;
+   if ( rtype == nullptr ) {
+      PyErr_Format( PyExc_ValueError, "bad result type code '%c'", *restype );
+      return nullptr;
+   }
+   HeldBuffer result;
+   char * results = nullptr;
+   if ( rtype != &ffi_type_void ) {
+      if ( result.get( out, PyBUF_WRITABLE ) != 0 )
+         return nullptr;
+      if ( size_t( result.view.len ) < rtype->size * count ) {
+         PyErr_Format( PyExc_ValueError, "output has room for fewer than %zd results",
+                       count );
+         return nullptr;
+      }
+      results = ( char * )result.view.buf;
+   }
+
+   ffi_cif cif;
+   if ( ffi_prep_cif( &cif, FFI_DEFAULT_ABI, nargs, rtype, types.data() ) != FFI_OK ) {
+      PyErr_SetString( PyExc_RuntimeError, "ffi_prep_cif failed" );
+      return nullptr;
+   }
+
+   // libffi widens integer results narrower than a register to an ffi_arg.
+   bool widened = rtype->type != FFI_TYPE_VOID && rtype->type != FFI_TYPE_FLOAT &&
+                  rtype->type != FFI_TYPE_DOUBLE && rtype->size < sizeof( ffi_arg );
+   auto fn = FFI_FN( uintptr_t( address ) );
+   std::vector< void * > values( nargs );
+
+   // Like ctypes' CDLL, we don't hold the GIL while we are in the library.
+   Py_BEGIN_ALLOW_THREADS
+   for ( Py_ssize_t row = 0; row < count; ++row ) {
+      for ( size_t i = 0; i < nargs; ++i )
+         values[ i ] = data[ i ] + row * strides[ i ];
+      if ( widened ) {
+         ffi_arg wide;
+         ffi_call( &cif, fn, &wide, values.data() );
+         char * to = results + row * rtype->size;
+         switch ( rtype->size ) {
+            case 1: *( uint8_t * )to = uint8_t( wide ); break;
+            case 2: *( uint16_t * )to = uint16_t( wide ); break;
+            case 4: *( uint32_t * )to = uint32_t( wide ); break;
+         }
+      } else {
+         ffi_call( &cif, fn, results ? results + row * rtype->size : nullptr,
+                   values.data() );
+      }
+   }
+   Py_END_ALLOW_THREADS
+   Py_RETURN_NONE;
+}
+
 static PyMethodDef ctypegen_methods[] = {
    { "open", elf_open, METH_VARARGS, "open an ELF file to process" },
    { "verbose", elf_verbose, METH_VARARGS, "set verbosity" },
+   { "batchCall", batch_call, METH_VARARGS,
+     "call a function for each row of columns of arguments" },
    { 0, 0, 0, 0 }
 };
 
@@ -1149,11 +1578,21 @@ static PyMethodDef elf_methods[] = {
      elf_soname,
      METH_VARARGS,
      "get the name of this library as used to locate it at run-time" },
+   { "buildId",
+     elf_buildId,
+     METH_VARARGS,
+     "get the GNU build ID of this object as a hex string" },
    { "dynaddrs",
      elf_dynaddrs,
      METH_VARARGS,
      "get a mapping of addr->dynamic symbol name" },
    { "symbol", elf_symbol, METH_VARARGS, "get address of symbol" },
+   { "segments",
+     elf_segments,
+     METH_VARARGS,
+     "get the program headers of a given type" },
+   { "notes", elf_notes, METH_NOARGS, "get the ( name, type, desc ) notes" },
+   { "read", elf_read, METH_VARARGS, "read bytes from the object's file" },
    { "findDefinition",
      elf_findDefinition,
      METH_VARARGS,
@@ -1180,6 +1619,8 @@ static PyMethodDef unit_methods[] = {
    { "root", unit_root, METH_VARARGS, "get root DIE of a unit" },
    { "purge", unit_purge, METH_VARARGS, "purge any memory used by DIE trees" },
    { "macros", unit_macros, METH_VARARGS, "walk the macros for a unit" },
+   { "definedMacros", unit_definedMacros, METH_VARARGS,
+     "list macros defined by files matching the given glob patterns" },
    { 0, 0, 0, 0 }
 };
 
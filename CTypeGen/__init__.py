@@ -14,22 +14,35 @@
 # CTypeGen generates boilerplate code using python's ctype package to
 # interact with C libraries. See Aid 3558, aka go/ctypegen for the gorey details.
 
+import bisect
 import datetime
+import hashlib
 import io
 import os.path
 import imp
+import importlib.abc
+import importlib.machinery
+import importlib.util
 import inspect
 import sys
 import ctypes
 import keyword
+import marshal
 import ast
+import contextlib
+import math
+import fnmatch
 import functools
 import operator
 import re
+import shutil
+import struct
+import tempfile
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import CTypeGen.expression
+import CTypeGenRun
 
 # the following modules are dynamically generated inside the C extension.
 # pylint should ignore them
@@ -242,19 +255,31 @@ class FunctionType( Type ):
       return [ child for child in self.die
             if child.tag() == tags.DW_TAG_formal_parameter ]
 
-   def define( self, out ):
+   def defineSignature( self, out ):
+      ''' Define the return and parameter types of the function '''
       rtype = self.baseType()
       if rtype:
          self.resolver.defineType( rtype, out )
       for child in self.params():
          self.resolver.defineType(
                self.resolver.dieToType( child.DW_AT_type ), out )
+
+   def define( self, out ):
+      self.defineSignature( out )
+      self.resolver.functionTypeName( self.signature(), out )
       return True
 
    def size( self ):
       raise Exception( f"functions don't have sizes : {self.name()}" )
 
    def ctype( self ):
+      # Function types with the same signature share a name, once defined.
+      signature = self.signature()
+      return self.resolver.functionTypeNames.get( signature, signature )
+
+   def signature( self ):
+      ''' Return the python expression that creates the CFUNCTYPE for this
+      function '''
       result = io.StringIO()
       result.write( "CFUNCTYPE( " )
       rtype = self.baseType()
@@ -285,9 +310,14 @@ class FunctionDefType( FunctionType ):
    generate the restype and argtypes fields for ctypes, so we can call
    them with type-safety. '''
 
-   def writeLibUpdates( self, indent, stream ):
-      """Write function's prototype to stream"""
-      base = self.baseType()
+   def define( self, out ):
+      # A function's CFUNCTYPE is only needed for functionTypes, which names
+      # it itself.
+      self.defineSignature( out )
+      return True
+
+   def linkerNames( self ):
+      ''' Return the dynamic symbols that refer to this function '''
       obj = self.die.object()
 
       name = self.die.DW_AT_linkage_name
@@ -308,23 +338,32 @@ class FunctionDefType( FunctionType ):
       if self.die.DW_AT_external and obj.symbol( name ) is not None:
          names += [ name ]
 
+      linkernames = []
       for linkername in sorted( set( names ) ):
          if keyword.iskeyword( linkername ):
             self.resolver.errorfunc( f"cannot provide access to {self.name()} - "
                   f"its dynamic name {linkername} is a python keyword" )
             continue
+         linkernames.append( linkername )
+      return linkernames
+
+   def prototype( self ):
+      ''' Return the python expressions for the restype and argtypes of the
+      function. The restype is None for functions returning void '''
+      base = self.baseType()
+      return ( base.ctype() if base else None,
+               [ self.resolver.dieToType( child.DW_AT_type ).ctype()
+                 for child in self.params() ] )
 
+   def writeLibUpdates( self, indent, stream ):
+      """Write function's prototype to stream"""
+      restype, args = self.prototype()
+      for linkername in self.linkerNames():
          stream.write( "{}if hasattr(lib, '{}'):\n".format(
                        pad( indent ), linkername ) )
          indent += 3
          stream.write( "%slib.%s.restype = %s\n" %
-                       ( pad( indent ),
-               linkername, base.ctype() if base else "None" ) )
-         args = []
-
-         for child in self.params():
-            baseType = self.resolver.dieToType( child.DW_AT_type )
-            args.append( baseType.ctype() )
+                       ( pad( indent ), linkername, restype ) )
 
          stream.write( f"{pad( indent )}lib.{linkername}.argtypes = " )
          if args:
@@ -436,9 +475,13 @@ def die_bit_offset( die ):
       return die.DW_AT_data_bit_offset
    if die.DW_AT_bit_offset is not None:
 
+      # DW_AT_bit_offset counts from the most significant bit of the storage
+      # unit, which is its first bit on big-endian machines.
+      if sys.byteorder == "big":
+         return die.DW_AT_data_member_location * 8 + die.DW_AT_bit_offset
+
       size = die_size( die )
 
-      # XXX: litte-endian specific
       return \
             die.DW_AT_data_member_location * 8 + \
             size * 8 - \
@@ -446,6 +489,31 @@ def die_bit_offset( die ):
             die.DW_AT_bit_offset
    return None
 
+def bitfieldLayout( bitOffset, bits, structSize, signed ):
+   ''' Return the layout of a bitfield for CTypeGenRun.Bitfield: the offset
+   and size of the smallest native-endian integer that holds the field, the
+   shift to the field within that integer, the field's width, and whether it
+   is signed. "bitOffset" is the DWARF data bit offset, which counts from the
+   least significant bit of the first byte on little-endian machines, and
+   from the most significant on big-endian ones. Returns None if no integer
+   we can read holds it. '''
+   for size in ( 1, 2, 4, 8 ):
+      if bitOffset % 8 + bits <= size * 8:
+         break
+   else:
+      return None
+   start = bitOffset // 8
+   # Don't read past the end of the object: read a word ending at its end,
+   # and shift further into it instead.
+   if structSize is not None and start + size > structSize:
+      start = max( structSize - size, 0 )
+   shift = bitOffset - start * 8
+   if shift + bits > size * 8:
+      return None
+   if sys.byteorder == "big":
+      shift = size * 8 - shift - bits
+   return ( start, size, shift, bits, signed )
+
 class MemberType( Type ):
    ''' A struct, class  or union type - anything that has fields. '''
    __slots__ = [
@@ -453,6 +521,7 @@ class MemberType( Type ):
            "alignment_",
            "anonMembers",
            "base",
+           "layout",
            "members",
            "mixins",
            "packed",
@@ -479,6 +548,7 @@ class MemberType( Type ):
       self.packed = False
       self.unalignedPtrs = False
       self.superCount = 0
+      self.layout = None # our definition in the layout sidecar, if any.
 
    def findMembers( self ):
       if self.members:
@@ -578,6 +648,12 @@ class MemberType( Type ):
       ''' Declare a structure - we don't need to know the fields to
       declare it (think forward reference) '''
 
+      layouts = self.resolver.layouts
+      if layouts is not None:
+         layouts.declare( out, self.pyName(), self.base, self.mixins )
+         self.register( out )
+         return
+
       out.write( '\n' )
       # TestableCtypeClass is a mixin defined in CTypeGenRun, and
       # provides methods on the # generated class to do some consistency
@@ -590,8 +666,24 @@ class MemberType( Type ):
       if self.dieComment():
          out.write( "   %s\n" % self.dieComment() )
       out.write( "   pass\n" )
+      self.register( out )
       out.write( '\n' )
 
+   def register( self, out ):
+      ''' If we are sharing types, replace the class we just declared with
+      the one in the process-wide registry, if there is one '''
+      key = self.resolver.sharedTypeKey( self )
+      if key is not None:
+         out.write( f"{self.pyName()} = registerType( {self.pyName()}, {key!r} )\n" )
+
+   def offsets( self ):
+      ''' Return the list of offsets of our fields, if we want them checked '''
+      return None
+
+   def defaultFields( self ):
+      ''' Return the fields to use if the type has no members '''
+      return None
+
    def define( self, out ):
       ''' Define a type: we need to render the fields now, so something else
       can include an object of this type, or access a field '''
@@ -604,29 +696,23 @@ class MemberType( Type ):
       for m in self.members:
          self.resolver.defineType( m.type(), out )
 
-      out.write( "\n" )
-      out.write( "%s._ctypegen_native_size = %d\n" % ( self.pyName(),
-                                                          self.size() ) )
-      out.write( "%s._ctypegen_have_definition = True\n" % self.pyName() )
-
       # Indicate any fields we'll intentionally allow to have unaligned
       # pointers in them.
       if self.unalignedPtrs:
-         out.write( "%s.allow_unaligned = True\n" % self.pyName() )
+         unaligned = True
       else:
-         unaligned = [ m.pyName() for m in self.members if m.allowUnalignedPtr ]
-         if unaligned:
-            out.write( f"{self.pyName()}.allow_unaligned = {unaligned}\n" )
+         unaligned = [ m.pyName() for m in self.members if m.allowUnalignedPtr ] \
+               or None
 
       self.alignment_ = 1
       packComment = "explicitly requested by type hint"
 
+      # Each field is ( name, ctype ), or ( name, ctype, bits ) for bitfields
+      fields = None
+      # The layout DWARF gives each bitfield, for CTypeGenRun.Bitfield.
+      bitfields = {}
       if self.members:
-         # We must set _pack_ before _fields_, because due to a limitation of ctypes,
-         # so accumulate fields in _fields_pre, first as we calculate what to do
-         # about packing. 9quoting the 'p' below stops pylint gagging on this file.)
-         out.write( "%s._fields_pre = [ # \x70ylint: disable=protected-access\n" %
-                    self.pyName() )
+         fields = []
 
          # the bit offset expected for the next field in a bitfield assuming it
          # fits in the current datatype
@@ -690,6 +776,14 @@ class MemberType( Type ):
             # the correct offset within this data object. we don't try and deal
             # with anonymous bitfields taking up entire data objects before
             # non-bitfield fields.
+            #
+            # defineBitfields only replaces the accessors of bitfields ctypes
+            # puts in the wrong place: the storage ctypes allocates still
+            # comes from _fields_, so these pads are what keep the members
+            # after the bitfields, and the size of the whole object, where
+            # DWARF says they are. Members with a ctypeOverride are emitted
+            # as the type the user asked for, not as bitfields, and the user
+            # is responsible for their layout, as in offsets() below.
 
             fieldDie = member.die
             off = die_bit_offset( fieldDie )
@@ -702,9 +796,9 @@ class MemberType( Type ):
                      # Insert padding to consume the remainder of this field
                      padding = expected_end - expected_bit_offset
                      member.pre_pads.append( padding )
-                     out.write( "   ( \"%s\", %s, %d ),\n" %
-                        ( "%s_prepad_%d" % ( member.pyName(), expected_end ),
-                           typstr, padding ) )
+                     fields.append( ( "%s_prepad_%d" % ( member.pyName(),
+                                                         expected_end ),
+                                      typstr, padding ) )
                   # Move on to the next data object.
                   expected_bit_offset = expected_end
                   expected_end = expected_bit_offset + die_size( fieldDie ) * 8
@@ -714,19 +808,22 @@ class MemberType( Type ):
                diff = off - expected_bit_offset
                if diff != 0:
                   member.pre_pads.append( diff )
-                  out.write( "   ( \"%s\", %s, %d ),\n" %
-                     ( "%s_prepad_%d" % ( member.pyName(), expected_end ),
-                        typstr, diff ) )
+                  fields.append( ( "%s_prepad_%d" % ( member.pyName(),
+                                                      expected_end ),
+                                   typstr, diff ) )
 
                # The next bitfield in this data object will be directly after
                # this one
                expected_bit_offset = off + fieldDie.DW_AT_bit_size
 
-               out.write( "   ( \"%s\", %s, %d ),\n" %
-                          ( member.pyName(), typstr, member.bit_size() ) )
+               fields.append( ( member.pyName(), typstr, member.bit_size() ) )
+               layout = bitfieldLayout( off, fieldDie.DW_AT_bit_size, self.size(),
+                                        dieIsSigned( fieldDie.DW_AT_type ) )
+               if layout is not None:
+                  bitfields[ member.pyName() ] = layout
             else:
                # Regular, non-bitfield member.
-               out.write( f"   ( \"{member.name()}\", {typstr} ),\n" )
+               fields.append( ( member.name(), typstr ) )
                byteoff = fieldDie.DW_AT_data_member_location or 0
                if self.definition().tag() != tags.DW_TAG_union_type:
                   # Full data object - if the next object is a bitfield, it'll
@@ -759,10 +856,8 @@ class MemberType( Type ):
          if self.definition().tag() != tags.DW_TAG_union_type and \
                expected_end < actual_size and \
                len( self.members ) != self.superCount:
-            out.write( "   ( \"__trailing_pad\", (c_char * %d)),\n" % (
-               actual_size - expected_end ) )
-
-         out.write( "]\n" )
+            fields.append( ( "__trailing_pad",
+                             "(c_char * %d)" % ( actual_size - expected_end ) ) )
 
          # If the size of the entire object is not a multiple of the alignment
          # we calculated the type must be packed.
@@ -775,22 +870,87 @@ class MemberType( Type ):
          # If this type is packed, then let ctypes know, and set its alignment
          # to 1, because packed types don't need to be aligned in structures.
          if self.packed:
-            out.write( f"{self.pyName()}._pack_ = 1 # {packComment}\n" )
             self.alignment_ = 1
 
-         if self.anonMembers:
-            out.write( "%s._anonymous_ = (\n" % self.pyName() )
-            for fieldDie in sorted( self.anonMembers ):
-               out.write( "   \"%s\",\n" % fieldDie.pyName() )
+      if fields is None:
+         fields = self.defaultFields()
+      anonymous = [ member.pyName() for member in sorted( self.anonMembers ) ]
+      offsets = self.offsets()
+      layouts = self.resolver.layouts
+      if layouts is not None:
+         self.layout = layouts.define( out, self.pyName(), self.size(), unaligned,
+               fields, self.packed, anonymous )
+         self.layout[ LayoutWriter.OFFSETS ] = offsets
+         self.layout[ LayoutWriter.BITFIELDS ] = bitfields or None
+         return True
+
+      name = self.pyName()
+      out.write( "\n" )
+      if self.resolver.sharedTypeKey( self ) is not None:
+         # Another module may have defined the type we share already.
+         out.write( f"if needsDefinition( {name} ):\n" )
+         body = io.StringIO()
+         self.writeDefinition( body, unaligned, fields, packComment, anonymous,
+                               offsets, bitfields )
+         for line in body.getvalue().splitlines( True ):
+            out.write( f"   {line}" if line.strip() else line )
+      else:
+         self.writeDefinition( out, unaligned, fields, packComment, anonymous,
+                               offsets, bitfields )
+      return True
+
+   def writeDefinition( self, out, unaligned, fields, packComment, anonymous,
+         offsets, bitfields ):
+      ''' Write the python to set our fields, and other attributes '''
+      name = self.pyName()
+      out.write( "%s._ctypegen_native_size = %d\n" % ( name, self.size() ) )
+      out.write( "%s._ctypegen_have_definition = True\n" % name )
+      if unaligned is not None:
+         out.write( f"{name}.allow_unaligned = {unaligned}\n" )
+
+      if fields is not None:
+         # We must set _pack_ before _fields_, because due to a limitation of ctypes,
+         # so accumulate fields in _fields_pre, first as we calculate what to do
+         # about packing. 9quoting the 'p' below stops pylint gagging on this file.)
+         out.write( "%s._fields_pre = [ # \x70ylint: disable=protected-access\n" %
+                    name )
+         for field in fields:
+            if len( field ) == 3:
+               out.write( "   ( \"%s\", %s, %d ),\n" % field )
+            else:
+               out.write( "   ( \"%s\", %s ),\n" % field )
+         out.write( "]\n" )
+
+         if self.packed:
+            out.write( f"{name}._pack_ = 1 # {packComment}\n" )
+
+         if anonymous:
+            out.write( "%s._anonymous_ = (\n" % name )
+            for anon in anonymous:
+               out.write( "   \"%s\",\n" % anon )
             out.write( "   )\n" )
 
          # Now that we've worked out what to do with the "pack" field, we can
          # finally assign to the type's _fields_
-         out.write( "%s._fields_ = %s._fields_pre\n" %
-                    ( self.pyName(), self.pyName() ) )
+         out.write( "%s._fields_ = %s._fields_pre\n" % ( name, name ) )
 
       out.write( "\n" )
-      return True
+
+      if offsets is not None:
+         out.write( f"{name}._ctypegen_offsets = [ "  )
+         sep = ""
+         for memberCount, offset in enumerate( offsets, 1 ):
+            out.write( f"{sep}{offset}" )
+            sep = ", " if memberCount % 10 != 0 else ",\n    "
+         out.write( " ]\n\n" )
+
+      if bitfields:
+         # This must follow _fields_, so we can replace the accessors ctypes
+         # gets wrong.
+         out.write( f"defineBitfields( {name}, {{\n" )
+         for field, layout in bitfields.items():
+            out.write( f"   {field!r}: {layout},\n" )
+         out.write( "} )\n\n" )
 
 class StructType( MemberType ):
    ''' A member type for a structure (or class) '''
@@ -800,13 +960,8 @@ class StructType( MemberType ):
    def ctype_subclass( self ):
       return "Structure"
 
-   def define( self, out ):
-      if not super().define( out ):
-         return False
-      out.write( f"{self.pyName()}._ctypegen_offsets = [ "  )
-      sep = ""
-
-      memberCount = 0
+   def offsets( self ):
+      offsets = []
       lastOffset = -1
       for member in self.members:
          memberOffset = member.die.DW_AT_data_member_location
@@ -822,19 +977,12 @@ class StructType( MemberType ):
          else:
             offset = None
 
-         for _ in member.pre_pads:
-            # if we're adding our own padding in front of this member (for anon
-            # bitfields), include the padding in the offsets table as "-1". We
-            # don't expect anything to access it anyway.
-            out.write( f"{sep}{-1}" )
-            sep = ", " if memberCount % 10 != 0 else ",\n    "
-            memberCount += 1
-
-         out.write( f"{sep}{offset}" )
-         memberCount += 1
-         sep = ", " if memberCount % 10 != 0 else ",\n    "
-      out.write( " ]\n\n" )
-      return True
+         # if we're adding our own padding in front of this member (for anon
+         # bitfields), include the padding in the offsets table as "-1". We
+         # don't expect anything to access it anyway.
+         offsets += [ -1 ] * len( member.pre_pads )
+         offsets.append( offset )
+      return offsets
 
 class UnionType( MemberType ):
    ''' Member type for a union '''
@@ -843,13 +991,10 @@ class UnionType( MemberType ):
    def ctype_subclass( self ):
       return "Union"
 
-   def define( self, out ):
-      if not super().define( out ):
-         return False
-      if not self.members and self.die.DW_AT_byte_size is not None:
-         out.write( f"{self.pyName()}._fields_ = [('__broken_transparent_union', "
-                    "c_void_p)]\n" )
-      return True
+   def defaultFields( self ):
+      if self.die.DW_AT_byte_size is not None:
+         return [ ( '__broken_transparent_union', 'c_void_p' ) ]
+      return None
 
 class EnumType( Type ):
    __slots__ = [ "nameless" ]
@@ -868,31 +1013,88 @@ class EnumType( Type ):
          self.resolver.defineType( rtype, out )
       indent = ''
 
-      out.write( f"class {self.pyName()}( {self.intType()} ):\n" )
+      intType = self.intType()
+      enumerators = []
+      for child in self.definition():
+         if child.tag() == tags.DW_TAG_enumerator:
+            value = child.DW_AT_const_value
+            enumerators.append( ( asPythonId( child.DW_AT_name ), value,
+                                  self.literal( intType, value ) ) )
+
+      # The reverse mapping from values to names uses the first enumerator
+      # with each value, as C code normally does.
+      names = {}
+      for name, _, literal in enumerators:
+         names.setdefault( literal, name )
+
+      out.write( f"class {self.pyName()}( {intType} ):\n" )
       out.write( f'{pad( 3 )}_ctypegen_have_definition = True\n' )
+      if enumerators:
+         out.write( f"{pad( 3 )}_ctypegen_names = {{ " )
+         out.write( "".join( f"{literal}: {name!r}, "
+                             for literal, name in names.items() ) )
+         out.write( "}\n" )
+         flags = self.flags( enumerators )
+         if flags:
+            out.write( f"{pad( 3 )}_ctypegen_flags = ( " )
+            out.write( "".join( f"( {value}, {name!r} ), "
+                                for value, name in flags ) )
+            out.write( ")\n" )
       if not self.nameless:
          indent = pad( 3 )
       else:
          out.write( f'# Values of {self.pyName()} (nameless enum)\n' )
 
-      childcount = 0
-      for child in self.definition():
+      for name, value, literal in enumerators:
          if self.dieComment():
             out.write( f"{indent}{self.dieComment()}\n" )
-         if child.tag() == tags.DW_TAG_enumerator:
-            childcount += 1
-            value = child.DW_AT_const_value
-            name = asPythonId( child.DW_AT_name )
-            out.write( f"{indent}{name} = {self.intType()}({value}).value # "
-                       f"{hex(value)}\n" )
-            if self.nameless:
-               self.resolver.defined.add( name )
-      if childcount == 0:
+         out.write( f"{indent}{name} = {literal} # {hex(value)}\n" )
+         if self.nameless:
+            self.resolver.defined.add( name )
+      if not enumerators and not self.nameless:
          out.write( f"{indent}pass\n" )
 
+      key = self.resolver.sharedTypeKey( self )
+      if key is not None:
+         out.write( f"{self.pyName()} = registerType( {self.pyName()}, {key!r} )\n" )
+
       out.write( "\n\n" )
       return True
 
+   @staticmethod
+   def literal( intType, value ):
+      ''' Return the python literal for "value", as represented by the ctypes
+      integer type named "intType". If we can't work that out here, the
+      module does the conversion when it is imported '''
+      ctype = getattr( ctypes, intType, None ) if intType.startswith( "c_" ) \
+            else None
+      if ctype is not None:
+         try:
+            return repr( ctype( value ).value )
+         except ( TypeError, ValueError, OverflowError ):
+            pass
+      return f"({intType}({value}).value)"
+
+   @staticmethod
+   def flags( enumerators ):
+      ''' If this looks like an enum of flags - every non-zero value is a
+      distinct power of two - return ( value, name ) for each flag, in order
+      of value. '''
+      flags = {}
+      for name, _, literal in enumerators:
+         try:
+            value = int( literal )
+         except ValueError:
+            return None
+         if value == 0:
+            continue
+         if value < 0 or value & ( value - 1 ) or value in flags:
+            return None
+         flags[ value ] = name
+      if len( flags ) < 2:
+         return None
+      return sorted( flags.items() )
+
    def intType( self ):
       typ = self.definition().DW_AT_type
       if typ is None:
@@ -1006,6 +1208,14 @@ def alignmentFromEncoding( die ):
                        f"(encoding, size): {key} on this architecture" )
    return align
 
+def dieIsSigned( die ):
+   ''' Return True if the integer type "die", after dereferencing typedefs
+   and enums, is signed '''
+   while die is not None and die.DW_AT_encoding is None:
+      die = die.DW_AT_type
+   return die is not None and die.DW_AT_encoding in ( enc.DW_ATE_signed,
+                                                     enc.DW_ATE_signed_char )
+
 _baseTypes = {
       "long long unsigned int" : ( "c_ulonglong", _align( 4, 8 ) ),
       "unsigned long long" : ( "c_ulonglong", _align( 4, 8 ) ),
@@ -1255,6 +1465,282 @@ typeFromTag = {
       tags.DW_TAG_ptr_to_member_type : PointerType,
 }
 
+class Chunk:
+   ''' A fragment of python that can be executed on its own, when a generated
+   module is written lazily. '''
+
+   __slots__ = [
+         "comment",  # Comment to add to the chunk's entry in the lazy table
+         "complete", # names used by the chunk need complete definitions
+         "deps",     # chunks that must be executed before this one.
+         "text",     # the python source for the chunk
+         "typ",      # the Type we were declaring or defining, if any.
+   ]
+
+   def __init__( self, typ, complete, comment ):
+      self.typ = typ
+      self.complete = complete
+      self.comment = comment
+      self.deps = set()
+      self.text = io.StringIO()
+
+def boundNames( tree ):
+   ''' The names bound by the top-level statements of an ast.Module '''
+   for stmt in tree.body:
+      if isinstance( stmt, ( ast.ClassDef, ast.FunctionDef ) ):
+         yield stmt.name
+      elif isinstance( stmt, ast.Assign ):
+         for target in stmt.targets:
+            if isinstance( target, ast.Name ):
+               yield target.id
+
+def usedNames( tree ):
+   ''' All the names read by the code in an ast.Module '''
+   for node in ast.walk( tree ):
+      if isinstance( node, ast.Name ) and isinstance( node.ctx, ast.Load ):
+         yield node.id
+
+class LazyChunks:
+   ''' Collects the python generated for a module as a set of chunks, each with
+   the chunks it depends on, and writes them as a LazyDefinitions table, so the
+   generated module can execute each chunk only when the names it defines are
+   first used.
+
+   Declaring or defining a type writes that type's python to its own chunk.
+   When doing so requires declaring or defining another type, we record a
+   dependency on the other type's chunk. Other code, such as the Globals class
+   or function-like macros, is added as individual chunks, and depends on the
+   complete definitions of the names it uses. '''
+
+   def __init__( self ):
+      self.chunks = []
+      self.byKey = {} # ( "declare"|"define", Type ) -> Chunk
+      self.stack = [] # chunks being generated.
+
+   def dependOn( self, key ):
+      ''' The chunk being generated depends on an existing chunk '''
+      chunk = self.byKey.get( key )
+      if chunk is not None and self.stack:
+         self.stack[ -1 ].deps.add( chunk )
+
+   @contextlib.contextmanager
+   def record( self, key=None, complete=False, comment=None ):
+      ''' Yield the stream for a chunk. If "key" is given, writes for the same
+      key append to the same chunk. '''
+      chunk = self.byKey.get( key ) if key is not None else None
+      if chunk is None:
+         chunk = Chunk( key[ 1 ] if key is not None else None, complete, comment )
+         self.chunks.append( chunk )
+         if key is not None:
+            self.byKey[ key ] = chunk
+      if self.stack:
+         self.stack[ -1 ].deps.add( chunk )
+      self.stack.append( chunk )
+      try:
+         yield chunk.text
+      finally:
+         self.stack.pop()
+
+   def add( self, source, comment=None ):
+      ''' Add a self-contained chunk of python. '''
+      with self.record( complete=True, comment=comment ) as out:
+         out.write( source )
+
+   def resolve( self, partition=None ):
+      ''' Return the LazyDefinitions tables for the chunks. "partition" is
+      called with each chunk's Type ( or None for chunks that are not for a
+      type ), and returns the name of the module in a generated package that
+      the chunk belongs in, or None for the package itself. The result maps
+      each module name to a tuple containing a list of ( source, dependencies,
+      comment ) for its chunks, a dict mapping each name the module defines to
+      the index of the chunk that completes the definition, and a dict
+      mapping names used from other modules to the module that defines them.
+      Without a partition, the result has a single entry, for None. '''
+      index = { chunk: i for i, chunk in enumerate( self.chunks ) }
+      trees = [ ast.parse( chunk.text.getvalue() ) for chunk in self.chunks ]
+
+      # The chunk that binds each name, and the chunk to execute to complete
+      # its definition. For a struct, the first is where the class is
+      # declared, the second where its fields are set.
+      bindings = {}
+      complete = {}
+      for chunk, tree in zip( self.chunks, trees ):
+         for name in boundNames( tree ):
+            bindings[ name ] = chunk
+            complete[ name ] = chunk if chunk.typ is None else \
+                  self.byKey.get( ( "define", chunk.typ ), chunk )
+
+      allDeps = []
+      for chunk, tree in zip( self.chunks, trees ):
+         deps = set( chunk.deps )
+         lookup = complete if chunk.complete else bindings
+         for name in usedNames( tree ):
+            dep = lookup.get( name )
+            if dep is not None:
+               deps.add( dep )
+         deps.discard( chunk )
+         allDeps.append( deps )
+
+      # Many chunks are empty - pointers and primitive types have nothing to
+      # define, for example. Unless a name refers to them, replace each empty
+      # chunk in the dependencies with its own dependencies, and drop it.
+      named = set( complete.values() )
+      kept = [ chunk for chunk in self.chunks
+               if chunk in named or chunk.text.getvalue() ]
+
+      if partition is None:
+         modules = { chunk : None for chunk in kept }
+      else:
+         modules = { chunk : partition( chunk.typ ) for chunk in kept }
+
+      # A module refers to a chunk in another module by one of the names it
+      # defines.
+      nameOf = {}
+      for name, chunk in sorted( bindings.items() ) + sorted( complete.items() ):
+         nameOf.setdefault( chunk, name )
+
+      tables = defaultdict( lambda: ( [], {}, {} ) )
+      newIndex = {}
+      for chunk in kept:
+         chunks, _, _ = tables[ modules[ chunk ] ]
+         newIndex[ chunk ] = len( chunks )
+         chunks.append( None )
+
+      def keptDeps( chunk, imports ):
+         local = set()
+         external = set()
+         pending = list( allDeps[ index[ chunk ] ] )
+         seen = set()
+         while pending:
+            dep = pending.pop()
+            if dep in seen:
+               continue
+            seen.add( dep )
+            if dep not in newIndex or \
+                  modules[ dep ] != modules[ chunk ] and dep not in nameOf:
+               pending.extend( allDeps[ index[ dep ] ] )
+            elif modules[ dep ] == modules[ chunk ]:
+               local.add( newIndex[ dep ] )
+            else:
+               external.add( nameOf[ dep ] )
+               imports[ nameOf[ dep ] ] = modules[ dep ]
+         local.discard( newIndex[ chunk ] )
+         return tuple( sorted( local ) ) + tuple( sorted( external ) )
+
+      for chunk in kept:
+         chunks, _, imports = tables[ modules[ chunk ] ]
+         chunks[ newIndex[ chunk ] ] = ( chunk.text.getvalue(),
+                                         keptDeps( chunk, imports ),
+                                         chunk.comment )
+      for name, chunk in complete.items():
+         tables[ modules[ chunk ] ][ 1 ][ name ] = newIndex[ chunk ]
+
+      # The package itself provides every name in the package.
+      _, rootNames, rootImports = tables[ None ]
+      for module, ( _, names, _ ) in tables.items():
+         if module is not None:
+            for name in names:
+               if name not in rootNames:
+                  rootImports[ name ] = module
+      return dict( tables )
+
+   @staticmethod
+   def write( stream, chunks, names, imports ):
+      ''' Write out a LazyDefinitions table as returned by resolve, and make it
+      provide the module's __getattr__ and __dir__. "imports" maps names to
+      the full name of the module that defines them. '''
+      stream.write( "CTYPEGEN_lazy = LazyDefinitions( globals(), [\n" )
+      for idx, ( source, deps, comment ) in enumerate( chunks ):
+         comment = f"{idx}: {comment}" if comment else f"{idx}"
+         stream.write( f"   ( {source!r}, {deps!r} ), # {comment}\n" )
+      stream.write( "], {\n" )
+      for name, idx in sorted( names.items() ):
+         stream.write( f"   {name!r}: {idx},\n" )
+      if imports:
+         stream.write( "}, {\n" )
+         for name, module in sorted( imports.items() ):
+            stream.write( f"   {name!r}: {module!r},\n" )
+      stream.write( "} )\n" )
+      stream.write( "__getattr__ = CTYPEGEN_lazy.get\n" )
+      stream.write( "__dir__ = CTYPEGEN_lazy.dir\n" )
+
+class LayoutWriter:
+   ''' Collects the layouts of structs and unions for a layout sidecar file.
+   Rather than rendering python statements to create each class and set its
+   fields, the generated module calls its CTypeGenRun.LayoutTable to build the
+   classes from the records in the sidecar. Each distinct ctypes expression
+   used for a field's type is stored once, and evaluated once by the loader. '''
+
+   FIELDS = CTypeGenRun.LayoutTable.FIELDS
+   OFFSETS = CTypeGenRun.LayoutTable.OFFSETS
+   BITFIELDS = CTypeGenRun.LayoutTable.BITFIELDS
+
+   def __init__( self, filename ):
+      self.filename = filename
+      self.exprs = {} # python expression -> index
+      self.records = []
+      # ( stream, start, end, first ) for the last "define" call we wrote, so
+      # we can extend it to cover successive definitions.
+      self.lastDefine = None
+
+   def expr( self, text ):
+      return self.exprs.setdefault( text, len( self.exprs ) )
+
+   def fields( self, fields ):
+      return [ ( field[ 0 ], self.expr( field[ 1 ] ) ) + tuple( field[ 2: ] )
+               for field in fields ]
+
+   def declare( self, out, name, base, mixins ):
+      self.records.append( ( CTypeGenRun.LayoutTable.DECLARE, name,
+                             self.expr( base ),
+                             [ self.expr( mixin ) for mixin in mixins ] ) )
+      idx = len( self.records ) - 1
+      out.write( f"{name} = CTYPEGEN_layouts.declare( {idx} )\n" )
+
+   def define( self, out, name, size, unaligned, fields, packed, anonymous ):
+      ''' Add a definition, and return the record, so subclasses can add
+      to it. '''
+      record = [ CTypeGenRun.LayoutTable.DEFINE, name, size, unaligned,
+                 None if fields is None else self.fields( fields ), packed,
+                 anonymous, None, None ]
+      self.records.append( record )
+      idx = len( self.records ) - 1
+
+      # Successive definitions are built with a single call.
+      first = idx
+      if self.lastDefine is not None:
+         stream, start, end, prevFirst = self.lastDefine
+         if stream is out and out.tell() == end and \
+               self.records[ idx - 1 ][ 0 ] == CTypeGenRun.LayoutTable.DEFINE:
+            out.seek( start )
+            out.truncate()
+            first = prevFirst
+      start = out.tell()
+      if first == idx:
+         out.write( f"CTYPEGEN_layouts.define( {idx} )\n" )
+      else:
+         out.write( f"CTYPEGEN_layouts.define( {first}, {idx} )\n" )
+      self.lastDefine = ( out, start, out.tell(), first )
+      return record
+
+   def write( self ):
+      exprs = sorted( self.exprs, key=self.exprs.get )
+
+      # marshal writes a reference to an interned string it has already
+      # written, rather than the string, so intern the field names - they
+      # are very repetitive.
+      def intern( value ):
+         if isinstance( value, str ):
+            return sys.intern( value )
+         if isinstance( value, ( list, tuple ) ):
+            return type( value )( intern( item ) for item in value )
+         return value
+
+      with open( self.filename, "wb" ) as f:
+         marshal.dump( ( CTypeGenRun.LayoutTable.VERSION, exprs,
+                         [ intern( tuple( record ) ) for record in self.records ] ),
+                       f )
+
 class TypeResolver:
 
    ''' Construct a python file with a set of Ctypes derived from a
@@ -1271,12 +1757,18 @@ class TypeResolver:
          "errors",            # Errors generated by default error function
          "existingTypes",     # Set of existing CTypegen-generated modules to search
          "functions",         # Functions we've found
+         "functionTypeNames", # Maps CFUNCTYPE expressions to their names
          "functionsFilter",   # called to check if we should render a function
          "globalsFilter",     # called to check if we should render a global variable
+         "lazy",              # Write types as chunks in lazyChunks
+         "lazyChunks",        # Python to be executed on demand by the module
+         "layouts",           # LayoutWriter for struct layouts, if using a sidecar
          "namelessEnums",     # Enum values should not be enclosed in their own class
          "namespaceFilter",   # Called to determine if we should explore a namespace
          "pkgname",           # The name of the package we generate.
+         "libraryKeys",       # Maps ELF objects to their identity for shareTypes
          "producers",         # list of distinct producers that contribute to DWARF
+         "shareTypes",        # Register structs, unions and enums with CTypeGenRun
          "types",             # All the types we have found
          "typesFilter",       # called to see if we should render a type
          "variables",         # All the variables we want to render
@@ -1292,6 +1784,7 @@ class TypeResolver:
       self.types = {} # index by DIE fullname, then tag.
       self.variables = {} # index by DIE fullname
       self.functions = {} # index by DIE fullname
+      self.functionTypeNames = {}
       self.defineTypes = set()
 
       self.pkgname = None
@@ -1302,6 +1795,11 @@ class TypeResolver:
       self.applyHints = {}
       self.allHintedTypes = {}
       self.defined = set()
+      self.lazy = False
+      self.lazyChunks = LazyChunks()
+      self.layouts = None
+      self.shareTypes = False
+      self.libraryKeys = {}
 
       allNamespaces = set()
 
@@ -1467,17 +1965,25 @@ class TypeResolver:
       if typ is None:
          return
 
+      if self.lazy:
+         self.lazyChunks.dependOn( ( "declare", typ ) )
       if typ.declared:
          return
       if typ.resolver != self: # This type came from a different module - use as is
          return
-      typ.declare( out )
+      if self.lazy:
+         with self.lazyChunks.record( ( "declare", typ ) ) as chunk:
+            typ.declare( chunk )
+      else:
+         typ.declare( out )
       typ.declared = True
 
    def defineType( self, typ, out ):
       ''' Idempotent wrapper for Type.define '''
       if typ is None or typ.die is None:
          return True
+      if self.lazy:
+         self.lazyChunks.dependOn( ( "define", typ ) )
       if typ.defined:
          return True
       if typ.resolver != self: # This type came from a different module - use as is
@@ -1486,12 +1992,44 @@ class TypeResolver:
          self.errorfunc( f"{typ.name()} is 'void' - cannot output definition" )
          return True
 
-      typ.defined = typ.define( out )
+      if self.lazy:
+         with self.lazyChunks.record( ( "define", typ ) ) as chunk:
+            typ.defined = typ.define( chunk )
+      else:
+         typ.defined = typ.define( out )
       assert typ.defined is not None # typ.define should return a bool.
       if typ.defined:
          self.defined.add( typ.pyName() )
       return typ.defined
 
+   def sharedTypeKey( self, typ ):
+      ''' Return the key for "typ" in CTypeGenRun's registry of shared types,
+      or None if it's not shared. Types are identified by the build ID (or
+      soname) of the object that describes them, and their name. '''
+      if not self.shareTypes:
+         return None
+      obj = typ.die.object()
+      if obj not in self.libraryKeys:
+         self.libraryKeys[ obj ] = obj.buildId() or obj.soname()
+      library = self.libraryKeys[ obj ]
+      if library is None:
+         return None
+      return ( library, typ.name() )
+
+   def functionTypeName( self, signature, out ):
+      ''' Return the name for the CFUNCTYPE created by the python expression
+      "signature", writing its definition to "out" if this is its first use.
+      All function types with the same signature share a name, so we create
+      one ctypes class for them all. The name is derived from the signature,
+      so adding a function doesn't rename the types of the others. '''
+      name = self.functionTypeNames.get( signature )
+      if name is None:
+         digest = hashlib.sha1( signature.encode() ).hexdigest()
+         name = f"CTYPEGEN_functype_{digest[ : 16 ]}"
+         out.write( f"{name} = {signature}\n" )
+         self.functionTypeNames[ signature ] = name
+      return name
+
    def examineDIE( self, handle, die ):
       ''' Find any potentially interesting dwarf DIEs
       '''
@@ -1552,8 +2090,26 @@ class TypeResolver:
          for child in die:
             self.enumerateDIEs( child, func )
 
-   def write( self, stream ):
-      ''' Actually write the python file to a stream '''
+   def write( self, stream, lazy=False, layoutFile=None, lazyPrototypes=False ):
+      ''' Actually write the python file to a stream. If "lazy" is set, we
+      write only the imports: the python for the types, globals and functions
+      is collected in lazyChunks, and written later as a LazyDefinitions table,
+      so the module defines each name when it is first used. If "layoutFile"
+      is set, the layouts of structs and unions are written to that file
+      rather than as python, and the module builds them with a
+      CTypeGenRun.LayoutTable. If "lazyPrototypes" is set, the prototypes of
+      functions are written as a CTypeGenRun.FunctionPrototypes table, which
+      is only evaluated as each function is used. '''
+      self.lazy = lazy
+      if layoutFile is not None:
+         self.layouts = LayoutWriter( layoutFile )
+
+      def emit( source ):
+         if lazy:
+            self.lazyChunks.add( source )
+         else:
+            stream.write( source )
+
       stream.write(
 '''from ctypes import * # pylint: disable=wildcard-import
 from CTypeGenRun import * # pylint: disable=wildcard-import
@@ -1565,6 +2121,9 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
       for pkg in sorted( self.existingTypes, key=str ):
          stream.write( "import %s\n" % pkg.__name__ )
       stream.write( "\n" )
+      if self.layouts is not None:
+         stream.write( "CTYPEGEN_layouts = LayoutTable( globals(), "
+                       f"{os.path.basename( layoutFile )!r} )\n\n" )
 
       # Define any types needed by variables or functions, as they may
       # contribute to self.types.
@@ -1597,8 +2156,9 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
       # this module.
       for typ, hint in sorted( self.allHintedTypes.items() ):
          if hint.pythonName != typ.ctype():
-            stream.write( '{} = {} # python hint differs from ctype\n'.format(
-                          hint.pythonName, typ.ctype() ) )
+            emit( '{} = {} # python hint differs from ctype\n'.format(
+                  hint.pythonName, typ.ctype() ) )
+            self.defined.add( hint.pythonName )
 
       # If tagged types don't conflict with untagged, we can make aliases without
       # the tag prefix
@@ -1607,13 +2167,14 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
             for tag, typ in sorted( byTag.items() ):
                if not isinstance( typ, ExternalType ) and \
                         typ.defined and tag in TAGGED_ELEMENTS:
-                  stream.write( f"{typ.pyName( False )} = {typ.pyName( True )} "
-                                "# unambiguous name for tagged type\n" )
+                  emit( f"{typ.pyName( False )} = {typ.pyName( True )} "
+                        "# unambiguous name for tagged type\n" )
+                  self.defined.add( typ.pyName( False ) )
 
       # Now write out a class definition containing an entry for each global
-      # variable.
-      stream.write( "class Globals(object):\n" )
-      stream.write( "%sdef __init__(self, dll):\n" % pad( 3 ) )
+      # variable. Each variable is looked up when it is first used.
+      out = io.StringIO()
+      out.write( "class Globals( LazyGlobals ):\n" )
 
       for _, die in sorted( self.variables.items() ):
          if die is None:
@@ -1625,31 +2186,70 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
             cname = die.DW_AT_name
          pyName = asPythonId( "::".join( die.fullname() ) )
 
-         stream.write( "%sself.%s = ( %s ).in_dll( dll, '%s' )\n" %
-                       ( pad( 6 ), pyName, t.ctype(), cname ) )
+         out.write( f"{pad( 3 )}{pyName} = GlobalVariable( globals(), "
+                    f"{t.ctype()!r}, '{cname}' )\n" )
+
+      out.write( "%spass\n" % pad( 3 ) )
+      emit( out.getvalue() )
 
-      stream.write( "%spass" % pad( 6 ) )
+      if lazyPrototypes:
+         self.writePrototypes( emit )
+      else:
+         self.writeLibUpdates( emit )
 
+      stream.write( '\n' )
+      if self.layouts is not None:
+         self.layouts.write()
+
+   def writePrototypes( self, emit ):
+      ''' Write the table of prototypes for the functions, and a
+      decorateFunctions and functionTypes that use it '''
+      out = io.StringIO()
+      out.write( "\nCTYPEGEN_prototypes = FunctionPrototypes( globals(), {\n" )
+      for _, die in sorted( self.functions.items() ):
+         if not die:
+            continue
+         t = self.dieToType( die )
+         restype, args = t.prototype()
+         args = "".join( f"{arg!r}, " for arg in args )
+         linkernames = "".join( f"{name!r}, " for name in t.linkerNames() )
+         out.write( f"   {t.pyName()!r}: ( {restype!r}, ( {args}), "
+                    f"( {linkernames}) ),\n" )
+      out.write( "} )\n\n" )
+      out.write( "def decorateFunctions( lib ):\n" )
+      out.write( "   CTYPEGEN_prototypes.decorate( lib )\n" )
+      emit( out.getvalue() )
+      if any( self.functions.values() ):
+         emit( "\nfunctionTypes = CTYPEGEN_prototypes\n" )
+
+   def writeLibUpdates( self, emit ):
+      ''' Write decorateFunctions to set the prototypes of all the functions
+      in a library, and functionTypes, a dictionary of their CFUNCTYPEs '''
       ctypesProtos = {}
 
-      stream.write( '\ndef decorateFunctions( lib ):\n' )
+      out = io.StringIO()
+      out.write( '\ndef decorateFunctions( lib ):\n' )
 
       for _, die in sorted( self.functions.items() ):
          if not die:
             continue
          t = self.dieToType( die )
-         t.writeLibUpdates( 3, stream )
-         ctypesProtos[ t.pyName() ] = t.ctype()
+         t.writeLibUpdates( 3, out )
+         ctypesProtos[ t.pyName() ] = t.signature()
 
-      stream.write( '   pass\n' )
+      out.write( '   pass\n' )
+      emit( out.getvalue() )
 
       if ctypesProtos:
-         stream.write( "\nfunctionTypes = {\n" )
-         for funcName, proto in sorted( ctypesProtos.items() ):
-            stream.write( f"   '{funcName}': {proto},\n" )
-         stream.write( "}" )
-
-      stream.write( '\n\n' )
+         out = io.StringIO()
+         out.write( "\n" )
+         names = { funcName : self.functionTypeName( proto, out )
+                   for funcName, proto in sorted( ctypesProtos.items() ) }
+         out.write( "functionTypes = {\n" )
+         for funcName, name in names.items():
+            out.write( f"   '{funcName}': {name},\n" )
+         out.write( "}\n" )
+         emit( out.getvalue() )
 
 class Hint:
    ''' Hints indicate some modification to a field in a struct/union
@@ -1711,7 +2311,7 @@ class PythonType:
    def __hash__( self ):
       return hash( self.cName )
 
-def getlib( libname ):
+def libraryPath( libname ):
    if not os.path.exists( libname ):
       # If the file doesn't exist, try and load the library with CDLL/dlopen
       # And use the structure of the link map to work out the path to the file.
@@ -1723,7 +2323,10 @@ def getlib( libname ):
       lib = ctypes.CDLL( libname )
       handle = lib._handle # pylint: disable=protected-access
       libname = ctypes.cast( handle, ctypes.POINTER( LinkMap ) )[ 0 ].name
-   return libCTypeGen.open( libname )
+   return libname
+
+def getlib( libname ):
+   return libCTypeGen.open( libraryPath( libname ) )
 
 def getDwarves( libnames ):
    # Allow libnames to be a single string, or list thereof.
@@ -1736,7 +2339,10 @@ def getDwarves( libnames ):
 
 def generate( libnames, outname, types, functions, header=None, modname=None,
       existingTypes=None, errorfunc=None, globalVars=None, deepInspect=False,
-      namelessEnums=False, namespaceFilter=None, macroFiles=None, trailer=None ):
+      namelessEnums=False, namespaceFilter=None, macroFiles=None, trailer=None,
+      lazy=False, split=None, layoutSidecar=False,
+      lazyPrototypes=False, shareTypes=False, validate=True,
+      validationCache=None ):
    '''  External interface to generate code from a set of binaries, into a python
    module.
    Parameters:
@@ -1756,6 +2362,41 @@ def generate( libnames, outname, types, functions, header=None, modname=None,
          before attempting to render new copies of them. Eg, when generating
          GatedBgpCTypes, we pass GatedBgpTypes first, so the same type instances
          are used in both for the basic gated types.
+      macroFiles: the source files whose macros should be rendered into the
+         module. This can be a filename, a list of filenames or glob
+         patterns, or a callable that accepts a filename. Lists and patterns
+         are filtered natively, which is much faster than the callable.
+      lazy: generate a module that defines each type, and anything else that
+         needs the types, only when it is first accessed, via the module's
+         __getattr__. This makes importing a large module much cheaper.
+      split: generate a package rather than a single module. If "namespace",
+         the types in each C++ namespace are put in their own submodule. If
+         "header", the types declared in each source file are. The package
+         imports the submodules as their names are used, and the submodules
+         import from each other in the same way. "outname" is the directory
+         to create the package in. Implies "lazy".
+      layoutSidecar: write the layouts of structs and unions to a binary file
+         alongside the generated python (with the extension ".layout"). The
+         module builds the classes from the file, which is much faster than
+         compiling and executing the equivalent python.
+      lazyPrototypes: rather than setting the restype and argtypes of every
+         function in the library when it is loaded, decoratedLib returns a
+         CDLL that sets them for each function when it is first accessed,
+         from a table of prototypes. functionTypes creates each function's
+         CFUNCTYPE as it is used, too.
+      shareTypes: register the structs, unions and enums the module creates
+         in a process-wide registry, keyed by the build ID or soname of the
+         library that describes them. Other modules generated with shareTypes
+         use the registered classes rather than creating their own, so
+         independently generated modules can exchange objects and pointers.
+         The modules must agree on any hints applied to the shared types.
+      validate: check the layouts of the module's classes against the DWARF
+         once it is generated. If False, the check is skipped: call
+         CTypeGenRun.test_classes( None, modname ) to do it later. That
+         materializes a lazy module, to check all its classes.
+      validationCache: a file of the layout hashes of classes that have
+         already passed validation. Classes with a known good layout are not
+         checked again, and the hashes of newly checked ones are added.
    '''
 
    dwarves = getDwarves( libnames )
@@ -1767,11 +2408,16 @@ def generate( libnames, outname, types, functions, header=None, modname=None,
    return generateDwarf( dwarves,
                          outname, types, functions, header, modname, existingTypes,
                          errorfunc, globalVars, deepInspect, namelessEnums,
-                         namespaceFilter, macroFiles, trailer )
+                         namespaceFilter, macroFiles, trailer, lazy=lazy,
+                         split=split, layoutSidecar=layoutSidecar,
+                         lazyPrototypes=lazyPrototypes, shareTypes=shareTypes,
+                         validate=validate, validationCache=validationCache )
 
 def generateAll( libs, outname, modname=None, macroFiles=None, trailer=None,
       namelessEnums=False, existingTypes=None, skipTypes=None,
-      namespaceFilter=None ):
+      namespaceFilter=None, lazy=False, split=None, layoutSidecar=False,
+      lazyPrototypes=False, shareTypes=False, validate=True,
+      validationCache=None ):
    ''' Simplified "generate" that will generate code for all types, functions,
    and variables in a library '''
    dwarves = getDwarves( libs )
@@ -1795,16 +2441,59 @@ def generateAll( libs, outname, modname=None, macroFiles=None, trailer=None,
          trailer=trailer,
          namelessEnums=namelessEnums,
          existingTypes=existingTypes,
-         namespaceFilter=namespaceFilter )
+         namespaceFilter=namespaceFilter,
+         lazy=lazy,
+         split=split,
+         layoutSidecar=layoutSidecar,
+         lazyPrototypes=lazyPrototypes,
+         shareTypes=shareTypes,
+         validate=validate,
+         validationCache=validationCache )
+
+def macroLiteral( value ):
+   ''' Return the python literal for the evaluated value of a macro, or None
+   if it has no literal representation. '''
+   if value is None or isinstance( value, ( bool, int, str, bytes ) ):
+      return repr( value )
+   if isinstance( value, float ):
+      return repr( value ) if math.isfinite( value ) else f"float( '{value}' )"
+   return None
 
 class MacroCallback:
-   def __init__( self, output, interested, resolver ):
+   ''' Convert macros to python. Object-like macros are evaluated while
+   generating, and rendered as literals. Function-like macros are
+   rendered as lazy definitions, so the generated module does not pay the
+   cost of defining them until they are used. "namespace" is the result of
+   executing the python generated for the types in the module, and is used to
+   evaluate the macros. '''
+
+   def __init__( self, output, interested, resolver, namespace ):
       self.filescope = []
-      self.interested = interested if callable( interested ) \
-                        else lambda f : f in interested
+      if callable( interested ):
+         self.patterns = None
+         self.interested = interested
+      else:
+         # A single filename, or a list of filenames or glob patterns.
+         self.patterns = [ interested ] if isinstance( interested, str ) \
+                         else list( interested )
+         self.interested = lambda f : any(
+               fnmatch.fnmatchcase( f, pattern ) or
+               fnmatch.fnmatchcase( os.path.basename( f ), pattern )
+               for pattern in self.patterns )
       self.defining = 0
       self.output = output
       self.resolver = resolver
+      self.namespace = namespace
+      self.failed = []
+      # Names of macros that are defined lazily.
+      self.lazyNames = set()
+      # Names that can appear in casts and sizeof expressions.
+      self.typenames = frozenset( name for name in resolver.defined
+                                  if isinstance( namespace.get( name ), type ) )
+      # ( file, name, args, body ) for each macro we've already dealt with.
+      # The same header is seen in many units, and we only need to process
+      # each distinct definition once.
+      self.seen = set()
 
    def define ( self, line, data ):
       if not self.defining:
@@ -1839,45 +2528,105 @@ class MacroCallback:
          name = data[ 0:firstSpace ]
          value = data[ firstSpace + 1: ]
 
+      self.macro( self.filescope[ -1 ][ 1 ], line, name, macroArgs, value )
+
+   def macro( self, filename, line, name, macroArgs, value ):
+      ''' Render a single macro definition. This is called from "define" above
+      when walking the macros with callbacks, or directly with the tuples
+      returned by unit.definedMacros '''
+
+      if macroArgs is not None:
+         # Arguments we can't name in python (eg, varargs) make the macro
+         # unusable
+         if not all( isinstance( arg, str ) and arg.isidentifier() and
+                     not keyword.iskeyword( arg ) for arg in macroArgs ):
+            return
+         argStr = f"({', '.join( macroArgs )})"
+         macroArgs = tuple( macroArgs )
+
+      key = ( filename, name, macroArgs, value )
+      if key in self.seen:
+         return
+      self.seen.add( key )
+
       if name in self.resolver.defined:
          return
 
       # If a previous module has defined the macro, avoid the duplication.
-      if any( name in other.__dict__ for other in self.resolver.existingTypes ):
+      if any( name in other.__dict__ or name in getattr( other, "CTYPEGEN_lazy", () )
+              for other in self.resolver.existingTypes ):
+         return
+
+      # Don't let a macro hide anything else in the module, including the names
+      # it imports from ctypes and CTypeGenRun.
+      if name in self.namespace:
          return
 
       if value == "":
-         value = "None"
+         text, names = "None", ()
       else:
-         newvalue, names = CTypeGen.expression.clean( value )
-         if newvalue is None:
+         text, names = CTypeGen.expression.clean( value, self.typenames )
+         if text is None:
             return
-         value = newvalue
-         if name == value:
+         if name == text:
             return
          for n in names:
             if not ( n in self.resolver.defined or macroArgs and n in macroArgs ):
+               # This may resolve if we see the definition again after the
+               # names it depends on are defined, so don't remember it.
+               self.seen.discard( key )
                return
 
       self.resolver.defined.add( name )
+      location = f"{filename}:{line}"
+      # If the types are lazily defined, anything that uses them must be too.
+      lazy = any( n in self.lazyNames for n in names ) or \
+            self.resolver.lazy and names
+
+      if macroArgs is not None:
+         # Function-like macros are defined lazily in the generated module,
+         # when they are first accessed. We still need the function here, so
+         # other macros can be evaluated with it.
+         source = f"def {name}{argStr}: return {text}"
+         exec( source, self.namespace ) # pylint: disable=exec-used
+         self.lazyNames.add( name )
+         self.resolver.lazyChunks.add( source + "\n", location )
+         return
 
-      # some macros may not be evaluatable. For example, casts look like
+      # Evaluate object-like macros now, so we can render them as literals.
+      # Some macros may not be evaluatable. For example, casts look like
       # expressions: we have:
       #
       # #define SIG_ERR ((sighandler_t) -1 )
       #
-      # If sighandler_t is an int, then this is an arithmentic expression. If
-      # its a type, then its a type cast. We don't discriminate when parsing
-      # the AST so wrap macros in try/catch
-      self.output.write("try:\n")
-      if macroArgs is not None:
-         self.output.write( f"   def {name}{argStr}: return {value}" )
-      else:
-         self.output.write( f"   {name} = {value}" )
-      self.output.write( f" # {self.filescope[ -1 ][ 1 ]}:{line}\n" )
-      self.output.write( "except:\n" )
-      self.output.write( f"   __ctypegen_failed_macros.append('{name}')\n" )
+      # If sighandler_t is a type, we convert it to a CAST, but if we can't
+      # find the type, it looks like an arithmetic expression with an
+      # undefined name.
+      try:
+         result = eval( text, self.namespace ) # pylint: disable=eval-used
+      except Exception: # pylint: disable=broad-except
+         self.failed.append( name )
+         return
+      self.namespace[ name ] = result
+
+      literal = macroLiteral( result )
+      if literal is None:
+         # Not something we can render as a literal, like a pointer or a type.
+         # Render the expression itself - its deterministic, and we know it
+         # works.
+         if lazy:
+            self.lazyNames.add( name )
+            self.resolver.lazyChunks.add( f"{name} = {text}\n", location )
+            return
+         literal = text
+      if value and literal != value:
+         location = f"{location}: {value}"
+      self.output.write( f"{name} = {literal} # {location}\n" )
 
+   def write( self ):
+      ''' Write out the failed macros. The lazy definitions are written with
+      the resolver's other lazy chunks. '''
+      self.output.write( f"__ctypegen_failed_macros = {self.failed!r}\n" )
 
    def undef( self, line, data ):
       pass
@@ -1892,16 +2641,95 @@ class MacroCallback:
       if self.interested( filename ):
          self.defining -= 1
 
+   def visit( self, binaries ):
+      ''' Render the macros from all units in the binaries. If our filter is a
+      callable, we need to walk each unit's macros via callbacks. Otherwise, the
+      filter is a filename or a list of filenames or glob patterns, and we can
+      let libCTypeGen do the filtering for us, and just give us the
+      definitions we are interested in. '''
+      if self.patterns is None:
+         for binary in binaries:
+            for unit in binary.units():
+               unit.macros( self )
+      elif self.patterns:
+         for binary in binaries:
+            for unit in binary.units():
+               for macro in unit.definedMacros( self.patterns ):
+                  self.macro( *macro )
+
+def submodulePartition( split ):
+   ''' Return a function that maps a Type to the name of the submodule of a
+   split package it belongs in, or None if it belongs in the package itself.
+   "split" is "namespace" for a submodule per C++ namespace, or "header" for a
+   submodule per source file. Types in the global namespace, or with no
+   source file, belong in the package. '''
+
+   submodules = {} # namespace or filename -> submodule name
+
+   def submoduleName( key, name ):
+      if key not in submodules:
+         name = re.sub( r"\W", "_", name )
+         if not name or name[ 0 ].isdigit() or keyword.iskeyword( name ):
+            name = "_" + name
+         candidate = name
+         suffix = 1
+         while candidate in submodules.values():
+            suffix += 1
+            candidate = f"{name}_{suffix}"
+         submodules[ key ] = candidate
+      return submodules[ key ]
+
+   def partition( typ ):
+      if typ is None or typ.die is None:
+         return None
+      if split == "header":
+         filename = typ.die.DW_AT_decl_file
+         if filename is None:
+            return None
+         return submoduleName( filename,
+               os.path.splitext( os.path.basename( filename ) )[ 0 ] )
+      namespaces = []
+      die = typ.die.parent()
+      while die is not None:
+         if die.tag() == tags.DW_TAG_namespace:
+            namespaces.append( die.name() )
+         die = die.parent()
+      if not namespaces:
+         return None
+      namespaces = tuple( reversed( namespaces ) )
+      return submoduleName( namespaces, "_".join( namespaces ) )
+
+   assert split in ( "namespace", "header" ), f"cannot split by {split}"
+   return partition
+
 def generateDwarf( binaries, outname, types, functions, header=None, modname=None,
       existingTypes=None, errorfunc=None, globalVars=None, deepInspect=False,
       namelessEnums=False,
       namespaceFilter=None,
       macroFiles=None,
-      trailer=None ):
+      trailer=None,
+      lazy=False,
+      split=None,
+      layoutSidecar=False,
+      lazyPrototypes=False,
+      shareTypes=False,
+      validate=True,
+      validationCache=None ):
 
    resolver = TypeResolver( binaries, types, functions, existingTypes, errorfunc,
          globalVars, deepInspect, namelessEnums, namespaceFilter )
-   with open( outname, 'w' ) as content:
+   resolver.shareTypes = shareTypes
+   if modname is None:
+      modname = outname.split( "." )[ 0 ]
+   if split is not None:
+      # A package is always lazy - that's how it avoids importing submodules
+      # that are not used.
+      lazy = True
+      os.makedirs( outname, exist_ok=True )
+      filename = os.path.join( outname, "__init__.py" )
+   else:
+      filename = outname
+   with open( filename, 'w' ) as content:
 
       stack = inspect.stack()
       frame = stack[ 1 ]
@@ -1912,15 +2740,28 @@ def generateDwarf( binaries, outname, types, functions, header=None, modname=Non
       content.write( warning )
       if header is not None:
          content.write( header )
-      resolver.write( content )
-
-      content.write( "__ctypegen_failed_macros = []\n" )
-      content.write( "# Macro definitions:\n" )
+      types = io.StringIO()
+      resolver.write( types, lazy,
+            os.path.splitext( filename )[ 0 ] + ".layout" if layoutSidecar else None,
+            lazyPrototypes )
+      content.write( types.getvalue() )
+
+      # We evaluate macros in the context of the types we've generated, so
+      # we can deal with casts and sizeof.
+      namespace = { "__name__" : modname, "__file__" : filename }
       if macroFiles is not None:
-         macros = MacroCallback( content, macroFiles, resolver )
-         for binary in binaries:
-            for unit in binary.units():
-               unit.macros( macros )
+         # pylint: disable=exec-used
+         exec( compile( ( header or "" ) + types.getvalue(), filename, "exec" ),
+               namespace )
+         if lazy:
+            chunks, names, _ = resolver.lazyChunks.resolve()[ None ]
+            CTypeGenRun.LazyDefinitions( namespace,
+                  [ ( source, deps ) for source, deps, _ in chunks ],
+                  names ).materializeAll()
+      macros = MacroCallback( content, macroFiles or [], resolver, namespace )
+      content.write( "# Macro definitions:\n" )
+      macros.visit( binaries )
+      macros.write()
       content.write( "# (end Macro definitions)\n\n" )
 
 
@@ -1929,15 +2770,53 @@ def generateDwarf( binaries, outname, types, functions, header=None, modname=Non
          content.write("\t'%s',\n" % b.soname())
       content.write("]\n")
 
-      content.write("""
+      if lazyPrototypes:
+         decoratedLib = """
+# Use this to return a CDLL handle that has functions decorate with type info.
+# Each function is decorated when it is first accessed.
+def decoratedLib( idx = 0 ):
+      return DecoratedCDLL( CTYPEGEN_SONAMES[ idx ], CTYPEGEN_prototypes )
+"""
+      else:
+         decoratedLib = """
 # Use this to return a CDLL handle that has functions decorate with type info.
 def decoratedLib( idx = 0 ):
       lib = ctypes.CDLL( CTYPEGEN_SONAMES[ idx ] )
       if lib:
          decorateFunctions( lib )
       return lib
+"""
+      # decoratedLib uses decorateFunctions as a global, so it must be lazy
+      # too if decorateFunctions is.
+      if lazy:
+         resolver.lazyChunks.add( decoratedLib )
+      else:
+         content.write( decoratedLib )
+      content.write( "\n" )
+
+      tables = resolver.lazyChunks.resolve(
+            submodulePartition( split ) if split is not None else None )
+
+      def writeTable( stream, module ):
+         chunks, names, imports = tables.get( module, ( [], {}, {} ) )
+         LazyChunks.write( stream, chunks, names,
+               { name : modname if other is None else f"{modname}.{other}"
+                 for name, other in imports.items() } )
 
-""")
+      writeTable( content, None )
+      content.write( "\n" )
+
+      for module in sorted( tables, key=str ):
+         if module is None:
+            continue
+         with open( os.path.join( outname, f"{module}.py" ), 'w' ) as submodule:
+            submodule.write( warning )
+            if header is not None:
+               submodule.write( header )
+            submodule.write( types.getvalue() )
+            writeTable( submodule, module )
+            submodule.write( "__all__ = [ name for name in CTYPEGEN_lazy.dir() "
+                             "if not name.startswith( '_' ) ]\n" )
 
       content.write( "CTYPEGEN_producers__ = {\n" )
       for p in sorted( resolver.producers ):
@@ -1945,19 +2824,462 @@ def decoratedLib( idx = 0 ):
          content.write( "\t\"%s\",\n" % p )
       content.write( "}\n" )
 
+      # Names that have not been materialized are not yet in the module's
+      # dictionary, so give "import *" the full list.
+      if lazy:
+         content.write( "__all__ = [ name for name in CTYPEGEN_lazy.dir() "
+                        "if not name.startswith( '_' ) ]\n" )
+
       # Make the whole shebang test itself when run.
       content.write( '\nif __name__ == "__main__":\n' )
+      content.write( '   CTYPEGEN_lazy.materializeAll()\n' )
       content.write( '   test_classes( __ctypegen_failed_macros )\n' )
 
       if trailer is not None:
          content.write( trailer )
 
-   if modname is None:
-      modname = outname.split( "." )[ 0 ]
-   mod = imp.load_source( modname, outname )
+   if split is not None:
+      spec = importlib.util.spec_from_file_location( modname, filename,
+            submodule_search_locations=[ outname ] )
+      mod = importlib.util.module_from_spec( spec )
+      sys.modules[ modname ] = mod
+      spec.loader.exec_module( mod )
+   else:
+      mod = imp.load_source( modname, outname )
+   resolver.pkgname = modname
+   if not validate:
+      sys.stderr.write( "generated %s\n" % modname )
+      return ( mod, resolver )
+   mod.CTYPEGEN_lazy.materializeAll()
+   cache = None
+   if validationCache is not None:
+      cache = CTypeGenRun.ValidationCache( validationCache )
+   # Only check this module's classes, not those of every module generated
+   # in this process.
    # pylint: disable=protected-access
-   mod.test_classes( mod.__ctypegen_failed_macros )
+   mod.test_classes( mod.__ctypegen_failed_macros, modname, cache )
    # pylint: enable=protected-access
-   resolver.pkgname = modname
+   if cache is not None:
+      cache.save()
    sys.stderr.write( "generated and tested %s\n" % modname )
    return ( mod, resolver )
+
+class TypeLibrary:
+   ''' Builds ctypes classes for types in a set of libraries on demand,
+   directly from their DWARF, without writing or importing a module. Eg:
+
+      foo = TypeLibrary( "libfoo.so" ).struct( "ns::Foo" )
+
+   The types a class depends on are built along with it, and the classes for
+   the same types are shared between lookups, so objects can be exchanged
+   between them. The most recent "maxsize" lookups are cached. Once as many
+   lookups again have been evicted, we start afresh, so the classes nobody
+   refers to any more can be freed: classes returned after that are distinct
+   from those returned before. '''
+
+   structTags = ( tags.DW_TAG_structure_type, tags.DW_TAG_class_type )
+
+   def __init__( self, libnames, maxsize=128, errorfunc=None ):
+      self.dwarves = getDwarves( libnames )
+      self.maxsize = maxsize
+      self.errorfunc = errorfunc
+      self.cache = OrderedDict()
+      self.clear()
+
+   def clear( self ):
+      ''' Forget all the classes we have built '''
+      self.resolver = TypeResolver( self.dwarves, [], None, None, self.errorfunc,
+            None, False, False, None )
+      self.namespace = { "__name__" : f"{__name__}.TypeLibrary" }
+      prelude = "from ctypes import *\nfrom CTypeGenRun import *\n"
+      exec( prelude, self.namespace ) # pylint: disable=exec-used
+      self.cache.clear()
+      self.evicted = 0
+
+   def struct( self, name ):
+      return self.lookup( name, self.structTags )
+
+   def union( self, name ):
+      return self.lookup( name, ( tags.DW_TAG_union_type, ) )
+
+   def enum( self, name ):
+      return self.lookup( name, ( tags.DW_TAG_enumeration_type, ) )
+
+   def typedef( self, name ):
+      return self.lookup( name, ( tags.DW_TAG_typedef, ) )
+
+   def type( self, name ):
+      ''' Return the class for a struct, union, enum or typedef '''
+      return self.lookup( name, TypeResolver.typeDieTags )
+
+   def lookup( self, name, dieTags ):
+      ''' Return the class for the type called "name", with one of "dieTags" '''
+      key = ( name, dieTags )
+      cls = self.cache.get( key )
+      if cls is not None:
+         self.cache.move_to_end( key )
+         return cls
+
+      die = self.find( tuple( name.split( "::" ) ), dieTags )
+      if die is None:
+         raise KeyError( f"no type {name} found" )
+      cls = self.build( self.resolver.dieToType( die ) )
+
+      self.cache[ key ] = cls
+      if len( self.cache ) > self.maxsize:
+         self.cache.popitem( last=False )
+         self.evicted += 1
+         if self.evicted >= self.maxsize:
+            self.clear()
+      return cls
+
+   def build( self, typ ):
+      ''' Execute the python for "typ", and anything it depends on, and
+      return its class '''
+      out = io.StringIO()
+      self.resolver.declareType( typ, out )
+      self.resolver.defineType( typ, out )
+      exec( out.getvalue(), self.namespace ) # pylint: disable=exec-used
+      return eval( typ.ctype(), self.namespace ) # pylint: disable=eval-used
+
+   def find( self, path, dieTags ):
+      ''' Find the DIE for the type with the scoped name "path". We prefer a
+      definition, but settle for a declaration if that's all there is. '''
+      declaration = None
+      for dwarf in self.dwarves:
+         for unit in dwarf.units():
+            die = self.findIn( unit.root(), path, dieTags )
+            if die is not None:
+               if not die.DW_AT_declaration:
+                  return die
+               declaration = declaration or die
+      return declaration
+
+   def findIn( self, scope, path, dieTags ):
+      declaration = None
+      for child in scope:
+         if child.DW_AT_name != path[ 0 ]:
+            continue
+         tag = child.tag()
+         if len( path ) == 1:
+            if tag in dieTags:
+               if not child.DW_AT_declaration:
+                  return child
+               declaration = declaration or child
+         elif tag in TypeResolver.namespaceDieTags:
+            die = self.findIn( child, path[ 1: ], dieTags )
+            if die is not None:
+               if not die.DW_AT_declaration:
+                  return die
+               declaration = declaration or die
+      return declaration
+
+def readBuildId( path ):
+   ''' Return the GNU build ID of the ELF object at "path" as a hex string, or
+   None if it does not have one. We read the notes directly, rather than
+   with libCTypeGen, so we don't have to load any debug information. '''
+   with open( path, "rb" ) as f:
+      ident = f.read( 64 )
+      if len( ident ) < 52 or ident[ : 4 ] != b"\x7fELF":
+         return None
+      order = "<" if ident[ 5 ] == 1 else ">"
+      if ident[ 4 ] == 2: # ELFCLASS64
+         phoff, = struct.unpack_from( order + "Q", ident, 0x20 )
+         phentsize, phnum = struct.unpack_from( order + "HH", ident, 0x36 )
+         phdr = order + "I4xQ8x8xQ8xQ" # type, offset, filesz, align
+      else:
+         phoff, = struct.unpack_from( order + "I", ident, 0x1c )
+         phentsize, phnum = struct.unpack_from( order + "HH", ident, 0x2a )
+         phdr = order + "II4x4xI4x4xI"
+      for i in range( phnum ):
+         f.seek( phoff + i * phentsize )
+         ptype, offset, filesz, align = struct.unpack(
+               phdr, f.read( struct.calcsize( phdr ) ) )
+         if ptype != 4: # PT_NOTE
+            continue
+         align = 8 if align == 8 else 4
+         f.seek( offset )
+         notes = f.read( filesz )
+         pos = 0
+         while pos + 12 <= len( notes ):
+            namesz, descsz, ntype = struct.unpack_from( order + "III", notes, pos )
+            pos += 12
+            name = notes[ pos : pos + namesz ]
+            pos += ( namesz + align - 1 ) & -align
+            if ntype == 3 and name == b"GNU\0": # NT_GNU_BUILD_ID
+               return notes[ pos : pos + descsz ].hex()
+            pos += ( descsz + align - 1 ) & -align
+   return None
+
+class CoreFile( CTypeGenRun.RemoteMemory ):
+   ''' Reads the objects of a crashed process out of its core file.
+   Memory the core does not include, such as the text and read-only data of
+   the libraries, is read from the files that were mapped there, as listed in
+   the core's NT_FILE note. Those files also provide the symbols of global
+   variables. "sysroot" is prefixed to the paths of the mapped files, to find
+   the libraries of a core from another machine. The core and the mapped
+   libraries are read with libCTypeGen, like any other ELF object. Eg:
+
+      core = CoreFile( "core.1234" )
+      table = core.readGlobal( libfoo.Table, "fooTable", "libfoo.so" )
+      entry = core.follow( table.first ) '''
+
+   NT_FILE = 0x46494c45
+   PT_LOAD = 1
+
+   def __init__( self, path, sysroot="" ):
+      super().__init__()
+      self.sysroot = sysroot
+      self.mappings = [] # sorted ( start, end, file offset, path )
+      self.elves = {}
+      self.fds = {}
+      try:
+         self.core = libCTypeGen.open( path )
+      except RuntimeError as ex:
+         raise ValueError( f"{path} is not an ELF core file: {ex}" ) from None
+      # sorted ( vaddr, memsz, offset, filesz )
+      self.loads = sorted( ( vaddr, memsz, offset, filesz )
+            for _, offset, vaddr, filesz, memsz, _
+            in self.core.segments( self.PT_LOAD ) )
+      # The NT_FILE note is made of words of the core's class and byte order.
+      ident = self.core.read( 0, 6 )
+      order = "<" if ident[ 5 ] == 1 else ">"
+      word = "Q" if ident[ 4 ] == 2 else "I" # ELFCLASS64
+      for name, ntype, desc in self.core.notes():
+         if ntype == self.NT_FILE and name.rstrip( "\0" ) == "CORE":
+            self.mappings = self.fileMappings( order, word, desc )
+
+   @staticmethod
+   def fileMappings( order, word, desc ):
+      ''' Return the ( start, end, file offset, path ) tuples in an NT_FILE
+      note '''
+      count, pageSize = struct.unpack_from( order + word * 2, desc )
+      size = struct.calcsize( order + word )
+      ranges = struct.unpack_from( order + word * ( 3 * count ), desc, 2 * size )
+      names = desc[ ( 2 + 3 * count ) * size : ].split( b"\0" )
+      return sorted( ( ranges[ i * 3 ], ranges[ i * 3 + 1 ],
+                       ranges[ i * 3 + 2 ] * pageSize, os.fsdecode( names[ i ] ) )
+                     for i in range( count ) )
+
+   def close( self ):
+      for fd in self.fds.values():
+         if fd is not None:
+            os.close( fd )
+      self.fds.clear()
+      self.elves.clear()
+      if self.core is not None:
+         self.core.flush()
+         self.core = None
+
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, *args ):
+      self.close()
+
+   @staticmethod
+   def find( table, address ):
+      ''' Return the entry of "table", a sorted list of tuples starting with
+      their start address, whose start is closest below "address" '''
+      idx = bisect.bisect_right( table, ( address, float( "inf" ) ) ) - 1
+      return table[ idx ] if idx >= 0 else None
+
+   def mappedFile( self, path ):
+      if path not in self.fds:
+         try:
+            self.fds[ path ] = os.open( self.sysroot + path, os.O_RDONLY )
+         except OSError:
+            self.fds[ path ] = None
+      return self.fds[ path ]
+
+   def readPage( self, address ):
+      ''' Return the page at "address", or None if the process had nothing
+      there that we can find '''
+      pageSize = self.pageSize
+      load = self.find( self.loads, address )
+      if load is not None:
+         vaddr, memsz, offset, filesz = load
+         if address < vaddr + memsz and address - vaddr < filesz:
+            data = self.core.read( offset + address - vaddr,
+                                   min( pageSize, filesz - ( address - vaddr ) ) )
+            return data.ljust( pageSize, b"\0" )
+      mapping = self.find( self.mappings, address )
+      if mapping is not None and address < mapping[ 1 ]:
+         fd = self.mappedFile( mapping[ 3 ] )
+         if fd is not None:
+            data = os.pread( fd, pageSize, mapping[ 2 ] + address - mapping[ 0 ] )
+            return data.ljust( pageSize, b"\0" )
+      if load is not None and address < load[ 0 ] + load[ 1 ]:
+         return bytes( pageSize ) # not dumped, because it was all zeroes.
+      return None
+
+   def fetch( self, ranges ):
+      results = []
+      for address, size in ranges:
+         pages = []
+         for page in range( address, address + size, self.pageSize ):
+            data = self.readPage( page )
+            if data is None:
+               break
+            pages.append( data )
+         results.append( b"".join( pages ) )
+      return results
+
+   def loadAddress( self, path ):
+      ''' Return the address the object "path" was loaded at: the amount to
+      add to the addresses in its symbol table. '''
+      path = self.resolvePath( path )
+      starts = [ start for start, _, offset, mapped in self.mappings
+                 if offset == 0 and mapped == path ]
+      if not starts:
+         raise KeyError( f"{path} is not mapped in the core" )
+      segments = libCTypeGen.open( self.sysroot + path ).segments( self.PT_LOAD )
+      vaddr = min( vaddr for _, _, vaddr, _, _, _ in segments )
+      pageSize = self.pageSize
+      return min( starts ) - ( vaddr & -pageSize )
+
+   def resolvePath( self, path ):
+      ''' Return the full path of the mapped object "path" '''
+      for _, _, _, mapped in self.mappings:
+         if mapped == path or os.path.basename( mapped ) == path:
+            return mapped
+      raise KeyError( f"{path} is not mapped in the core" )
+
+   def symbol( self, name, path ):
+      ''' Return the address of the dynamic symbol "name" of the mapped
+      object "path", which may be given by its full path or its basename '''
+      path = self.resolvePath( path )
+      if path not in self.elves:
+         self.elves[ path ] = ( libCTypeGen.open( self.sysroot + path ),
+                                self.loadAddress( path ) )
+      elf, base = self.elves[ path ]
+      value = elf.symbol( name )
+      if value is None:
+         raise KeyError( f"no symbol {name} in {path}" )
+      return base + value
+
+   def readGlobal( self, ctype, name, path ):
+      ''' Return a copy of the global variable "name", of type "ctype",
+      defined in the mapped object "path" '''
+      return self.readType( ctype, self.symbol( name, path ) )
+
+def defaultCacheDir():
+   cache = os.environ.get( "CTYPEGEN_CACHE" )
+   if cache:
+      return cache
+   return os.path.join( os.environ.get( "XDG_CACHE_HOME" ) or
+                        os.path.expanduser( "~/.cache" ), "ctypegen" )
+
+@functools.lru_cache( maxsize=None )
+def generatorHash():
+   ''' A digest of the generator's source, the runtime support generated
+   modules use, and the extension that reads DWARF for us, so a new version
+   of CTypeGen doesn't use modules cached by an old one. '''
+   digest = hashlib.sha256()
+   for source in ( __file__, CTypeGen.expression.__file__, CTypeGenRun.__file__,
+                   libCTypeGen.__file__ ):
+      with open( source, "rb" ) as f:
+         digest.update( f.read() )
+   return digest.hexdigest()
+
+class AutoImporter( importlib.abc.MetaPathFinder, importlib.abc.Loader ):
+   ''' An import hook that generates a module for a library, with
+   generateAll, when it is first imported as a submodule of "package".
+   "modules" maps module names to the library to generate each from, or to a
+   dict of arguments for generateAll, which must include "libs". Other
+   module names are taken as the name of the library, with ".so" appended.
+   "options" are passed to generateAll for every module.
+
+   Generated modules are stored in "cacheDir", in a directory named for a
+   digest of the build ID of the library (or its path, size and modification
+   time, if it has no build ID), the arguments, and the version of CTypeGen.
+   Later imports load the module from the cache without reading any DWARF.
+   Arguments must have a stable repr to be cached usefully. '''
+
+   def __init__( self, modules=None, cacheDir=None, package="ctypegen_auto",
+         **options ):
+      self.modules = modules or {}
+      self.cacheDir = cacheDir or defaultCacheDir()
+      self.package = package
+      self.options = options
+
+   def arguments( self, name ):
+      args = dict( self.options )
+      config = self.modules.get( name, f"{name}.so" )
+      if isinstance( config, dict ):
+         args.update( config )
+      else:
+         args[ "libs" ] = config
+      return args
+
+   def cacheKey( self, args ):
+      libs = args[ "libs" ]
+      identities = []
+      for lib in [ libs ] if isinstance( libs, str ) else libs:
+         path = libraryPath( lib )
+         buildId = readBuildId( path )
+         if buildId is None:
+            stat = os.stat( path )
+            buildId = ( os.path.realpath( path ), stat.st_size, stat.st_mtime_ns )
+         identities.append( buildId )
+      options = sorted( ( k, v ) for k, v in args.items() if k != "libs" )
+      text = repr( ( identities, options, generatorHash() ) )
+      return hashlib.sha256( text.encode() ).hexdigest()[ : 32 ]
+
+   def generate( self, fullname, name, args, directory ):
+      ''' Generate the module into a new directory, and move it into place
+      in the cache '''
+      os.makedirs( self.cacheDir, exist_ok=True )
+      tmp = tempfile.mkdtemp( prefix=".tmp-", dir=self.cacheDir )
+      try:
+         generateAll( outname=os.path.join( tmp, name if args.get( "split" )
+                                            else f"{name}.py" ),
+                      modname=fullname, **args )
+         try:
+            os.rename( tmp, directory )
+         except OSError:
+            # Someone else generated it at the same time, and got there first.
+            if not os.path.isdir( directory ):
+               raise
+      finally:
+         if os.path.isdir( tmp ):
+            shutil.rmtree( tmp, ignore_errors=True )
+      # Generating the module loaded it from its temporary location: forget
+      # about that, so the import system loads it from the cache.
+      for loaded in list( sys.modules ):
+         if loaded == fullname or loaded.startswith( fullname + "." ):
+            del sys.modules[ loaded ]
+
+   def find_spec( self, fullname, path, target=None ):
+      if fullname == self.package:
+         return importlib.machinery.ModuleSpec( fullname, self, is_package=True )
+      prefix, _, name = fullname.partition( "." )
+      if prefix != self.package or not name or "." in name:
+         # Submodules of split packages are found through their package's path
+         return None
+      args = self.arguments( name )
+      directory = os.path.join( self.cacheDir, self.cacheKey( args ) )
+      if not os.path.isdir( directory ):
+         self.generate( fullname, name, args, directory )
+      location = os.path.join( directory, name )
+      if os.path.isdir( location ):
+         return importlib.util.spec_from_file_location( fullname,
+               os.path.join( location, "__init__.py" ),
+               submodule_search_locations=[ location ] )
+      return importlib.util.spec_from_file_location( fullname, f"{location}.py" )
+
+   # We are the loader for "package" itself, which is empty.
+   def create_module( self, spec ):
+      return None
+
+   def exec_module( self, module ):
+      pass
+
+def installImportHook( modules=None, cacheDir=None, package="ctypegen_auto",
+      **options ):
+   ''' Install an AutoImporter, so importing "package.name" generates a
+   module for a library on first use. Returns the hook, which can be
+   removed from sys.meta_path to uninstall it. '''
+   hook = AutoImporter( modules, cacheDir, package, **options )
+   sys.meta_path.insert( 0, hook )
+   return hook
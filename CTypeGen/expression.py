@@ -12,121 +12,313 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
-import sys
-import ast
-import token
-import tokenize
-
-PY3 = sys.version_info.major >= 3
-
-# make python2's tokenize.tokenize behave more like python3
-if PY3:
-   TokenInfo = tokenize.TokenInfo # for python2: pylint: disable=no-member
-else:
-   class TokenInfo:
-      def __init__( self, tup ):
-         self.type, self.string, self.start, self.end, self.line = tup
-      def __repr__( self ):
-         return ( "TokenInfo(type=%d (%s), string='%s', start=%s, end=%s, line='%s'"
-               % (self.type, token.tok_name[self.type], self.string, self.start,
-                        self.end, self.line ) )
-
-# Act like readline for a fixed string.
-class Reader:
-   def __init__( self, text ):
-      if PY3 and isinstance( text, str ):
-         self.text = text.encode("utf-8")
+# Convert the bodies of C macros into python expressions. We see tens of
+# thousands of (mostly tiny) macro bodies when generating code for something
+# like libc, so rather than using python's tokenize and ast modules, we have a
+# small lexer for C tokens, and a recursive descent parser for the subset of
+# C expressions that have a python equivalent, that renders the python as it
+# goes.
+
+import functools
+import keyword
+import re
+
+# Token types
+NAME, NUMBER, STRING, OP = range( 4 )
+
+tokenPattern = re.compile( r'''
+     (?P<space>  \s+ )
+   | (?P<hex>    0[xX][0-9a-fA-F]+ [uUlL]* (?![\w.]) )
+   | (?P<bin>    0[bB][01]+ [uUlL]* (?![\w.]) )
+   | (?P<float>  (?: [0-9]+ \. [0-9]* | \. [0-9]+ ) (?: [eE][-+]?[0-9]+ )?
+                 [fFlL]? (?![\w.])
+               | [0-9]+ [eE][-+]?[0-9]+ [fFlL]? (?![\w.]) )
+   | (?P<int>    [0-9]+ [uUlL]* (?![\w.]) )
+   | (?P<char>   L? ' (?: [^'\\\n] | \\ [^\n] )+ ' )
+   | (?P<string> " (?: [^"\\\n] | \\ [^\n] )* " )
+   | (?P<name>   [A-Za-z_][A-Za-z0-9_]* )
+   | (?P<op>     << | >> | <= | >= | == | != | [-+*/%&|^~()<>,] )
+   ''', re.VERBOSE )
+
+# Escape sequences in C character constants, and their values.
+charEscapes = {
+   "n" : 10, "t" : 9, "r" : 13, "a" : 7, "b" : 8, "f" : 12, "v" : 11,
+   "\\" : 92, "'" : 39, '"' : 34, "?" : 63, "e" : 27,
+}
+
+class Unusable( Exception ):
+   ''' Raised when a macro body cannot be converted to python '''
+
+def charValue( text ):
+   ''' Return the value of a C character constant, without its quotes '''
+   if text[ 0 ] != "\\":
+      if len( text ) != 1:
+         raise Unusable() # multi-character constants are implementation defined
+      return ord( text )
+   body = text[ 1: ]
+   if body[ 0 ] in "01234567":
+      if len( body ) > 3 or any( c not in "01234567" for c in body ):
+         raise Unusable()
+      return int( body, 8 )
+   if body[ 0 ] == "x":
+      try:
+         return int( body[ 1: ], 16 )
+      except ValueError:
+         raise Unusable() from None
+   if body not in charEscapes:
+      raise Unusable()
+   return charEscapes[ body ]
+
+def lex( text ):
+   ''' Split text into a list of ( type, python text ) tuples. Numeric
+   suffixes are removed, octal constants are converted to python syntax, and
+   character constants are converted to their integer value. Anything that
+   does not look like part of a usable expression raises Unusable. '''
+   toks = []
+   pos = 0
+   end = len( text )
+   match = tokenPattern.match
+   while pos < end:
+      m = match( text, pos )
+      if m is None:
+         raise Unusable()
+      pos = m.end()
+      kind = m.lastgroup
+      if kind == "space":
+         continue
+      tok = m.group()
+      if kind == "name":
+         toks.append( ( NAME, tok ) )
+      elif kind == "op":
+         toks.append( ( OP, tok ) )
+      elif kind == "int":
+         tok = tok.rstrip( "uUlL" )
+         if len( tok ) > 1 and tok[ 0 ] == "0":
+            if any( c not in "01234567" for c in tok ):
+               raise Unusable()
+            tok = "0o" + tok[ 1: ]
+         toks.append( ( NUMBER, tok ) )
+      elif kind in ( "hex", "bin" ):
+         toks.append( ( NUMBER, tok.rstrip( "uUlL" ) ) )
+      elif kind == "float":
+         toks.append( ( NUMBER, tok.rstrip( "fFlL" ) ) )
+      elif kind == "char":
+         toks.append( ( NUMBER, str( charValue( tok.lstrip( "L" )[ 1 : -1 ] ) ) ) )
       else:
-         self.text = text
-
-   def __call__( self ):
-      if self.text:
-         rv = self.text
-         self.text = None
-         return rv
-      return b""
-
-def getTokens(b):
-   if not PY3:
-      alltoks = []
-      def eat(a, b, c, d, e):
-         alltoks.append(TokenInfo((a, b, c, d, e)))
-      tokenize.tokenize(Reader(b), eat)
-      return alltoks
-   else:
-      return tokenize.tokenize(Reader(b))
-
-def clean( input_ ):
-   ''' If "input_" is a usable expression, convert it into valid python,
-   returning a 2-tuple contining the conversion, and a list of identifiers that
-   are used in the string. Otherwise return ( None, None ) '''
+         toks.append( ( STRING, tok ) )
+   return toks
 
-   # the names of identifiers used in the expression - will return this
-   # to caller.
-   name_list = []
+# C keywords that can make up the name of a primitive type, qualifiers we
+# can ignore in type names, and the prefixes CTypeGen gives tagged types.
+primitiveWords = { "void", "char", "short", "int", "long", "float", "double",
+                   "signed", "unsigned", "_Bool", "bool" }
+qualifiers = { "const", "volatile", "restrict", "__restrict" }
+tagPrefixes = { "struct" : "struct_", "union" : "union_", "enum" : "enum_" }
 
-   # Step one - lexical cleanup.
-   try:
-      kill_suffixes = {  "UL", "U", "ULL", "L", "LL"  }
-      output = ''
-      prev_tok = None
-      for tok in getTokens(input_):
-         # py2 has no ENCODING field; disable lint error. pylint: disable=no-member
-         if tok.type == token.INDENT or PY3 and tok.type == token.ENCODING:
-            continue
-         # pylint: enable=no-member
-
-         if prev_tok:
-            # splice in any whitespace that was skipped over into the output.
-            output += input_[ prev_tok.end[ 1 ] : tok.start[ 1 ] ]
-
-         # If the token for a number ends with "L", remove it.
-         if tok.type == token.NUMBER and tok.string[-1].upper() == 'L':
-            output += tok.string[:-1]
-
-         # If the token is a single character string, then convert it to the literal
-         # character ordinal. C characters a numeric types, so treat as a python
-         # number.
-         elif tok.type == token.STRING and tok.string[0] == "'" and \
-                              len( tok.string ) == 3 and tok.string[2] == "'":
-            output += str(ord(tok.string[1]))
-
-         # Convert old style octal numbers ("0123") to new style ("0o123")
-         elif tok.type == token.NUMBER and len(tok.string) >= 2 and \
-               tok.string[0] == '0' and tok.string[1].upper() != 'X':
-            output += "0o%s" % tok.string[1:]
-
-         # if the previous token was a number, and now we have a name like
-         # "UL", just drop this token - it's a precision suffix that python
-         # doesn't need.
-         elif prev_tok is not None and prev_tok.type == token.NUMBER and \
-                  tok.type == token.NAME and tok.string.upper() in kill_suffixes:
-            pass
-         else: # emit token unmodified.
-            if tok.type == token.NAME:
-               name_list.append( tok.string )
-            output += tok.string
-         prev_tok = tok
-   except tokenize.TokenError:
-      return None, None
+unaryOps = { "-", "+", "~" }
+binaryOps = { "+", "-", "*", "/", "%", "<<", ">>", "<", ">", "<=", ">=", "==",
+              "!=", "&", "|", "^" }
 
-   # Step 2 - see if we have a valid python expression.
-   try:
-      tree = ast.parse( output )
+def primitiveCType( words ):
+   ''' Convert a list of C type specifier keywords ( "unsigned", "long",
+   "int", etc ) to the name of the equivalent ctypes type. Returns None for
+   "void" '''
+   unsigned = "unsigned" in words
+   longs = words.count( "long" )
+   if "void" in words:
+      return None
+   if "_Bool" in words or "bool" in words:
+      return "c_bool"
+   if "char" in words:
+      if unsigned:
+         return "c_ubyte"
+      return "c_byte" if "signed" in words else "c_char"
+   if "float" in words:
+      return "c_float"
+   if "double" in words:
+      return "c_longdouble" if longs else "c_double"
+   if "short" in words:
+      return "c_ushort" if unsigned else "c_short"
+   if longs >= 2:
+      return "c_ulonglong" if unsigned else "c_longlong"
+   if longs == 1:
+      return "c_ulong" if unsigned else "c_long"
+   return "c_uint" if unsigned else "c_int"
 
-      # We only want things that parse as a single expression.
-      if len(tree.body) != 1 or not isinstance( tree.body[0], ast.Expr ):
-         return None, None
+class Parser:
+   ''' Recursive descent parser for C expressions. Each method consumes the
+   tokens for one production, and returns the equivalent python text. C casts
+   are converted to calls to CTypeGenRun.CAST, and the types in sizeof
+   expressions are converted to ctypes types. '''
 
-      # Many system headers include macros for brace-initializers. They look
-      # like sets to python, and when they nest, it causes a problem as they
-      # are not hashable. The definitions are of no use to python anyhow, so
-      # just discard them.
-      if isinstance( tree.body[0].value, ast.Set ):
-         return None, None
+   __slots__ = [ "toks", "pos", "typenames", "names" ]
+
+   def __init__( self, toks, typenames ):
+      self.toks = toks
+      self.pos = 0
+      self.typenames = typenames
+      self.names = [] # identifiers used by the expression.
+
+   def peek( self, offset=0 ):
+      pos = self.pos + offset
+      return self.toks[ pos ] if pos < len( self.toks ) else ( None, None )
 
-      return output, name_list
+   def expect( self, text ):
+      if self.peek()[ 1 ] != text:
+         raise Unusable()
+      self.pos += 1
 
-   except SyntaxError:
-      pass
-   return None, None
+   def expression( self ):
+      output = self.unary()
+      while True:
+         kind, text = self.peek()
+         if kind != OP or text not in binaryOps:
+            return output
+         self.pos += 1
+         output = f"{output} {text} {self.unary()}"
+
+   def unary( self ):
+      kind, text = self.peek()
+      if kind == OP and text in unaryOps:
+         self.pos += 1
+         return text + self.unary()
+      if kind == OP and text == "(":
+         cast = self.castType()
+         if cast is not None:
+            return f"CAST( {cast}, {self.unary()} )"
+      return self.postfix()
+
+   def postfix( self ):
+      output = self.primary()
+      # Only names can be called - python will happily parse "1(2)", but C
+      # won't.
+      if self.toks[ self.pos - 1 ][ 0 ] == NAME:
+         while self.peek()[ 1 ] == "(":
+            self.pos += 1
+            args = []
+            if self.peek()[ 1 ] != ")":
+               args.append( self.expression() )
+               while self.peek()[ 1 ] == ",":
+                  self.pos += 1
+                  args.append( self.expression() )
+            self.expect( ")" )
+            output = f"{output}({', '.join( args )})"
+      return output
+
+   def primary( self ):
+      kind, text = self.peek()
+      if kind == NUMBER:
+         self.pos += 1
+         return text
+      if kind == STRING:
+         # Adjacent string literals are concatenated in python and C alike.
+         strings = []
+         while self.peek()[ 0 ] == STRING:
+            strings.append( self.peek()[ 1 ] )
+            self.pos += 1
+         return " ".join( strings )
+      if kind == NAME:
+         if text == "sizeof":
+            # We can only deal with sizeof for types: we don't know the types
+            # of expressions.
+            self.pos += 1
+            self.expect( "(" )
+            ctype = self.typeName()
+            if ctype is None:
+               raise Unusable()
+            self.expect( ")" )
+            return f"sizeof( {ctype} )"
+         if keyword.iskeyword( text ) or text in primitiveWords or \
+               text in tagPrefixes:
+            raise Unusable()
+         self.pos += 1
+         self.names.append( text )
+         return text
+      if text == "(":
+         self.pos += 1
+         output = self.expression()
+         self.expect( ")" )
+         return f"({output})"
+      raise Unusable()
+
+   def castType( self ):
+      ''' If we are positioned at a parenthesized type name, consume it, and
+      return the ctype for the type. Otherwise, consume nothing, and return
+      None '''
+      start = self.pos
+      self.pos += 1
+      ctype = self.typeName()
+      if ctype is None or self.peek()[ 1 ] != ")":
+         self.pos = start
+         return None
+      self.pos += 1
+      return ctype
+
+   def typeName( self ):
+      ''' Try to parse a C type name. If successful, return the python ctype
+      expression for the type. Otherwise, return None '''
+
+      def skipQualifiers():
+         while self.peek()[ 1 ] in qualifiers:
+            self.pos += 1
+
+      start = self.pos
+      skipQualifiers()
+      kind, text = self.peek()
+      if text in tagPrefixes:
+         kind, tag = self.peek( 1 )
+         if kind != NAME:
+            self.pos = start
+            return None
+         self.pos += 2
+         ctype = tagPrefixes[ text ] + tag
+         self.names.append( ctype )
+      elif text in primitiveWords:
+         words = []
+         while self.peek()[ 1 ] in primitiveWords or \
+               self.peek()[ 1 ] in qualifiers:
+            words.append( self.peek()[ 1 ] )
+            self.pos += 1
+         ctype = primitiveCType( words )
+      elif kind == NAME and text in self.typenames:
+         self.pos += 1
+         ctype = text
+         self.names.append( ctype )
+      else:
+         self.pos = start
+         return None
+
+      skipQualifiers()
+      while self.peek()[ 1 ] == "*":
+         if ctype is None:
+            ctype = "c_void_p"
+         elif ctype == "c_char":
+            ctype = "c_char_p"
+         else:
+            ctype = f"POINTER( {ctype} )"
+         self.pos += 1
+         skipQualifiers()
+
+      if ctype is None: # can't do anything with an unadorned void
+         raise Unusable()
+      return ctype
+
+# The same macro definitions appear in every compilation unit that includes
+# the header they come from, so memoize the results.
+@functools.lru_cache( maxsize=None )
+def clean( input_, typenames=frozenset() ):
+   ''' If "input_" is a usable expression, convert it into valid python,
+   returning a 2-tuple contining the conversion, and a tuple of identifiers
+   that are used in the string. Otherwise return ( None, None ).
+   "typenames" is the set of names that refer to types, and is used to
+   recognise casts and sizeof expressions. Casts are converted to calls to
+   CTypeGenRun.CAST, and types in sizeof expressions to their ctypes
+   equivalent. '''
+   try:
+      parser = Parser( lex( input_ ), typenames )
+      output = parser.expression()
+      if parser.pos != len( parser.toks ):
+         return None, None
+      return output, tuple( parser.names )
+   except Unusable:
+      return None, None
@@ -14,10 +14,43 @@
 
 # We need to look inside ctypes a bit, so do this globally:
 # pylint: disable=protected-access
+import abc
+import collections.abc
 import ctypes
+import errno
+import hashlib
+import importlib
+import json
+import marshal
+import mmap
+import os
+import re
+import struct
+import sys
+import weakref
+
+# The generated classes each module uses, by module name, so test_classes can
+# check one module's classes without looking at every other module's.
+moduleClasses = collections.defaultdict( weakref.WeakSet )
+
+# The validation functions add the errors they find to the list they are
+# given. Without one, as older callers use them, they add them here.
+errors = []
+
+def addError( text ):
+   errors.append( text )
 
 class TestableCtypeClass:
-   pass
+
+   def __init_subclass__( cls, **kwargs ):
+      super().__init_subclass__( **kwargs )
+      if TestableCtypeClass in cls.__bases__:
+         moduleClasses[ cls.__module__ ].add( cls )
+
+   @classmethod
+   def _ctypegen_dtype( cls ):
+      ''' Return the numpy dtype for the class: see numpyDtype '''
+      return numpyDtype( cls )
 
 def CONST( t ):
    return t
@@ -28,6 +61,1419 @@ def VOLATILE( t ):
 def RESTRICT( t ):
    return t
 
+def CAST( t, value ):
+   ''' Emulate a C-style cast of "value" to ctype "t". Casts to pointer types
+   return a pointer of that type, other casts return the converted python
+   value. '''
+   if issubclass( t, ( ctypes._Pointer, ctypes._CFuncPtr, ctypes.c_void_p,
+                       ctypes.c_char_p ) ):
+      if isinstance( value, ( str, bytes ) ):
+         return value # string literals are already pointers.
+      if isinstance( value, int ):
+         value = ctypes.c_void_p( value )
+      return ctypes.cast( value, t )
+   if isinstance( value, ( ctypes._Pointer, ctypes._CFuncPtr, ctypes.c_void_p,
+                           ctypes.c_char_p ) ):
+      value = ctypes.cast( value, ctypes.c_void_p ).value or 0
+   if issubclass( t, ctypes.c_char ):
+      # In C, char is an integral type - in ctypes, its a "bytes"
+      t = ctypes.c_byte
+   if issubclass( t, ctypes.c_bool ):
+      return bool( value )
+   if isinstance( value, float ) and t._type_ not in "fdg":
+      value = int( value )
+   return t( value ).value
+
+def enumName( enumType, value, default=None ):
+   ''' Return the name of the enumerator of the generated enum "enumType"
+   with the given value, or "default" if there is none. "value" may be a
+   python value, or an instance of the enum. '''
+   if isinstance( value, ctypes._SimpleCData ):
+      value = value.value
+   return enumType._ctypegen_names.get( value, default )
+
+def enumFlags( enumType, value ):
+   ''' Decompose "value" into the flags of "enumType", a generated enum whose
+   enumerators are distinct powers of two. Returns a list of the names of
+   the flags set in "value", and any bits of "value" that are not flags. '''
+   flags = getattr( enumType, "_ctypegen_flags", None )
+   if flags is None:
+      raise TypeError( f"{enumType.__name__} is not an enum of flags" )
+   if isinstance( value, ctypes._SimpleCData ):
+      value = value.value
+   names = []
+   for flag, name in flags:
+      if value & flag:
+         names.append( name )
+         value &= ~flag
+   return names, value
+
+# The classes for types shared between generated modules, indexed by the
+# identity of the library that describes them, and the name of the type.
+typeRegistry = {}
+
+def registerType( cls, key ):
+   ''' Return the class registered for "key", a ( library, type name ) tuple,
+   registering "cls" if there is none. The library is identified by its build
+   ID, or soname. Modules generated with "shareTypes" call this for each
+   struct, union and enum they declare, so there is only one class for each
+   type in a process, however many modules describe it. '''
+   registered = typeRegistry.setdefault( key, cls )
+   if registered is not cls:
+      # The class keeps the __module__ of the first module to declare it, so
+      # note that this module uses it instead of the class it declared.
+      used = moduleClasses[ cls.__module__ ]
+      used.discard( cls )
+      used.add( registered )
+   return registered
+
+def needsDefinition( cls ):
+   ''' Return True if the fields of the declared class "cls" have not been
+   set yet. A shared class may already have been defined by another module. '''
+   return "_ctypegen_have_definition" not in cls.__dict__
+
+class LazyDefinitions:
+   ''' Definitions in a generated module that are only executed when they are
+   first accessed. The generated module uses "get" as its module-level
+   __getattr__, so accessing a name not yet defined in the module will
+   execute its definition. "chunks" is a list of ( source, dependencies )
+   tuples, where source is python source text, and dependencies are the
+   indexes of the chunks that must be executed first. "names" maps each name
+   to the chunk that defines it.
+
+   When a generated package is split into submodules, "imports" maps names
+   defined in other modules of the package to the module that defines them.
+   Such names can appear in the dependencies of a chunk, and are copied from
+   their module before the chunk is executed. '''
+
+   def __init__( self, namespace, chunks, names, imports=None ):
+      self.namespace = namespace
+      self.chunks = chunks
+      self.names = names
+      self.imports = imports if imports is not None else {}
+      # 0: not yet executed, 1: being executed, 2: executed.
+      self.state = bytearray( len( chunks ) )
+
+   def __contains__( self, name ):
+      return name in self.names or name in self.imports
+
+   def load( self, name ):
+      ''' Copy an imported name from the module that defines it. '''
+      if name not in self.namespace:
+         module = importlib.import_module( self.imports[ name ] )
+         self.namespace[ name ] = getattr( module, name )
+
+   def run( self, idx ):
+      ''' Execute chunk "idx", after any chunks it depends on. Chunks that
+      depend on each other ( eg, a struct with a pointer to a struct that
+      points back to it ) are broken at the chunk we are already executing. We
+      walk the dependencies iteratively, as the chains can be longer than the
+      recursion limit. '''
+      if self.state[ idx ]:
+         return
+      self.state[ idx ] = 1
+      stack = [ ( idx, iter( self.chunks[ idx ][ 1 ] ) ) ]
+      try:
+         while stack:
+            current, deps = stack[ -1 ]
+            for dep in deps:
+               if isinstance( dep, str ):
+                  self.load( dep )
+               elif not self.state[ dep ]:
+                  self.state[ dep ] = 1
+                  stack.append( ( dep, iter( self.chunks[ dep ][ 1 ] ) ) )
+                  break
+            else:
+               stack.pop()
+               source = self.chunks[ current ][ 0 ]
+               if source:
+                  exec( source, self.namespace ) # pylint: disable=exec-used
+               self.state[ current ] = 2
+      except BaseException:
+         # Leave anything we did not finish to be retried.
+         for current, _ in stack:
+            self.state[ current ] = 0
+         raise
+
+   def materialize( self, name ):
+      ''' Execute the definition for "name", and any definitions it
+      depends on. '''
+      idx = self.names.get( name )
+      if idx is not None:
+         self.run( idx )
+
+   def materializeAll( self ):
+      for idx in range( len( self.chunks ) ):
+         self.run( idx )
+      for name in self.imports:
+         self.load( name )
+
+   def get( self, name ):
+      idx = self.names.get( name )
+      if idx is not None:
+         self.run( idx )
+         if name in self.namespace:
+            return self.namespace[ name ]
+      elif name in self.imports:
+         self.load( name )
+         return self.namespace[ name ]
+      raise AttributeError( f"module '{self.namespace[ '__name__' ]}' has "
+                            f"no attribute '{name}'" )
+
+   def dir( self ):
+      return sorted( set( self.namespace ) | set( self.names ) |
+                     set( self.imports ) )
+
+class LazyNames:
+   ''' A mapping to use as the locals when evaluating an expression in the
+   namespace of a generated module. Names the module defines lazily are
+   defined as the expression uses them. '''
+
+   __slots__ = [ "namespace" ]
+
+   def __init__( self, namespace ):
+      self.namespace = namespace
+
+   def __getitem__( self, name ):
+      if name in self.namespace:
+         return self.namespace[ name ]
+      lazy = self.namespace.get( "CTYPEGEN_lazy" )
+      if lazy is not None and name in lazy:
+         return lazy.get( name )
+      raise KeyError( name )
+
+pointerExpr = re.compile( r"POINTER\( (.*) \)" )
+
+def evaluateType( namespace, expr ):
+   ''' Evaluate the python expression for a type in the namespace of a
+   generated module '''
+   # Most types are names or pointers, which we can deal with without
+   # compiling anything.
+   if expr.isidentifier():
+      try:
+         return LazyNames( namespace )[ expr ]
+      except KeyError:
+         pass
+   match = pointerExpr.fullmatch( expr )
+   if match:
+      return ctypes.POINTER( evaluateType( namespace, match.group( 1 ) ) )
+   return eval( expr, namespace, LazyNames( namespace ) ) # pylint: disable=eval-used
+
+def readLayouts( path ):
+   # marshal.load reads the file piecemeal, and is much slower than reading
+   # the whole thing at once. We don't cache the result: the LayoutTable
+   # keeps it, and a module regenerated in this process must see its new
+   # layouts.
+   with open( path, "rb" ) as f:
+      return marshal.loads( f.read() )
+
+class LayoutTable:
+   ''' Builds the structs and unions for a generated module from the records
+   in its layout sidecar file. A DECLARE record is ( DECLARE, name, base,
+   mixins ), and a DEFINE record is ( DEFINE, name, native size,
+   allow_unaligned, fields, packed, anonymous fields, offsets, bitfields ).
+   Types are indexes into a table of python expressions, which we evaluate in
+   the module's namespace the first time they are used. '''
+
+   VERSION = 2
+   DECLARE, DEFINE = range( 2 )
+   KIND, NAME, SIZE, UNALIGNED, FIELDS, PACKED, ANONYMOUS, OFFSETS, BITFIELDS = \
+         range( 9 )
+
+   def __init__( self, namespace, filename ):
+      self.namespace = namespace
+      path = os.path.join( os.path.dirname( namespace[ "__file__" ] ), filename )
+      version, self.exprs, self.records = readLayouts( path )
+      if version != self.VERSION:
+         raise ImportError( f"{path}: layout version {version}, "
+                            f"expected {self.VERSION}" )
+      self.ctypes = [ None ] * len( self.exprs )
+
+   def ctype( self, idx ):
+      t = self.ctypes[ idx ]
+      if t is None:
+         t = evaluateType( self.namespace, self.exprs[ idx ] )
+         self.ctypes[ idx ] = t
+      return t
+
+   def declare( self, idx ):
+      _, name, base, mixins = self.records[ idx ]
+      bases = ( self.ctype( base ), TestableCtypeClass ) + \
+            tuple( self.ctype( mixin ) for mixin in mixins )
+      return type( name, bases, { "__module__" : self.namespace[ "__name__" ] } )
+
+   def define( self, first, last=None ):
+      ''' Set the fields of the classes for records first to last inclusive '''
+      ctype = self.ctype
+      namespace = self.namespace
+      for record in self.records[ first : ( first if last is None else last ) + 1 ]:
+         _, name, size, unaligned, fields, packed, anonymous, offsets, \
+               bitfields = record
+         cls = namespace[ name ]
+         if not needsDefinition( cls ):
+            continue
+         cls._ctypegen_native_size = size
+         cls._ctypegen_have_definition = True
+         if unaligned is not None:
+            cls.allow_unaligned = unaligned
+         if fields is not None:
+            # _pack_ and _anonymous_ must be set before _fields_
+            if packed:
+               cls._pack_ = 1
+            if anonymous:
+               cls._anonymous_ = anonymous
+            cls._fields_ = [ ( field[ 0 ], ctype( field[ 1 ] ) ) + field[ 2: ]
+                             for field in fields ]
+         if offsets is not None:
+            cls._ctypegen_offsets = offsets
+         if bitfields is not None:
+            defineBitfields( cls, bitfields )
+
+class FunctionPrototypes( collections.abc.Mapping ):
+   ''' The prototypes of the functions in a module generated with
+   "lazyPrototypes". "table" maps the python name of each function to a tuple
+   of ( restype, argtypes, linker names ), where the types are python
+   expressions, and restype is None for void functions. Nothing is evaluated
+   until it is used. As a mapping, this is the module's "functionTypes": it
+   maps each function's name to its CFUNCTYPE, created on first access. '''
+
+   def __init__( self, namespace, table ):
+      self.namespace = namespace
+      self.table = table
+      self.types = {}
+      self.signatures = {}
+      self.byLinkerName = None
+
+   def signature( self, name ):
+      ''' Return ( restype, argtypes ) for the function called "name" '''
+      signature = self.signatures.get( name )
+      if signature is None:
+         restype, argtypes, _ = self.table[ name ]
+         namespace = self.namespace
+         signature = (
+               None if restype is None else evaluateType( namespace, restype ),
+               [ evaluateType( namespace, arg ) for arg in argtypes ] )
+         self.signatures[ name ] = signature
+      return signature
+
+   def __getitem__( self, name ):
+      functionType = self.types.get( name )
+      if functionType is None:
+         restype, argtypes = self.signature( name )
+         functionType = ctypes.CFUNCTYPE( restype, *argtypes )
+         self.types[ name ] = functionType
+      return functionType
+
+   def __iter__( self ):
+      return iter( self.table )
+
+   def __len__( self ):
+      return len( self.table )
+
+   def apply( self, func, linkername ):
+      ''' If we have a prototype for the dynamic symbol "linkername", set
+      the restype and argtypes of "func", the function for that symbol '''
+      if self.byLinkerName is None:
+         self.byLinkerName = { linkername : name
+                               for name, ( _, _, linkernames ) in self.table.items()
+                               for linkername in linkernames }
+      name = self.byLinkerName.get( linkername )
+      if name is not None:
+         func.restype, func.argtypes = self.signature( name )
+
+   def decorate( self, lib ):
+      ''' Set the restype and argtypes of every function in "lib" that we
+      have a prototype for '''
+      for _, _, linkernames in self.table.values():
+         for linkername in linkernames:
+            if hasattr( lib, linkername ):
+               self.apply( getattr( lib, linkername ), linkername )
+
+class DecoratedCDLL( ctypes.CDLL ):
+   ''' A CDLL that sets the restype and argtypes of each of its functions from
+   a FunctionPrototypes when the function is first accessed, rather than
+   decorating every function in the library up front. '''
+
+   def __init__( self, name, prototypes, **kwargs ):
+      super().__init__( name, **kwargs )
+      self._ctypegen_prototypes = prototypes
+
+   def __getitem__( self, name ):
+      func = super().__getitem__( name )
+      self._ctypegen_prototypes.apply( func, name )
+      return func
+
+class GlobalVariable:
+   ''' A descriptor for a variable in the "Globals" class of a generated
+   module. The variable is looked up in the library the first time it is
+   accessed, and the resulting ctypes object is cached in the instance.
+   "ctype" is the python expression for the variable's type, evaluated in
+   "namespace", and "symbol" is the name of the variable in the library. '''
+
+   __slots__ = [ "namespace", "ctype", "symbol", "name" ]
+
+   def __init__( self, namespace, ctype, symbol ):
+      self.namespace = namespace
+      self.ctype = ctype
+      self.symbol = symbol
+      self.name = None
+
+   def __set_name__( self, owner, name ):
+      self.name = name
+
+   def __get__( self, instance, owner ):
+      if instance is None:
+         return self
+      value = evaluateType( self.namespace, self.ctype ).in_dll(
+            instance._ctypegen_dll, self.symbol )
+      # We don't define __set__, so the cached value hides us from now on.
+      instance.__dict__[ self.name ] = value
+      return value
+
+class LazyGlobals:
+   ''' The base class for the "Globals" class of a generated module, which
+   has a GlobalVariable for each variable in the library "dll". Its
+   attributes are the names of the variables, so it has no methods of its
+   own: see prefetchGlobals. '''
+
+   def __init__( self, dll ):
+      self._ctypegen_dll = dll
+
+def prefetchGlobals( globals_, names=None ):
+   ''' Look up the named variables of "globals_", a generated module's
+   Globals, or all of them, now rather than on their first access. '''
+   if names is None:
+      names = [ name for cls in type( globals_ ).__mro__
+                for name, value in vars( cls ).items()
+                if isinstance( value, GlobalVariable ) ]
+   for name in names:
+      getattr( globals_, name )
+
+def pointerTarget( pointer, ctype=None ):
+   ''' Return the address "pointer" holds, and the type it points to.
+   "pointer" may be a ctypes pointer, a c_void_p or an integer, in which case
+   "ctype" gives the type. '''
+   if isinstance( pointer, ctypes._Pointer ):
+      if ctype is None:
+         ctype = pointer._type_
+      pointer = ctypes.cast( pointer, ctypes.c_void_p ).value
+   elif isinstance( pointer, ctypes.c_void_p ):
+      pointer = pointer.value
+   if ctype is None:
+      raise TypeError( "the type of an untyped pointer must be given" )
+   return pointer, ctype
+
+class MappedRegion:
+   ''' Maps a file, and returns views of ctypes types at offsets within it.
+   The views share the mapping's memory, so nothing is copied, and changes to
+   a view made through a writable mapping change the file. Read-only
+   mappings are private, copy-on-write mappings: ctypes can only build
+   objects over writable memory, but changes to the views are never written
+   back.
+
+   Pointers stored in the file hold addresses in the address space of
+   whoever wrote it. "base" is the address the file was mapped at there: it
+   defaults to our own mapping's address, which is right for memory that is
+   shared with a live process that maps it at the same address.
+
+   All views must be released before the region is closed. '''
+
+   def __init__( self, path, writable=False, base=None, offset=0, size=0 ):
+      fd = os.open( path, os.O_RDWR if writable else os.O_RDONLY )
+      try:
+         self.mmap = mmap.mmap( fd, size, offset=offset,
+               access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_COPY )
+      finally:
+         os.close( fd )
+      self.address = ctypes.addressof( ctypes.c_char.from_buffer( self.mmap ) )
+      self.base = self.address if base is None else base
+
+   @classmethod
+   def sharedMemory( cls, name, writable=False, base=None ):
+      ''' Map the POSIX shared memory segment "name", as shm_open would '''
+      return cls( os.path.join( "/dev/shm", name.lstrip( "/" ) ), writable,
+                  base )
+
+   def __len__( self ):
+      return len( self.mmap )
+
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, *args ):
+      self.close()
+
+   def close( self ):
+      self.mmap.close()
+
+   def view( self, ctype, offset=0 ):
+      ''' Return an instance of "ctype" over the memory at "offset" '''
+      return ctype.from_buffer( self.mmap, offset )
+
+   def array( self, ctype, count, offset=0 ):
+      ''' Return an array of "count" instances of "ctype" at "offset" '''
+      return self.view( ctype * count, offset )
+
+   def records( self, ctype, offset=0, count=None, stride=None ):
+      ''' Yield views of successive records of type "ctype", starting at
+      "offset", "stride" bytes apart ( by default, the size of "ctype" ).
+      Without "count", continue to the end of the mapping. '''
+      if stride is None:
+         stride = ctypes.sizeof( ctype )
+      if count is None:
+         count = ( len( self.mmap ) - offset - ctypes.sizeof( ctype ) ) // \
+               stride + 1
+      for idx in range( max( count, 0 ) ):
+         yield ctype.from_buffer( self.mmap, offset + idx * stride )
+
+   def offsetOf( self, address ):
+      ''' Return the offset in the mapping of "address", an address in the
+      writer's address space '''
+      offset = address - self.base
+      if not 0 <= offset < len( self.mmap ):
+         raise ValueError( f"address {address:#x} is outside the mapping" )
+      return offset
+
+   def follow( self, pointer, ctype=None ):
+      ''' Return a view of what the pointer field "pointer" points to, or
+      None if it is null. "pointer" may also be an integer address, or a
+      c_void_p, in which case "ctype" gives the type to view it as. '''
+      address, ctype = pointerTarget( pointer, ctype )
+      if not address:
+         return None
+      return self.view( ctype, self.offsetOf( address ) )
+
+class RemoteMemory( abc.ABC ):
+   ''' Reads ctypes objects out of another address space, such as a core
+   file or a live process, through a cache of its pages. Subclasses provide
+   "fetch", which is passed a list of ( address, size ) ranges of whole
+   pages, and returns the bytes read from each: if one comes up short, the
+   page after the bytes it returned is taken to be unreadable.
+
+   Objects are copies, so the pointers in them hold addresses in the other
+   address space, and "follow" reads what they point to, only when asked.
+   Don't read the c_char_p fields of a copy: ctypes would dereference them
+   in this process. Pass their address, which is
+   c_void_p.from_buffer( obj, type( obj ).field.offset ).value, to
+   "string" instead.
+
+   When pages must be read, the "readAhead" pages after each are read along
+   with them, if they can be: the objects of a linked structure are often
+   near each other. '''
+
+   pageSize = mmap.PAGESIZE
+
+   def __init__( self, readAhead=0 ):
+      self.pages = {}
+      self.readAhead = readAhead
+
+   @abc.abstractmethod
+   def fetch( self, ranges ):
+      ''' Return the bytes read from each of "ranges" '''
+
+   def pagesFor( self, address, size ):
+      return range( address // self.pageSize,
+                    ( address + max( size, 1 ) - 1 ) // self.pageSize + 1 )
+
+   def load( self, ranges ):
+      ''' Make sure the pages for a list of ( address, size ) ranges are
+      cached, reading all that are missing in a single batch '''
+      pageSize = self.pageSize
+      needed = { page for address, size in ranges
+                 for page in self.pagesFor( address, size )
+                 if page not in self.pages }
+      missing = sorted( { page + ahead for page in needed
+                          for ahead in range( self.readAhead + 1 )
+                          if page + ahead not in self.pages } )
+      runs = []
+      for page in missing:
+         if runs and runs[ -1 ][ 0 ] + runs[ -1 ][ 1 ] == page:
+            runs[ -1 ][ 1 ] += 1
+         else:
+            runs.append( [ page, 1 ] )
+      while runs:
+         results = self.fetch( [ ( first * pageSize, count * pageSize )
+                                 for first, count in runs ] )
+         retries = []
+         for ( first, count ), data in zip( runs, results ):
+            got = len( data ) // pageSize
+            for idx in range( got ):
+               self.pages[ first + idx ] = data[ idx * pageSize :
+                                                 ( idx + 1 ) * pageSize ]
+            # Skip the page we could not read, and try the rest again, if
+            # any of it is needed.
+            rest = range( first + got + 1, first + count )
+            if any( page in needed for page in rest ):
+               retries.append( [ rest.start, len( rest ) ] )
+         runs = retries
+
+   def read( self, address, size ):
+      ''' Return "size" bytes from "address" '''
+      self.load( [ ( address, size ) ] )
+      pageSize = self.pageSize
+      chunks = []
+      for page in self.pagesFor( address, size ):
+         data = self.pages.get( page )
+         if data is None:
+            raise ValueError( f"cannot read {size} bytes at {address:#x}" )
+         chunks.append( data )
+      start = address % pageSize
+      return b"".join( chunks )[ start : start + size ]
+
+   def readType( self, ctype, address ):
+      ''' Return a copy of the instance of "ctype" at "address" '''
+      return ctype.from_buffer_copy( self.read( address, ctypes.sizeof( ctype ) ) )
+
+   def readTypes( self, requests ):
+      ''' Return copies of the objects for a list of ( ctype, address )
+      requests, reading the memory for all of them in one batch '''
+      self.load( [ ( address, ctypes.sizeof( ctype ) )
+                   for ctype, address in requests ] )
+      return [ self.readType( ctype, address ) for ctype, address in requests ]
+
+   def follow( self, pointer, ctype=None ):
+      ''' Return a copy of what "pointer" points to, or None if it is null.
+      As for pointerTarget, "ctype" is needed if "pointer" is untyped. '''
+      address, ctype = pointerTarget( pointer, ctype )
+      return self.readType( ctype, address ) if address else None
+
+   def followAll( self, pointers, ctype=None ):
+      ''' "follow" each of "pointers", reading them all in one batch '''
+      targets = [ pointerTarget( pointer, ctype ) for pointer in pointers ]
+      found = iter( self.readTypes( [ ( ctype, address )
+                                      for address, ctype in targets if address ] ) )
+      return [ next( found ) if address else None for address, _ in targets ]
+
+   def string( self, address, limit=4096 ):
+      ''' Return the NUL terminated string at "address", reading at most
+      "limit" bytes '''
+      data = b""
+      while len( data ) < limit:
+         here = address + len( data )
+         chunk = self.pageSize - here % self.pageSize
+         data += self.read( here, min( chunk, limit - len( data ) ) )
+         end = data.find( b"\0" )
+         if end != -1:
+            return data[ : end ]
+      return data
+
+   def invalidate( self, address=None, size=1 ):
+      ''' Forget the cached pages covering "size" bytes at "address", or
+      all of them '''
+      if address is None:
+         self.pages.clear()
+      else:
+         for page in self.pagesFor( address, size ):
+            self.pages.pop( page, None )
+
+class iovec( ctypes.Structure ):
+   _fields_ = [ ( "iov_base", ctypes.c_void_p ), ( "iov_len", ctypes.c_size_t ) ]
+
+class ProcessMemory( RemoteMemory ):
+   ''' Reads objects out of the running process "pid", with
+   process_vm_readv. All the pages missing for a request are read with one
+   system call ( or one for every IOV_MAX of them ), and kept until they are
+   invalidated, so call "invalidate" when the process may have changed
+   them. Reading another process needs the same permission as ptrace. '''
+
+   IOV_MAX = 1024
+
+   def __init__( self, pid, readAhead=0 ):
+      super().__init__( readAhead )
+      self.pid = pid
+      self.syscalls = 0
+      libc = ctypes.CDLL( None, use_errno=True )
+      self.readv = libc.process_vm_readv
+      self.readv.restype = ctypes.c_ssize_t
+      self.readv.argtypes = [ ctypes.c_int, ctypes.POINTER( iovec ), ctypes.c_ulong,
+                              ctypes.POINTER( iovec ), ctypes.c_ulong,
+                              ctypes.c_ulong ]
+
+   def fetch( self, ranges ):
+      results = []
+      pending = list( ranges )
+      while pending:
+         batch = pending[ : self.IOV_MAX ]
+         total = sum( size for _, size in batch )
+         buf = ctypes.create_string_buffer( total )
+         local = iovec( ctypes.addressof( buf ), total )
+         remote = ( iovec * len( batch ) )( *[ iovec( address, size )
+                                               for address, size in batch ] )
+         got = self.readv( self.pid, ctypes.byref( local ), 1, remote,
+                           len( batch ), 0 )
+         self.syscalls += 1
+         if got < 0:
+            err = ctypes.get_errno()
+            if err != errno.EFAULT:
+               raise OSError( err, os.strerror( err ) )
+            got = 0
+         # The transfer stops at the first range that cannot be read in full,
+         # which is cut short, and the rest are read again by the next call.
+         raw = buf.raw
+         pos = 0
+         done = 0
+         for _, size in batch:
+            results.append( raw[ pos : min( pos + size, got ) ] )
+            pos += size
+            done += 1
+            if pos > got:
+               break
+         pending = pending[ done : ]
+      return results
+
+# numpy dtype strings for the ctypes simple type codes that differ. Pointers
+# are addresses in numpy.
+numpyTypeCodes = { "c" : "S1", "u" : "U1", "z" : "uintp", "Z" : "uintp",
+                   "P" : "uintp" }
+
+numpyDtypeMemo = {}
+
+def numpyDtype( ctype ):
+   ''' Return the numpy dtype with the same layout as "ctype", so a buffer
+   of records can be viewed as a numpy array. Structs and unions get a
+   structured dtype with the offsets DWARF gives their fields, and the
+   native size as the itemsize; nested structs and arrays become sub-dtypes.
+   Pointers are unsigned integers. Numpy has no bitfields, so they are left
+   out, along with our padding fields. Arrays of char are byte strings.
+   numpy is only imported when this is called. '''
+   # pylint: disable=import-outside-toplevel
+   import numpy
+   dtype = numpyDtypeMemo.get( ctype )
+   if dtype is not None:
+      return dtype
+
+   if issubclass( ctype, ctypes.Array ) and ctype._type_ is ctypes.c_char:
+      dtype = numpy.dtype( f"S{ctype._length_}" )
+   elif issubclass( ctype, ctypes.Array ):
+      dtype = numpy.dtype( ( numpyDtype( ctype._type_ ), ( ctype._length_, ) ) )
+   elif issubclass( ctype, ( ctypes.Structure, ctypes.Union ) ):
+      offsets = getattr( ctype, "_ctypegen_offsets", None ) or []
+      names, formats, fieldOffsets = [], [], []
+      for idx, field in enumerate( getattr( ctype, "_fields_", [] ) ):
+         offset = offsets[ idx ] if idx < len( offsets ) else None
+         if len( field ) > 2 or offset == -1:
+            continue # bitfield, or padding
+         names.append( field[ 0 ] )
+         formats.append( numpyDtype( field[ 1 ] ) )
+         fieldOffsets.append( getattr( ctype, field[ 0 ] ).offset
+                              if offset is None else offset )
+      size = getattr( ctype, "_ctypegen_native_size", ctypes.sizeof( ctype ) )
+      dtype = numpy.dtype( { "names" : names, "formats" : formats,
+                             "offsets" : fieldOffsets,
+                             "itemsize" : max( size, ctypes.sizeof( ctype ) ) } )
+   elif issubclass( ctype, ( ctypes._Pointer, ctypes._CFuncPtr ) ):
+      dtype = numpy.dtype( "uintp" )
+   else:
+      code = ctype._type_
+      dtype = numpy.dtype( numpyTypeCodes.get( code, code ) )
+   numpyDtypeMemo[ ctype ] = dtype
+   return dtype
+
+# struct codes for integers of each size, signed and unsigned.
+structIntCodes = { 1 : "bB", 2 : "hH", 4 : "iI", 8 : "qQ" }
+
+def structCode( ctype ):
+   ''' Return the struct module code that decodes "ctype", or None if there
+   isn't one. Pointers decode to their address. '''
+   if issubclass( ctype, ( ctypes._Pointer, ctypes._CFuncPtr ) ):
+      code = "P"
+   elif issubclass( ctype, ctypes._SimpleCData ):
+      code = ctype._type_
+   else:
+      return None
+   size = ctypes.sizeof( ctype )
+   if code in "PzZ":
+      return structIntCodes[ size ][ 1 ]
+   if code in "bhilq":
+      return structIntCodes[ size ][ 0 ]
+   if code in "BHILQ":
+      return structIntCodes[ size ][ 1 ]
+   if code in "fd?c":
+      return code
+   return None
+
+class Bitfield:
+   ''' A descriptor for a bitfield that reads and writes the integer holding
+   it directly: "bits" bits, "shift" bits up the native-endian integer of
+   "size" bytes at "offset" in the object, sign extended if "signed", and
+   read as a bool if "boolean". '''
+
+   __slots__ = [ "offset", "size", "shift", "bits", "signed", "boolean", "mask",
+                 "word" ]
+
+   def __init__( self, offset, size, shift, bits, signed, boolean=False ):
+      self.offset = offset
+      self.size = size
+      self.shift = shift
+      self.bits = bits
+      self.signed = signed
+      self.boolean = boolean
+      self.mask = ( 1 << bits ) - 1
+      self.word = struct.Struct( "=" + structIntCodes[ size ][ 1 ] )
+
+   def read( self, buf, base=0 ):
+      value = ( self.word.unpack_from( buf, base + self.offset )[ 0 ] >>
+                self.shift ) & self.mask
+      if self.signed and value >> ( self.bits - 1 ):
+         value -= 1 << self.bits
+      return bool( value ) if self.boolean else value
+
+   def write( self, buf, value, base=0 ):
+      offset = base + self.offset
+      word = self.word.unpack_from( buf, offset )[ 0 ] & \
+            ~( self.mask << self.shift )
+      self.word.pack_into( buf, offset,
+                           word | ( ( value & self.mask ) << self.shift ) )
+
+   def __get__( self, instance, owner ):
+      return self if instance is None else self.read( instance )
+
+   def __set__( self, instance, value ):
+      self.write( instance, value )
+
+def ctypesBitPosition( descriptor ):
+   ''' Return the offset and size in bits of the ctypes bitfield
+   "descriptor" '''
+   if hasattr( descriptor, "bit_offset" ):
+      return descriptor.offset * 8 + descriptor.bit_offset, descriptor.bit_size
+   # Before python 3.13, the size of a bitfield holds its size in bits in the
+   # high 16 bits, and its offset in the low 16.
+   return descriptor.offset * 8 + ( descriptor.size & 0xffff ), \
+         descriptor.size >> 16
+
+def isBoolType( ctype ):
+   return ctype is not None and issubclass( ctype, ctypes.c_bool )
+
+def defineBitfields( cls, bitfields ):
+   ''' Record the layout of the bitfields of "cls" that DWARF gives, as a
+   dict mapping their names to the arguments for a Bitfield. ctypes doesn't
+   always lay bitfields out as the compiler does ( in packed structs, for
+   example ), so we replace the accessors of any it has put in the wrong
+   place with a Bitfield. The others keep the ctypes accessor, which is
+   faster. On big-endian hosts, where we can't compare ctypes' positions
+   with ours as simply, every bitfield gets a Bitfield, so all bitfield
+   access there goes through this slower python descriptor. '''
+   cls._ctypegen_bitfields = bitfields
+   fieldTypes = { field[ 0 ] : field[ 1 ]
+                  for field in cls.__dict__.get( "_fields_", () ) }
+   for name, layout in bitfields.items():
+      offset, _, shift, bits, _ = layout
+      descriptor = cls.__dict__.get( name )
+      if descriptor is None or isinstance( descriptor, Bitfield ):
+         continue
+      if sys.byteorder == "big" or \
+            ctypesBitPosition( descriptor ) != ( offset * 8 + shift, bits ):
+         setattr( cls, name,
+                  Bitfield( *layout, isBoolType( fieldTypes.get( name ) ) ) )
+
+class ConverterCompiler:
+   ''' Generates the source of the converter for one struct or union. Runs
+   of fields the struct module can decode, and arrays of them, are decoded
+   with a single unpack_from, nested records and arrays with their own
+   converters, and bitfields from the integers holding them. Anything else
+   goes through ctypes. '''
+
+   def __init__( self, ctype, kind ):
+      self.ctype = ctype
+      self.kind = kind
+      self.namespace = { "from_buffer_copy" : ctype.from_buffer_copy }
+      self.lines = []
+      self.values = []
+      self.run = None # [ format, start offset, end offset, value count ]
+      self.runs = 0
+      # ( offset, size ) -> index of the integers holding bitfields in the
+      # current run, so bitfields sharing one only unpack it once.
+      self.words = {}
+      self.usesObject = False
+
+   def endRun( self ):
+      if self.run is not None:
+         fmt, start, _, _ = self.run
+         name = f"unpack_{self.runs}"
+         self.namespace[ name ] = struct.Struct( fmt ).unpack_from
+         self.lines.append( f"   v{self.runs} = {name}( buf, offset + {start} )" )
+         self.runs += 1
+         self.run = None
+         self.words = {}
+
+   def unpacked( self, offset, size, fmt, count ):
+      ''' Add "count" values of "fmt" at "offset" to the current run of
+      unpacked values, and return the index of the first '''
+      if self.run is not None and offset < self.run[ 2 ]:
+         self.endRun() # unions, and fields we didn't expect to overlap.
+      if self.run is None:
+         self.run = [ "=", offset, offset, 0 ]
+      if offset > self.run[ 2 ]:
+         self.run[ 0 ] += f"{offset - self.run[ 2 ]}x"
+      self.run[ 0 ] += fmt
+      self.run[ 2 ] = offset + size
+      self.run[ 3 ] += count
+      return self.run[ 3 ] - count
+
+   def value( self, ftype, offset, name ):
+      ''' Return the expression for the field "name", of type "ftype" '''
+      size = ctypes.sizeof( ftype )
+      code = structCode( ftype )
+      if code is not None:
+         idx = self.unpacked( offset, size, code, 1 )
+         return f"v{self.runs}[ {idx} ]"
+      if issubclass( ftype, ctypes.Array ):
+         elementCode = structCode( ftype._type_ )
+         if elementCode == "c":
+            idx = self.unpacked( offset, size, f"{ftype._length_}s", 1 )
+            return f"v{self.runs}[ {idx} ].split( b'\\0', 1 )[ 0 ]"
+         if elementCode is not None:
+            idx = self.unpacked( offset, size, f"{ftype._length_}{elementCode}",
+                                 ftype._length_ )
+            values = f"v{self.runs}[ {idx} : {idx + ftype._length_} ]"
+            return values if self.kind == "tuple" else f"list( {values} )"
+      if issubclass( ftype, ( ctypes.Array, ctypes.Structure, ctypes.Union ) ):
+         converter = f"convert_{len( self.namespace )}"
+         self.namespace[ converter ] = recordConverter( ftype, self.kind )
+         return f"{converter}( buf, offset + {offset} )"
+      self.usesObject = True
+      return f"getattr( obj, {name!r} )"
+
+   def bitfieldValue( self, ftype, base, layout ):
+      ''' Return the expression for a bitfield with "layout", as for
+      defineBitfields, in the record at "base" '''
+      offset, size, shift, bits, signed = layout
+      key = ( base + offset, size )
+      idx = self.words.get( key )
+      if idx is None:
+         idx = self.unpacked( base + offset, size, structIntCodes[ size ][ 1 ], 1 )
+         self.words[ key ] = idx
+      value = f"v{self.runs}[ {idx} ] >> {shift} & {( 1 << bits ) - 1}"
+      if signed:
+         sign = 1 << ( bits - 1 )
+         value = f"( ( {value} ) ^ {sign} ) - {sign}"
+      if isBoolType( ftype ):
+         value = f"bool( {value} )"
+      return value
+
+   def compile( self ):
+      ctype = self.ctype
+      if issubclass( ctype, ctypes.Array ):
+         converter = recordConverter( ctype._type_, self.kind ) \
+               if structCode( ctype._type_ ) is None else None
+         if converter is None:
+            # A multi-dimensional array of primitives, or one that nothing
+            # else contains.
+            self.lines.append( "   obj = from_buffer_copy( buf, offset )" )
+            body = "obj[ : ]"
+         else:
+            self.namespace[ "convert_element" ] = converter
+            stride = ctypes.sizeof( ctype._type_ )
+            body = ( f"[ convert_element( buf, offset + idx * {stride} ) "
+                     f"for idx in range( {ctype._length_} ) ]" )
+         if self.kind == "tuple":
+            body = f"tuple( {body} )"
+         self.lines.append( f"   return {body}" )
+      else:
+         offsets = getattr( ctype, "_ctypegen_offsets", None ) or []
+         bitfields = getattr( ctype, "_ctypegen_bitfields", None ) or {}
+         names = []
+         for idx, field in enumerate( getattr( ctype, "_fields_", [] ) ):
+            offset = offsets[ idx ] if idx < len( offsets ) else None
+            if offset == -1:
+               continue # padding
+            name = field[ 0 ]
+            if offset is None:
+               offset = getattr( ctype, name ).offset
+            if len( field ) > 2:
+               layout = bitfields.get( name )
+               if layout is not None:
+                  value = self.bitfieldValue( field[ 1 ], 0, layout )
+               else:
+                  self.usesObject = True
+                  value = f"getattr( obj, {name!r} )"
+            else:
+               value = self.value( field[ 1 ], offset, name )
+            names.append( ( name, value ) )
+         self.endRun()
+         if self.usesObject:
+            self.lines.insert( 0, "   obj = from_buffer_copy( buf, offset )" )
+         if self.kind == "tuple":
+            body = "".join( f"{value}, " for _, value in names )
+            self.lines.append( f"   return ( {body})" )
+         else:
+            body = ", ".join( f"{name!r} : {value}" for name, value in names )
+            self.lines.append( f"   return {{ {body} }}" )
+      source = "def convert( buf, offset=0 ):\n" + "\n".join( self.lines ) + "\n"
+      exec( source, self.namespace ) # pylint: disable=exec-used
+      convert = self.namespace[ "convert" ]
+      convert.source = source
+      return convert
+
+pathPattern = re.compile( r"\s*(?:\.?\s*([A-Za-z_]\w*)|\[\s*(\d+)\s*\])" )
+
+def findField( ctype, name ):
+   ''' Return the offset and type of the field "name" of the struct or
+   union "ctype", and its descriptor if it is a bitfield, looking in
+   anonymous members too. Returns None if there is no such field. '''
+   offsets = getattr( ctype, "_ctypegen_offsets", None ) or []
+   fields = getattr( ctype, "_fields_", [] )
+   for idx, field in enumerate( fields ):
+      if field[ 0 ] == name:
+         offset = offsets[ idx ] if idx < len( offsets ) else None
+         if offset is None or offset == -1:
+            offset = getattr( ctype, name ).offset
+         bitfield = getattr( ctype, name ) if len( field ) > 2 else None
+         return offset, field[ 1 ], bitfield
+   for idx, field in enumerate( fields ):
+      if field[ 0 ] in getattr( ctype, "_anonymous_", () ):
+         found = findField( field[ 1 ], name )
+         if found is not None:
+            offset, ftype, bitfield = found
+            return getattr( ctype, field[ 0 ] ).offset + offset, ftype, bitfield
+   return None
+
+class FieldPath:
+   ''' The field at the end of a path like "hdr.entries[3].key.id" in
+   instances of a ctypes struct, union or array, resolved to a byte offset
+   and a type. Use fieldPath to get one. "get" and "set" work on instances
+   of the type, or on any buffer holding one at "offset". Numbers, chars and
+   bools are read and written as python values with a precompiled struct;
+   anything else is returned as a ctypes view of the buffer. '''
+
+   __slots__ = [ "ctype", "offset", "code", "bitfield", "owner" ]
+
+   def __init__( self, ctype, path ):
+      root = ctype
+      offset = 0
+      bitfield = None
+      owner = None
+      pos = 0
+      path = path.strip()
+      while pos < len( path ):
+         m = pathPattern.match( path, pos )
+         if m is None or bitfield is not None:
+            raise ValueError( f"bad field path {path!r} for {root.__name__}" )
+         pos = m.end()
+         name, index = m.groups()
+         if name is not None:
+            found = findField( ctype, name )
+            if found is None:
+               raise AttributeError( f"{ctype.__name__} has no field {name}" )
+            fieldOffset, fieldType, bitfield = found
+            owner = ( ctype, offset, name )
+            offset += fieldOffset
+            ctype = fieldType
+         else:
+            if not issubclass( ctype, ctypes.Array ):
+               raise TypeError( f"{ctype.__name__} is not an array" )
+            index = int( index )
+            if index >= ctype._length_:
+               raise IndexError( f"index {index} out of range for {ctype.__name__}" )
+            offset += index * ctypes.sizeof( ctype._type_ )
+            ctype = ctype._type_
+      self.ctype = ctype
+      self.offset = offset
+      if bitfield is not None:
+         # With the layout DWARF gives the bitfield, we can read and write its
+         # integer in place, rather than through a copy of its owner.
+         ownerType, ownerOffset, name = owner
+         layouts = getattr( ownerType, "_ctypegen_bitfields", None ) or {}
+         layout = layouts.get( name )
+         if layout is not None:
+            bitfield = Bitfield( ownerOffset + layout[ 0 ], *layout[ 1 : ],
+                                 isBoolType( ctype ) )
+      self.bitfield = bitfield
+      self.owner = owner
+      code = None
+      if bitfield is None and issubclass( ctype, ctypes._SimpleCData ) and \
+            ctype._type_ not in "PzZ":
+         code = structCode( ctype )
+      self.code = None if code is None else struct.Struct( "=" + code )
+
+   def get( self, source, offset=0 ):
+      if self.code is not None:
+         return self.code.unpack_from( source, offset + self.offset )[ 0 ]
+      if isinstance( self.bitfield, Bitfield ):
+         return self.bitfield.read( source, offset )
+      if self.bitfield is not None:
+         ownerType, ownerOffset, name = self.owner
+         return getattr( ownerType.from_buffer_copy( source, offset + ownerOffset ),
+                         name )
+      try:
+         return self.ctype.from_buffer( source, offset + self.offset )
+      except TypeError: # read-only buffer.
+         return self.ctype.from_buffer_copy( source, offset + self.offset )
+
+   def set( self, target, value, offset=0 ):
+      if self.code is not None:
+         self.code.pack_into( target, offset + self.offset, value )
+      elif isinstance( self.bitfield, Bitfield ):
+         self.bitfield.write( target, value, offset )
+      elif self.bitfield is not None:
+         ownerType, ownerOffset, name = self.owner
+         setattr( ownerType.from_buffer( target, offset + ownerOffset ), name,
+                  value )
+      else:
+         ctypes.memmove( ctypes.addressof( self.ctype.from_buffer( target,
+                                                offset + self.offset ) ),
+                         ctypes.addressof( value ), ctypes.sizeof( self.ctype ) )
+
+fieldPathMemo = {}
+
+def fieldPath( ctype, path ):
+   ''' Return the FieldPath for "path" in "ctype", resolving it only the
+   first time it is asked for '''
+   key = ( ctype, path )
+   accessor = fieldPathMemo.get( key )
+   if accessor is None:
+      accessor = FieldPath( ctype, path )
+      fieldPathMemo[ key ] = accessor
+   return accessor
+
+converterMemo = {}
+
+def recordConverter( ctype, kind="dict" ):
+   ''' Return a function that converts the "ctype" struct, union or array at
+   an offset into a buffer, and returns it as a dict of its fields or, if
+   "kind" is "tuple", a tuple. Nested records are converted the same way,
+   arrays become lists ( or tuples ), and pointers become their addresses.
+   The function is compiled for "ctype" the first time it is asked for:
+   call it as convert( buffer, offset=0 ). '''
+   key = ( ctype, kind )
+   converter = converterMemo.get( key )
+   if converter is None:
+      converter = ConverterCompiler( ctype, kind ).compile()
+      converterMemo[ key ] = converter
+   return converter
+
+def convertRecords( ctype, buf, kind="dict", offset=0, count=None ):
+   ''' Yield each of the "ctype" records in "buf", from "offset", converted
+   as for recordConverter. Without "count", continue to the end of "buf". '''
+   convert = recordConverter( ctype, kind )
+   size = ctypes.sizeof( ctype )
+   if count is None:
+      count = ( len( memoryview( buf ).cast( "B" ) ) - offset ) // size
+   for idx in range( count ):
+      yield convert( buf, offset + idx * size )
+
+def jsonDefault( value ):
+   if isinstance( value, bytes ):
+      return value.decode( "latin-1" )
+   if isinstance( value, ctypes._SimpleCData ):
+      return value.value
+   raise TypeError( f"cannot convert {type( value ).__name__} to JSON" )
+
+def dumpRecords( ctype, buf, stream, offset=0, count=None ):
+   ''' Write the "ctype" records in "buf" to "stream" as JSON, one object
+   per line. Byte strings are decoded as latin-1. '''
+   encode = json.JSONEncoder( default=jsonDefault ).encode
+   for record in convertRecords( ctype, buf, "dict", offset, count ):
+      stream.write( encode( record ) )
+      stream.write( "\n" )
+
+pointerFieldsMemo = {}
+
+def pointerFields( ctype ):
+   ''' Return a list of ( path, offset, target type ) for the pointers in
+   "ctype" that walkGraph can follow: the typed pointers in it and in its
+   nested structs and arrays. Pointers in unions are left out, as we can't
+   tell which member of a union is in use. '''
+   found = pointerFieldsMemo.get( ctype )
+   if found is not None:
+      return found
+   found = []
+   if issubclass( ctype, ctypes._Pointer ):
+      found.append( ( "", 0, ctype._type_ ) )
+   elif issubclass( ctype, ctypes.Array ):
+      element = pointerFields( ctype._type_ )
+      stride = ctypes.sizeof( ctype._type_ )
+      if element:
+         found = [ ( f"[{idx}]{path}", idx * stride + offset, target )
+                   for idx in range( ctype._length_ )
+                   for path, offset, target in element ]
+   elif issubclass( ctype, ctypes.Structure ):
+      offsets = getattr( ctype, "_ctypegen_offsets", None ) or []
+      for idx, field in enumerate( getattr( ctype, "_fields_", [] ) ):
+         offset = offsets[ idx ] if idx < len( offsets ) else None
+         if len( field ) > 2 or offset == -1:
+            continue
+         name = field[ 0 ]
+         if offset is None:
+            offset = getattr( ctype, name ).offset
+         found += [ ( f".{name}{path}", offset + subOffset, target )
+                    for path, subOffset, target in pointerFields( field[ 1 ] ) ]
+   pointerFieldsMemo[ ctype ] = found
+   return found
+
+class GraphPath:
+   ''' The path walkGraph took to a node, like "root->left->right", and the
+   node's address. Each path refers to the path of its parent, so a path
+   costs the same to make however deep it is: the text is only built when
+   it is asked for. '''
+
+   __slots__ = [ "parent", "step", "address" ]
+
+   def __init__( self, parent, step, address ):
+      self.parent = parent
+      self.step = step
+      self.address = address
+
+   def __str__( self ):
+      steps = []
+      path = self
+      while path.parent is not None:
+         step = path.step
+         steps.append( step if step.startswith( "[" ) else "->" + step[ 1: ] )
+         path = path.parent
+      steps.append( path.step )
+      return "".join( reversed( steps ) )
+
+   def __repr__( self ):
+      return f"GraphPath({str( self )!r})"
+
+   def onPath( self, address ):
+      ''' Return True if "address" is this node's, or one of its
+      ancestors' '''
+      path = self
+      while path is not None:
+         if path.address == address:
+            return True
+         path = path.parent
+      return False
+
+   def depth( self ):
+      depth = 0
+      path = self.parent
+      while path is not None:
+         depth += 1
+         path = path.parent
+      return depth
+
+unpackPointer = struct.Struct( "P" ).unpack_from
+
+def walkGraph( obj, memory=None, address=None, maxDepth=None, maxNodes=None,
+               name="root", pathOnly=False ):
+   ''' Yield a ( GraphPath, object ) pair for "obj", and for each object
+   reachable from it through pointers, depth first. Each address is visited
+   once, so cycles and shared nodes are not followed again. Pointers are not
+   followed from objects "maxDepth" pointers away from "obj", and the walk
+   stops after "maxNodes" objects. Nodes are produced as they are reached,
+   and only the nodes waiting to be visited are kept, along with the set of
+   addresses seen.
+
+   That set grows with the number of nodes. With "pathOnly", only the
+   addresses on the path to each node are checked instead, so the walk
+   keeps nothing beyond the nodes waiting to be visited. Cycles are still
+   broken, but a node reachable along several paths is visited once for
+   each of them.
+
+   Without "memory", pointers are followed in this process, and "obj" is a
+   ctypes object here. Otherwise, "memory" is a RemoteMemory or
+   MappedRegion to follow pointers in, and "address" is the address of "obj"
+   there. Nodes we can't read in "memory" are yielded as None. '''
+   if address is None and memory is None:
+      address = ctypes.addressof( obj )
+   visited = None if pathOnly else { address }
+   stack = [ ( GraphPath( None, name, address ), obj, 0 ) ]
+   count = 0
+   while stack:
+      path, node, depth = stack.pop()
+      yield path, node
+      count += 1
+      if maxNodes is not None and count >= maxNodes:
+         return
+      if node is None or ( maxDepth is not None and depth >= maxDepth ):
+         continue
+      children = []
+      for step, offset, target in pointerFields( type( node ) ):
+         child = unpackPointer( node, offset )[ 0 ]
+         if not child:
+            continue
+         if visited is None:
+            if path.onPath( child ):
+               continue
+         elif child in visited:
+            continue
+         else:
+            visited.add( child )
+         if memory is None:
+            value = target.from_address( child )
+         else:
+            try:
+               value = memory.follow( child, target )
+            except ValueError:
+               value = None
+         children.append( ( GraphPath( path, step, child ), value, depth + 1 ) )
+      stack += reversed( children )
+
+def nodeValue( node ):
+   ''' Return the python value of a node from walkGraph '''
+   if node is None or isinstance( node, ctypes._SimpleCData ):
+      return None if node is None else node.value
+   return recordConverter( type( node ) )( node )
+
+def dumpGraph( obj, stream, memory=None, address=None, maxDepth=None,
+               maxNodes=None, name="root", asJson=False, pathOnly=False ):
+   ''' Write each node walkGraph finds from "obj" to "stream", one per line,
+   as text, or, with "asJson", as a JSON object with its path, address,
+   type and value. Pointers in the values are shown as their addresses.
+   "pathOnly" is passed on to walkGraph, to dump large graphs without
+   keeping the set of every address seen. '''
+   encode = json.JSONEncoder( default=jsonDefault ).encode
+   for path, node in walkGraph( obj, memory, address, maxDepth, maxNodes, name,
+                                pathOnly ):
+      value = nodeValue( node )
+      typeName = None if node is None else type( node ).__name__
+      if asJson:
+         stream.write( encode( { "path" : str( path ), "address" : path.address,
+                                 "type" : typeName, "value" : value } ) )
+      else:
+         where = "?" if path.address is None else f"{path.address:#x}"
+         stream.write( f"{path} @ {where}: {typeName} {value!r}" )
+      stream.write( "\n" )
+
+class Pool:
+   ''' Allocates "count" instances of "ctype" in one contiguous array, for
+   calls into a library that are made over and over. "take" hands out the
+   instances in turn, and "reset" makes them all available again, zeroing
+   the ones that were used if "zero" is set. The same python objects are
+   handed out after each reset, so a loop using a pool creates none. Used as
+   a context manager, the pool is reset on exit. '''
+
+   def __init__( self, ctype, count, zero=True ):
+      self.ctype = ctype
+      self.count = count
+      self.zero = zero
+      self.array = ( ctype * count )()
+      self.size = ctypes.sizeof( ctype )
+      self.views = [ ctype.from_buffer( self.array, idx * self.size )
+                     for idx in range( count ) ]
+      self.used = 0
+      # Zero by copying from zeroes, which is cheaper than a call to memset.
+      self.bytes = memoryview( self.array ).cast( "B" )
+      self.zeroes = memoryview( bytes( len( self.bytes ) ) )
+      # Arrays handed out by takeArray, by ( start, count ), to hand out
+      # again after a reset.
+      self.arrays = {}
+
+   def __len__( self ):
+      return self.count
+
+   def available( self ):
+      return self.count - self.used
+
+   def take( self ):
+      ''' Return the next unused instance '''
+      if self.used >= self.count:
+         raise IndexError( f"pool of {self.count} {self.ctype.__name__} exhausted" )
+      view = self.views[ self.used ]
+      self.used += 1
+      return view
+
+   def takeArray( self, count ):
+      ''' Return an array of the next "count" unused instances '''
+      if self.used + count > self.count:
+         raise IndexError( f"pool of {self.count} {self.ctype.__name__} exhausted" )
+      key = ( self.used, count )
+      array = self.arrays.get( key )
+      if array is None:
+         array = ( self.ctype * count ).from_buffer( self.array,
+                                                     self.used * self.size )
+         self.arrays[ key ] = array
+      self.used += count
+      return array
+
+   def reset( self ):
+      ''' Make all the instances available again '''
+      if self.zero and self.used:
+         end = self.used * self.size
+         self.bytes[ : end ] = self.zeroes[ : end ]
+      self.used = 0
+
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, *args ):
+      self.reset()
+
+def batchCode( ctype ):
+   ''' Return the type code libCTypeGen.batchCall uses for "ctype" '''
+   if issubclass( ctype, ( ctypes._Pointer, ctypes._CFuncPtr ) ) or \
+         ctype._type_ in "PzZ":
+      return "P"
+   code = structCode( ctype )
+   if code is None:
+      raise TypeError( f"batchCall can't pass or return {ctype.__name__}" )
+   return code
+
+# The kind of value each struct module code holds, to check the columns of a
+# batchCall carry the values its function takes. Pointers are integers.
+batchKinds = dict( [ ( code, "integer" ) for code in "bBhHiIlLqQnNPzZ&" ] +
+                   [ ( "f", "float" ), ( "d", "float" ), ( "?", "bool" ),
+                     ( "c", "char" ) ] )
+foreignOrder = "<" if sys.byteorder == "big" else ">!"
+
+def batchColumn( column, argtype ):
+   ''' Return "column" as a buffer of values for the "argtype" argument of
+   batchCall, and the number of values in it. A single python value is
+   converted to "argtype". Raises TypeError if the buffer holds values of
+   another size or kind. '''
+   code = batchCode( argtype )
+   try:
+      view = memoryview( column )
+   except TypeError:
+      column = ( ctypes.c_void_p if code == "P" else argtype )( column )
+      view = memoryview( column )
+   checkBatchBuffer( view, argtype, "column", "argument" )
+   return column, view.nbytes // view.itemsize
+
+def checkBatchBuffer( view, ctype, what, role ):
+   ''' Raise TypeError if the memoryview "view" does not hold native values
+   of the size and kind of "ctype" '''
+   fmt = view.format
+   foreign = fmt[ : 1 ] in foreignOrder
+   fmt = fmt.lstrip( "@=<>!" )
+   if foreign or view.itemsize != ctypes.sizeof( ctype ) or \
+         batchKinds.get( fmt[ : 1 ] ) != batchKinds[ batchCode( ctype ) ] or \
+         ( fmt[ : 1 ] != "&" and len( fmt ) != 1 ):
+      raise TypeError( f"{what} of {view.format!r} values, "
+                       f"{view.itemsize} bytes each, passed for "
+                       f"{ctype.__name__} {role}" )
+
+def batchCall( func, *columns, out=None, count=None ):
+   ''' Call the library function "func", which must have its argtypes and
+   restype set, as decorateFunctions does, once for each row of "columns",
+   in a native loop. Each column is a buffer ( a ctypes or numpy array, an
+   array.array, etc ) holding the values of one argument for every call, or
+   a single value to pass to all of them. The values in a column must be of
+   the size and kind, integer or floating point, of its argument. Only
+   numbers and pointers can be passed and returned. The results are
+   written to "out", which by default is a new ctypes array, and which is
+   returned. Like the columns, "out" must hold values of the size and kind
+   of the function's restype. "count" defaults to the number of values in
+   the first column with more than one. '''
+   # pylint: disable=import-outside-toplevel
+   import libCTypeGen # pylint: disable=import-error
+   argtypes = func.argtypes or []
+   if len( columns ) != len( argtypes ):
+      raise TypeError( f"{getattr( func, '__name__', func )} takes "
+                       f"{len( argtypes )} arguments, "
+                       f"{len( columns )} columns given" )
+   codes = "".join( batchCode( argtype ) for argtype in argtypes )
+   checked = [ batchColumn( column, argtype )
+               for column, argtype in zip( columns, argtypes ) ]
+   columns = tuple( column for column, _ in checked )
+   if count is None:
+      count = next( ( values for _, values in checked if values != 1 ), 1 )
+   if count < 0:
+      raise ValueError( f"negative batchCall count {count}" )
+   restype = func.restype
+   if restype is not None:
+      if out is None:
+         out = ( restype * count )()
+      else:
+         checkBatchBuffer( memoryview( out ), restype, "output", "result" )
+   libCTypeGen.batchCall( ctypes.cast( func, ctypes.c_void_p ).value,
+         "" if restype is None else batchCode( restype ), codes, columns, out,
+         count )
+   return out
+
 hasPointersMemo = {}
 
 def hasPointers( t ):
@@ -50,12 +1496,8 @@ def hasPointers( t ):
    hasPointersMemo[ t ] = rv
    return rv
 
-errors = []
-
-def addError( text ):
-   errors.append( text )
-
-def checkUnalignedPtrs( t ):
+def checkUnalignedPtrs( t, errors=None ):
+   report = addError if errors is None else errors.append
 
    if not hasattr( t, "_fields_" ):
       return # no fields = no alignment problems
@@ -84,13 +1526,14 @@ def checkUnalignedPtrs( t ):
 
       # misaligned field that is a/has pointers. This trips up valgrind.
       if fname not in allowed:
-         addError( "unaligned ptr field %s in %s: offset=%d [%d]" % (
+         report( "unaligned ptr field %s in %s: offset=%d [%d]" % (
                      fname, t.__name__, field.offset,
                      field.offset % alignment ) )
 
-def checkSize( cls ):
+def checkSize( cls, errors=None ):
    ''' If we've defined the class fully, ensure python and DWARF agree on
    the size '''
+   report = addError if errors is None else errors.append
 
    if not hasattr( cls, "_ctypegen_have_definition" ):
       return
@@ -102,14 +1545,15 @@ def checkSize( cls ):
    if sz == 0 and cls._ctypegen_native_size == 1:
       # empty C++ classes are size 1. We can let this discrepancy slide.
       return
-   addError( "type %s has mismatched size. %d in ctypes, %d in DWARF" % (
+   report( "type %s has mismatched size. %d in ctypes, %d in DWARF" % (
                cls.__name__,
                ctypes.sizeof( cls ),
                cls._ctypegen_native_size) )
 
-def checkOffsets( cls ):
+def checkOffsets( cls, errors=None ):
    ''' if we have _fields_ and offsets defined for the class, make sure they
    agree with the dwarf definitions. '''
+   report = addError if errors is None else errors.append
    if not hasattr( cls, "_fields_" ) or not hasattr( cls, "_ctypegen_offsets" ):
       return
 
@@ -118,18 +1562,96 @@ def checkOffsets( cls ):
       if offset is not None:
          ctypesOffset = getattr( cls, field[ 0 ] ).offset
          if ctypesOffset != offset and offset != -1:
-            addError( "field %s of %s has offset %d in ctypes, %d in DWARF" %
+            report( "field %s of %s has offset %d in ctypes, %d in DWARF" %
                         ( field[ 0 ], str( cls ), ctypesOffset, offset ) )
 
-def test_class( cls ):
-   checkOffsets( cls )
-   checkSize( cls )
-   checkUnalignedPtrs( cls )
+def layoutHash( cls ):
+   ''' Return a digest of everything test_class looks at in "cls": two
+   classes with the same hash pass or fail together. '''
 
-def test_classes( failed_macros=None ):
+   def typeKey( t ):
+      return ( t.__name__, ctypes.sizeof( t ), ctypes.alignment( t ),
+               hasPointers( t ) )
+
+   fields = tuple( ( field[ 0 ], typeKey( field[ 1 ] ),
+                     getattr( cls, field[ 0 ] ).offset ) + tuple( field[ 2: ] )
+                   for field in getattr( cls, "_fields_", () ) )
+   key = ( cls.__name__, ctypes.sizeof( cls ),
+           getattr( cls, "_ctypegen_have_definition", False ),
+           getattr( cls, "_ctypegen_native_size", None ),
+           getattr( cls, "_ctypegen_offsets", None ),
+           getattr( cls, "allow_unaligned", None ), fields )
+   return hashlib.sha1( repr( key ).encode() ).hexdigest()
+
+class ValidationCache:
+   ''' The layout hashes of classes that are known to pass test_class. If
+   "path" is given, the hashes are read from it, one per line, and "save"
+   writes them back. '''
+
+   def __init__( self, path=None ):
+      self.path = path
+      self.hashes = set()
+      if path is not None and os.path.exists( path ):
+         with open( path ) as f:
+            self.hashes = set( f.read().split() )
+
+   def __contains__( self, cls ):
+      return layoutHash( cls ) in self.hashes
+
+   def add( self, cls ):
+      self.hashes.add( layoutHash( cls ) )
+
+   def save( self ):
+      if self.path is not None:
+         tmp = f"{self.path}.{os.getpid()}"
+         with open( tmp, "w" ) as f:
+            f.write( "".join( f"{h}\n" for h in sorted( self.hashes ) ) )
+         os.replace( tmp, self.path )
+
+# Classes that have passed test_classes in this process.
+validatedClasses = weakref.WeakSet()
+
+def test_class( cls, cache=None ):
+   ''' Return a list of the problems with "cls". If "cache" says its layout
+   has already passed, don't look any further '''
+   if cache is not None and cls in cache:
+      return []
+   errors = []
+   checkOffsets( cls, errors )
+   checkSize( cls, errors )
+   checkUnalignedPtrs( cls, errors )
+   if not errors and cache is not None:
+      cache.add( cls )
+   return errors
+
+def test_classes( failed_macros=None, module=None, cache=None ):
+   ''' Check the classes generated by "module", and its submodules, or
+   every generated class if "module" is None. Lazily generated modules are
+   materialized first, so all of their classes are checked. Classes that
+   have passed already are not checked again. "cache" is an optional
+   ValidationCache '''
    # pylint: disable=no-member
-   for cls in TestableCtypeClass.__subclasses__():
-      test_class( cls )
+   if module is None:
+      classes = TestableCtypeClass.__subclasses__()
+   else:
+      classes = set()
+      prefix = module + "."
+      for name, loaded in list( sys.modules.items() ):
+         lazy = getattr( loaded, "CTYPEGEN_lazy", None )
+         if lazy is not None and ( name == module or name.startswith( prefix ) ):
+            lazy.materializeAll()
+      for name, used in list( moduleClasses.items() ):
+         if name == module or name.startswith( prefix ):
+            classes.update( used )
+   errors = []
+   for cls in classes:
+      if cls in validatedClasses:
+         continue
+      problems = test_class( cls, cache )
+      if problems:
+         errors += problems
+      else:
+         validatedClasses.add( cls )
    if errors:
       raise Exception( "\n".join( errors ) )
    if failed_macros:
@@ -57,8 +57,11 @@ setup( name="CTypeGen",
         ],
 
         ext_modules=[
+            # libffi is for the native loop of CTypeGenRun.batchCall
             Extension( 'libCTypeGen', [ 'CTypeGen.cpp', ],
-                **pstack_extension_options ),
+                **dict( pstack_extension_options,
+                        libraries=pstack_extension_options[ 'libraries' ] +
+                              [ 'ffi' ] ) ),
             Extension( 'libCTypeMock', [ 'cmock.cpp', 'thunk-%s.s' % arch ],
                 **pstack_extension_options ),
         ],
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Copyright 2021 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# This test checks that the import hook generates a module on its first
+# import, and loads it from the cache after that.
+
+import os
+import shutil
+import sys
+import tempfile
+
+import CTypeGen
+
+cache = tempfile.mkdtemp()
+try:
+   hook = CTypeGen.installImportHook( { "supply": "./libSupply.so" },
+                                      cacheDir=cache )
+   import ctypegen_auto.supply # pylint: disable=import-error
+   assert len( os.listdir( cache ) ) == 1
+   firstType = ctypegen_auto.supply.Supply
+
+   # Forget the module, and make sure importing it again doesn't regenerate it.
+   for name in list( sys.modules ):
+      if name.startswith( "ctypegen_auto" ):
+         del sys.modules[ name ]
+
+   def noGenerate( *args, **kwargs ):
+      raise AssertionError( "module should have been loaded from the cache" )
+   CTypeGen.generateAll = noGenerate
+
+   import ctypegen_auto.supply # pylint: disable=import-error,reimported
+   assert ctypegen_auto.supply.__file__.startswith( cache )
+   assert ctypegen_auto.supply.Supply is not firstType
+   assert ctypegen_auto.supply.Supply().__class__.__name__ == "Supply"
+   sys.meta_path.remove( hook )
+finally:
+   shutil.rmtree( cache )
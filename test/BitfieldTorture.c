@@ -14,6 +14,7 @@
        limitations under the License.
 */
 
+#include <stdbool.h>
 #include <stdint.h>
 
 int main() {}
@@ -32,3 +33,13 @@ struct {
    uint32_t :16;
    uint32_t a:4;
 } torture2;
+
+// Packed, and with signed fields: ctypes doesn't lay this out as the
+// compiler does.
+struct __attribute__((packed)) Torture3 {
+   uint8_t c;
+   int32_t s:5;
+   uint32_t u:20;
+   int16_t n:3;
+   bool flag:1;
+} torture3 = { 1, -3, 0xabcde, -2, true };
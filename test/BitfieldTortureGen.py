@@ -13,8 +13,26 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from ctypes import CDLL, sizeof
 import CTypeGen
+from CTypeGenRun import fieldPath, recordConverter
 
 tortureModule, supplyResolver = CTypeGen.generateAll(
       "./libBitfieldTorture.so", "BitfieldTorture.py" )
 
+# Check the bitfields of a packed struct read as the compiler wrote them, and
+# write back to the same place.
+Torture3 = tortureModule.Torture3
+torture3 = Torture3.in_dll( CDLL( "./libBitfieldTorture.so" ), "torture3" )
+assert sizeof( Torture3 ) == 5
+assert ( torture3.s, torture3.u, torture3.n, torture3.flag ) == \
+      ( -3, 0xabcde, -2, True )
+assert recordConverter( Torture3 )( torture3 ) == \
+      { "c" : 1, "s" : -3, "u" : 0xabcde, "n" : -2, "flag" : True }
+assert fieldPath( Torture3, "flag" ).get( torture3 ) is True
+assert fieldPath( Torture3, "n" ).get( torture3 ) == -2
+torture3.n = 3
+torture3.s = 15
+assert ( torture3.c, torture3.s, torture3.u, torture3.n ) == ( 1, 15, 0xabcde, 3 )
+fieldPath( Torture3, "u" ).set( torture3, 7 )
+assert ( torture3.s, torture3.u, torture3.n ) == ( 15, 7, 3 )
@@ -13,10 +13,18 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 from ctypes import c_char, CDLL, c_void_p, c_long, c_int, cast, sizeof
-from ctypes import POINTER, c_char_p, c_ulong, Structure, Union
+from ctypes import POINTER, c_char_p, c_ulong, Structure, Union, addressof, pointer
+import importlib.util
+import io
+import json
+import os
 import sys
 
-from CTypeGen import generate, PythonType
+from CTypeGen import generate, PythonType, TypeLibrary
+from CTypeGenRun import DecoratedCDLL, ValidationCache, layoutHash, test_classes
+from CTypeGenRun import MappedRegion, ProcessMemory, numpyDtype
+from CTypeGenRun import recordConverter, convertRecords, dumpRecords, fieldPath
+from CTypeGenRun import walkGraph, dumpGraph, Pool, batchCall, prefetchGlobals
 
 if len( sys.argv ) >= 2:
    sanitylib = sys.argv[ 1 ]
@@ -148,6 +156,11 @@ if not any ( i.startswith( "clang" ) for i in module.CTYPEGEN_producers__ ):
    assert module.HELLO == 'hello world'
    assert module.ADD(1, 2) == 3
    assert module.ADD_42(2) == 44
+   assert module.UNSIGNED_MINUS_ONE == 0xffffffff
+   assert module.SIGNED_CHAR == -1
+   assert module.FOO_SIZE == sizeof( module.Foo ) * 2
+   assert not module.NULL_FOO
+   assert module.FORTY_FOUR == 44
 
 print( "Make sure 64-bit values are generated properly." )
 assert theCTypes.contents.bigEnum.value == module.BigNum.Big
@@ -171,8 +184,15 @@ assert module.AnonEnumWithTypedef.AETD_2 == 1
 
 # Test global variable access
 glob = module.Globals( dll )
+# Variables are looked up on first access, or when prefetched.
+assert "ExternalStruct" not in vars( glob )
 assert glob.ExternalStrings[ 3 ] == b"three"
 assert glob.ExternalStruct.x == 42
+assert glob.ExternalStruct is glob.ExternalStruct
+assert "thisIsTheStruct" not in vars( glob )
+prefetchGlobals( glob, [ "thisIsTheStruct" ] )
+assert "thisIsTheStruct" in vars( glob )
+prefetchGlobals( glob )
 
 # Two dimensional array sizes: the python declaration here lists the dimensions
 # non-obviously reversed wrt the C one
@@ -234,3 +254,240 @@ methodType = module.functionTypes[ "void_return_func" ]
 assert methodType.__class__.__name__ == "PyCFuncPtrType"
 assert methodType._restype_ is None
 assert methodType._argtypes_ == ()
+
+# Function types are created once per signature, and referred to by name.
+funcPtrType = dict( module.Foo._fields_ )[ "aFuncPtr" ]
+assert funcPtrType._restype_ == c_int and funcPtrType._argtypes_ == ( c_int, )
+assert [ name for name in dir( module ) if name.startswith( "CTYPEGEN_functype_" )
+         and getattr( module, name ) is funcPtrType ]
+
+print( "Check lazily generated module" )
+generate( [ sanitylib ], "CTypeSanityLazy.py", types, functions,
+      globalVars=globalVars, macroFiles=[ "macrosanity.h" ], lazy=True )
+# generate materializes everything to test the classes, so load a fresh copy.
+spec = importlib.util.spec_from_file_location( "CTypeSanityFresh",
+                                               "CTypeSanityLazy.py" )
+lazyModule = importlib.util.module_from_spec( spec )
+spec.loader.exec_module( lazyModule )
+assert "Foo" not in lazyModule.__dict__
+assert "Foo" in dir( lazyModule )
+assert sizeof( lazyModule.Foo ) == sizeof( module.Foo )
+assert "Foo" in lazyModule.__dict__
+assert "functionTypes" not in lazyModule.__dict__
+methodType = lazyModule.functionTypes[ "print_foo" ]
+assert methodType._argtypes_[ 0 ] == POINTER( lazyModule.Foo )
+assert lazyModule.TheEnum.Two == 2
+
+print( "Check package split by namespace" )
+generate( [ sanitylib ], "CTypeSanityPkg", types, functions,
+      globalVars=globalVars, split="namespace" )
+assert os.path.exists( "CTypeSanityPkg/Outer_Inner.py" )
+for name in list( sys.modules ):
+   if name.startswith( "CTypeSanityPkg" ):
+      del sys.modules[ name ]
+import CTypeSanityPkg # pylint: disable=import-error,wrong-import-position
+assert "CTypeSanityPkg.Outer_Inner" not in sys.modules
+leaf = CTypeSanityPkg.NamespacedLeaf
+assert "CTypeSanityPkg.Outer_Inner" in sys.modules
+assert leaf.__module__ == "CTypeSanityPkg.Outer_Inner"
+assert sizeof( leaf ) == sizeof( module.NamespacedLeaf )
+assert CTypeSanityPkg.GlobalLeaf.__module__ == "CTypeSanityPkg"
+
+print( "Check module using a layout sidecar" )
+sidecarModule, _ = generate( [ sanitylib ], "CTypeSanitySidecar.py", types,
+      functions, globalVars=globalVars, layoutSidecar=True )
+assert os.path.exists( "CTypeSanitySidecar.layout" )
+assert not hasattr( sidecarModule.Foo, "_fields_pre" )
+assert sizeof( sidecarModule.Foo ) == sizeof( module.Foo )
+assert [ field[ 0 ] for field in sidecarModule.Foo._fields_ ] == \
+      [ field[ 0 ] for field in module.Foo._fields_ ]
+assert sidecarModule.Foo._ctypegen_offsets == module.Foo._ctypegen_offsets
+
+print( "Check lazily applied function prototypes" )
+protoModule, _ = generate( [ sanitylib ], "CTypeSanityProtos.py", types,
+      functions, globalVars=globalVars, lazyPrototypes=True )
+assert set( protoModule.functionTypes ) == set( module.functionTypes )
+assert protoModule.functionTypes[ "void_return_func" ]._restype_ is None
+protoDll = DecoratedCDLL( sanitylib, protoModule.CTYPEGEN_prototypes )
+assert "print_foo" not in protoDll.__dict__
+assert protoDll.print_foo.argtypes == [ POINTER( protoModule.Foo ), c_char_p,
+                                        c_ulong ]
+assert protoDll.make_foo.restype == POINTER( protoModule.Foo )
+
+print( "Check types shared between modules" )
+shared1, _ = generate( [ sanitylib ], "CTypeSanityShared1.py", types, functions,
+      globalVars=globalVars, shareTypes=True )
+shared2, _ = generate( [ sanitylib ], "CTypeSanityShared2.py", types, functions,
+      globalVars=globalVars, shareTypes=True )
+assert shared1.Foo is shared2.Foo
+assert shared1.Foo is not module.Foo
+assert shared1.TheEnum is shared2.TheEnum
+assert sizeof( shared2.Foo ) == sizeof( module.Foo )
+
+print( "Check types built on demand, without a module" )
+before = set( os.listdir( "." ) )
+library = TypeLibrary( [ sanitylib ] )
+libFoo = library.struct( "Foo" )
+assert library.struct( "Foo" ) is libFoo
+assert sizeof( libFoo ) == sizeof( module.Foo )
+assert libFoo._ctypegen_offsets == module.Foo._ctypegen_offsets
+assert set( os.listdir( "." ) ) == before
+
+print( "Check validation is scoped to a module, and cached by layout" )
+if os.path.exists( "CTypeSanity.valid" ):
+   os.remove( "CTypeSanity.valid" )
+validated, _ = generate( [ sanitylib ], "CTypeSanityValidated.py", types,
+      functions, globalVars=globalVars, validationCache="CTypeSanity.valid" )
+assert layoutHash( validated.Foo ) in ValidationCache( "CTypeSanity.valid" ).hashes
+deferred, _ = generate( [ sanitylib ], "CTypeSanityDeferred.py", types,
+      functions, globalVars=globalVars, validate=False )
+deferred.CTYPEGEN_lazy.materializeAll()
+deferred.Foo._ctypegen_native_size += 1
+try:
+   test_classes( None, "CTypeSanityDeferred" )
+   assert False, "bad size not detected"
+except Exception as ex: # pylint: disable=broad-except
+   assert "mismatched size" in str( ex )
+test_classes( None, "CTypeSanityValidated" )
+
+print( "Check zero-copy views of a mapped file" )
+# Write a list of three Foos as if they were mapped at "writerBase".
+writerBase = 0x10000000
+foos = ( module.Foo * 3 )()
+for i in range( 3 ):
+   foos[ i ].anInt = i
+   if i != 2:
+      foos[ i ].next = cast( writerBase + ( i + 1 ) * sizeof( module.Foo ),
+                             POINTER( module.Foo ) )
+with open( "CTypeSanity.mapped", "wb" ) as mapped:
+   mapped.write( bytes( foos ) )
+with MappedRegion( "CTypeSanity.mapped", base=writerBase ) as region:
+   assert [ foo.anInt for foo in region.records( module.Foo ) ] == [ 0, 1, 2 ]
+   foo = region.view( module.Foo )
+   chain = []
+   while foo is not None:
+      chain.append( foo.anInt )
+      foo = region.follow( foo.next )
+   assert chain == [ 0, 1, 2 ]
+with MappedRegion( "CTypeSanity.mapped", writable=True ) as region:
+   region.array( module.Foo, 3 )[ 1 ].anInt = 42
+with open( "CTypeSanity.mapped", "rb" ) as mapped:
+   assert module.Foo.from_buffer_copy( mapped.read(),
+                                       sizeof( module.Foo ) ).anInt == 42
+
+print( "Check batched reads from a live process" )
+# Read a list of Foos out of our own address space.
+for i in range( 2 ):
+   foos[ i ].next = pointer( foos[ i + 1 ] )
+remote = ProcessMemory( os.getpid() )
+foo = remote.readType( module.Foo, addressof( foos[ 0 ] ) )
+chain = []
+while foo is not None:
+   chain.append( foo.anInt )
+   foo = remote.follow( foo.next )
+assert chain == [ 0, 1, 2 ]
+syscalls = remote.syscalls
+foos[ 0 ].anInt = 42
+assert remote.readType( module.Foo, addressof( foos[ 0 ] ) ).anInt == 0
+assert remote.syscalls == syscalls
+remote.invalidate()
+assert remote.readType( module.Foo, addressof( foos[ 0 ] ) ).anInt == 42
+
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+if numpy is not None:
+   print( "Check numpy views of arrays of records" )
+   dtype = numpyDtype( module.Foo )
+   assert module.Foo._ctypegen_dtype() is dtype
+   assert dtype.itemsize == sizeof( module.Foo )
+   for i in range( 3 ):
+      foos[ i ].anInt = i * 10
+      foos[ i ].aTwoDimensionalArrayOfLong[ 16 ][ 12 ] = i
+   records = numpy.frombuffer( foos, dtype=dtype )
+   assert list( records[ "anInt" ] ) == [ 0, 10, 20 ]
+   assert list( records[ "aTwoDimensionalArrayOfLong" ][ :, 16, 12 ] ) == [ 0, 1, 2 ]
+   assert dtype.fields[ "anInt" ][ 1 ] == module.Foo.anInt.offset
+
+print( "Check compiled record converters" )
+for i in range( 3 ):
+   foos[ i ].anInt = i
+   foos[ i ].aTwoDimensionalArrayOfLong[ 16 ][ 12 ] = i * 2
+   foos[ i ].aOneDimensionalArrayOfChar = b"foo%d" % i
+converted = list( convertRecords( module.Foo, foos ) )
+assert [ foo[ "anInt" ] for foo in converted ] == [ 0, 1, 2 ]
+assert converted[ 2 ][ "aTwoDimensionalArrayOfLong" ][ 16 ][ 12 ] == 4
+assert converted[ 1 ][ "aOneDimensionalArrayOfChar" ] == b"foo1"
+assert converted[ 0 ][ "next" ] == addressof( foos[ 1 ] )
+fooTuple = recordConverter( module.Foo, "tuple" )( foos, sizeof( module.Foo ) )
+assert fooTuple[ list( converted[ 1 ] ).index( "anInt" ) ] == 1
+dumped = io.StringIO()
+dumpRecords( module.Foo, foos, dumped )
+assert [ json.loads( line )[ "anInt" ]
+         for line in dumped.getvalue().splitlines() ] == [ 0, 1, 2 ]
+
+print( "Check compiled field paths" )
+longPath = fieldPath( module.Foo, "aTwoDimensionalArrayOfLong[ 16 ][ 12 ]" )
+assert longPath is fieldPath( module.Foo, "aTwoDimensionalArrayOfLong[ 16 ][ 12 ]" )
+assert longPath.get( foos[ 2 ] ) == 4
+assert longPath.get( bytes( foos ), 2 * sizeof( module.Foo ) ) == 4
+longPath.set( foos[ 1 ], 99 )
+assert foos[ 1 ].aTwoDimensionalArrayOfLong[ 16 ][ 12 ] == 99
+assert fieldPath( module.Foo, "aOneDimensionalArrayOfChar" ).get( foos[ 1 ] ).value \
+      == b"foo1"
+
+print( "Check walking pointer graphs" )
+# Make the list of Foos a cycle.
+foos[ 2 ].next = pointer( foos[ 0 ] )
+walked = [ ( str( path ), foo.anInt ) for path, foo in walkGraph( foos[ 0 ] ) ]
+assert walked == [ ( "root", 0 ), ( "root->next", 1 ), ( "root->next->next", 2 ) ], \
+      walked
+assert len( list( walkGraph( foos[ 0 ], maxDepth=1 ) ) ) == 2
+assert len( list( walkGraph( foos[ 0 ], maxNodes=1 ) ) ) == 1
+assert [ ( str( path ), foo.anInt )
+         for path, foo in walkGraph( foos[ 0 ], pathOnly=True ) ] == walked
+graph = io.StringIO()
+dumpGraph( foos[ 0 ], graph, asJson=True )
+assert [ json.loads( line )[ "address" ] for line in graph.getvalue().splitlines() ] \
+      == [ addressof( foo ) for foo in foos ]
+graph = io.StringIO()
+dumpGraph( foos[ 0 ], graph, pathOnly=True )
+assert len( graph.getvalue().splitlines() ) == len( foos )
+
+print( "Check pooled allocation" )
+pool = Pool( module.Foo, 3 )
+with pool:
+   pooled = pool.take()
+   pooled.anInt = 42
+   pooledArray = pool.takeArray( 2 )
+   assert addressof( pooledArray ) == addressof( pooled ) + sizeof( module.Foo )
+   try:
+      pool.take()
+      assert False, "pool not exhausted"
+   except IndexError:
+      pass
+assert pool.take() is pooled
+assert pooled.anInt == 0
+assert pool.takeArray( 2 ) is pooledArray
+
+print( "Check batched calls" )
+doubled = batchCall( theCTypes.contents.aFuncPtr, ( c_int * 4 )( 1, 2, 3, 4 ) )
+assert list( doubled ) == [ 2, 4, 6, 8 ]
+assert list( batchCall( theCTypes.contents.aFuncPtr, 5, count=2 ) ) == [ 10, 10 ]
+try:
+   batchCall( theCTypes.contents.aFuncPtr, ( c_long * 4 )( 1, 2, 3, 4 ) )
+   assert False, "column of longs accepted for an int argument"
+except TypeError:
+   pass
+try:
+   batchCall( theCTypes.contents.aFuncPtr, 5, count=2, out=( c_long * 2 )() )
+   assert False, "output of longs accepted for an int result"
+except TypeError:
+   pass
+try:
+   batchCall( theCTypes.contents.aFuncPtr, 5, count=-1 )
+   assert False, "negative count accepted"
+except ValueError:
+   pass
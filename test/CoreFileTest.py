@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Copyright 2026 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Dump a core of a child process that has built a linked list with
+# libCoreTest.so, and check CoreFile reads the list back out of it.
+
+import ctypes
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from ctypes import c_char, c_int, c_void_p, sizeof
+import CTypeGen
+
+if len( sys.argv ) >= 2:
+   corelib = sys.argv[ 1 ]
+else:
+   corelib = "./libCoreTest.so"
+libname = os.path.basename( corelib )
+
+module, resolver = CTypeGen.generate( corelib, "CoreTest.py", [ "Node" ], [] )
+
+with open( "/proc/sys/kernel/core_pattern" ) as patternFile:
+   if patternFile.read().startswith( "|" ):
+      print( "core dumps are piped to a helper: skipping core file test" )
+      sys.exit( 0 )
+
+# The child inherits our mapping of the library, so the addresses of its
+# globals are the ones we see here.
+dll = ctypes.CDLL( corelib )
+headAddress = ctypes.addressof( c_void_p.in_dll( dll, "head" ) )
+
+workdir = tempfile.mkdtemp()
+try:
+   pid = os.fork()
+   if pid == 0:
+      try:
+         os.chdir( workdir )
+         resource.setrlimit( resource.RLIMIT_CORE,
+                             ( resource.RLIM_INFINITY, resource.RLIM_INFINITY ) )
+         dll.build()
+      finally:
+         os.abort()
+   os.waitpid( pid, 0 )
+   cores = [ name for name in os.listdir( workdir ) if name.startswith( "core" ) ]
+   if not cores:
+      print( "no core file was dumped: skipping core file test" )
+      sys.exit( 0 )
+
+   with CTypeGen.CoreFile( os.path.join( workdir, cores[ 0 ] ) ) as core:
+      path = core.resolvePath( libname )
+      assert path == os.path.realpath( corelib )
+      assert core.symbol( "head", path ) == headAddress
+
+      assert core.readGlobal( c_int, "answer", libname ).value == 42
+      zeroes = core.readGlobal( c_char * 65536, "zeroes", path )
+      assert bytes( zeroes ) == bytes( 65536 )
+
+      # The nodes are on the heap, and the names in the library's read-only
+      # data, which the core doesn't include.
+      found = []
+      node = core.follow( core.readGlobal( ctypes.POINTER( module.Node ), "head",
+                                           path ) )
+      while node is not None:
+         name = c_void_p.from_buffer( node, module.Node.name.offset ).value
+         found.append( ( node.value, core.string( name ) ) )
+         node = core.follow( node.next )
+      assert found == [ ( 0, b"zero" ), ( 10, b"one" ), ( 20, b"two" ) ], found
+
+      # Nothing is mapped at address 0.
+      try:
+         core.read( 0, sizeof( c_int ) )
+         assert False, "read of unmapped memory succeeded"
+      except ValueError:
+         pass
+finally:
+   shutil.rmtree( workdir )
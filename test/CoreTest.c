@@ -0,0 +1,45 @@
+/*
+   Copyright 2026 Arista Networks.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+       Unless required by applicable law or agreed to in writing, software
+       distributed under the License is distributed on an "AS IS" BASIS,
+       WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+       See the License for the specific language governing permissions and
+       limitations under the License.
+*/
+
+// CoreFileTest.py dumps a core of a process that has called "build", and
+// reads these back out of it.
+
+#include <stdlib.h>
+
+struct Node {
+   int value;
+   struct Node *next;
+   const char *name;
+};
+
+// The list is on the heap, which the core includes, and the names in
+// read-only data, which we must read from the library itself.
+struct Node *head;
+int answer = 42;
+char zeroes[ 65536 ];
+
+static const char *names[] = { "zero", "one", "two" };
+
+void
+build( void ) {
+   for ( int i = 2; i >= 0; i-- ) {
+      struct Node *node = malloc( sizeof *node );
+      node->value = i * 10;
+      node->next = head;
+      node->name = names[ i ];
+      head = node;
+   }
+}
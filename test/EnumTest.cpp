@@ -108,3 +108,9 @@ enum AllBits {
    BIT( 63 )
 };
 AllBits allBits;
+
+enum Nameless {
+   first = 3,
+   second = 7
+};
+Nameless nameless;
@@ -16,6 +16,7 @@
 import re
 import ctypes
 import CTypeGen
+import CTypeGenRun
 import libCTypeGen
 import sys
 from libCTypeGen import tags
@@ -89,9 +90,46 @@ def testAllBits():
          break
    assert len( bitsTested ) == 64
 
+def testReverseLookup():
+   # Each enum has a map from values back to names, and enums of flags can
+   # decompose a value into its flags.
+   allBits = module.enum_AllBits
+   assert CTypeGenRun.enumName( allBits, 1 << 5 ) == "_5"
+   assert CTypeGenRun.enumName( allBits, 0 ) is None
+   assert CTypeGenRun.enumFlags( allBits, ( 1 << 63 ) | 3 ) == \
+         ( [ "_0", "_1", "_63" ], 0 )
+
+   fitted = type( globvars.s8t.e )
+   assert CTypeGenRun.enumName( fitted, -128 ) == "start"
+   assert CTypeGenRun.enumName( fitted, 127 ) == "end"
+   # The constructor of EnumToFit doesn't initialize "e", so it is zero, which
+   # is neither enumerator.
+   assert globvars.s8t.e.value == 0
+   assert CTypeGenRun.enumName( fitted, globvars.s8t.e ) is None
+   assert CTypeGenRun.enumName( fitted, globvars.s8t.e, "?" ) == "?"
+   try:
+      CTypeGenRun.enumFlags( fitted, 1 )
+      assert False, "enum of s8t is not an enum of flags"
+   except TypeError:
+      pass
+
 for var in dir( globvars ):
    m = regex.match( var )
    if m is not None:
       testFullRange( var, m )
 
+def testNamelessReverseLookup():
+   # Nameless enums put their enumerators in the module, rather than in their
+   # class, but the class still maps values back to names.
+   nameless, _ = CTypeGen.generate( "libEnumTest.so", "EnumNameless.py",
+           types=lambda die: die.name() == "Nameless",
+           functions=lambda die: False,
+           namelessEnums=True )
+   assert nameless.first == 3 and nameless.second == 7
+   assert not hasattr( nameless.enum_Nameless, "first" )
+   assert CTypeGenRun.enumName( nameless.enum_Nameless, 7 ) == "second"
+   assert CTypeGenRun.enumName( nameless.enum_Nameless, 5 ) is None
+
 testAllBits()
+testReverseLookup()
+testNamelessReverseLookup()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Copyright 2021 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Micro-benchmark for the conversion of macro bodies to python. This compares
+# CTypeGen.expression.clean with the tokenize/ast implementation it
+# replaced, which is reproduced here. Run with an optional repeat count.
+
+import ast
+import sys
+import time
+import token
+import tokenize
+
+from CTypeGen.expression import clean
+
+def legacyClean( input_ ):
+   ''' The old implementation of clean: lexical cleanup using python's
+   tokenizer, then validation with ast.parse '''
+
+   class Reader:
+      def __init__( self, text ):
+         self.text = text.encode( "utf-8" )
+
+      def __call__( self ):
+         rv = self.text
+         self.text = b""
+         return rv
+
+   name_list = []
+   try:
+      kill_suffixes = { "UL", "U", "ULL", "L", "LL" }
+      output = ''
+      prev_tok = None
+      for tok in tokenize.tokenize( Reader( input_ ) ):
+         if tok.type in ( token.INDENT, token.ENCODING ):
+            continue
+         if prev_tok:
+            output += input_[ prev_tok.end[ 1 ] : tok.start[ 1 ] ]
+         if tok.type == token.NUMBER and tok.string[ -1 ].upper() == 'L':
+            output += tok.string[ :-1 ]
+         elif tok.type == token.STRING and tok.string[ 0 ] == "'" and \
+               len( tok.string ) == 3 and tok.string[ 2 ] == "'":
+            output += str( ord( tok.string[ 1 ] ) )
+         elif tok.type == token.NUMBER and len( tok.string ) >= 2 and \
+               tok.string[ 0 ] == '0' and tok.string[ 1 ].upper() != 'X':
+            output += "0o%s" % tok.string[ 1: ]
+         elif prev_tok is not None and prev_tok.type == token.NUMBER and \
+               tok.type == token.NAME and tok.string.upper() in kill_suffixes:
+            pass
+         else:
+            if tok.type == token.NAME:
+               name_list.append( tok.string )
+            output += tok.string
+         prev_tok = tok
+   except tokenize.TokenError:
+      return None, None
+
+   try:
+      tree = ast.parse( output )
+      if len( tree.body ) != 1 or not isinstance( tree.body[ 0 ], ast.Expr ):
+         return None, None
+      if isinstance( tree.body[ 0 ].value, ast.Set ):
+         return None, None
+      return output, name_list
+   except SyntaxError:
+      pass
+   return None, None
+
+# A selection of macro bodies, typical of what we find in system headers.
+corpus = [
+   "42",
+   "0x7fffffffUL",
+   "(32 + A)",
+   "(1 << 12)",
+   "__GLIBC_PREREQ (2, 17)",
+   "\"hello world\"",
+   "'a'",
+   "0644",
+   "((sighandler_t) -1)",
+   "(__UINT64_C(1) << 63)",
+   "(-2147483647 - 1)",
+   "{ 0, 0, 0, 0 }",
+   "__attribute__ ((__nothrow__))",
+   "(X) + (Y) * 2",
+   "EAGAIN",
+   "1.0e-5",
+   "do { } while (0)",
+   "(~0UL)",
+   "sizeof(int)",
+   "((a) < (b) ? (a) : (b))",
+]
+
+def bench( func, count ):
+   # We want to measure the raw conversion, so bypass any caching.
+   func = getattr( func, "__wrapped__", func )
+   start = time.perf_counter()
+   for _ in range( count ):
+      for text in corpus:
+         func( text )
+   return time.perf_counter() - start
+
+count = int( sys.argv[ 1 ] ) if len( sys.argv ) > 1 else 2000
+total = count * len( corpus )
+legacy = bench( legacyClean, count )
+current = bench( clean, count )
+print( f"{total} macro bodies" )
+print( f"tokenize/ast: {legacy:.3f}s ({legacy / total * 1e6:.2f}us per macro)" )
+print( f"lexer/parser: {current:.3f}s ({current / total * 1e6:.2f}us per macro)" )
+print( f"speedup: {legacy / current:.1f}x" )
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright 2021 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Check the conversion of C macro bodies to python expressions.
+
+from CTypeGen.expression import clean
+
+typenames = frozenset( [ "sighandler_t", "Foo_t" ] )
+
+# C text -> ( expected python, expected names used )
+good = {
+   "42" : ( "42", () ),
+   "(32 + A)" : ( "(32 + A)", ( "A", ) ),
+   "0xffUL" : ( "0xff", () ),
+   "10lu" : ( "10", () ),
+   "1ULL << 40" : ( "1 << 40", () ),
+   "0755" : ( "0o755", () ),
+   "0" : ( "0", () ),
+   "1.5f" : ( "1.5", () ),
+   "1e-3" : ( "1e-3", () ),
+   "'a'" : ( "97", () ),
+   "'\\n'" : ( "10", () ),
+   "'\\0'" : ( "0", () ),
+   "'\\x41'" : ( "65", () ),
+   "'\\''" : ( "39", () ),
+   '"hello world"' : ( '"hello world"', () ),
+   '"hello" " world"' : ( '"hello" " world"', () ),
+   "ADD(42, a)" : ( "ADD(42, a)", ( "ADD", "a" ) ),
+   "~0U" : ( "~0", () ),
+   "-(1)" : ( "-(1)", () ),
+   "((sighandler_t) -1)" : ( "(CAST( sighandler_t, -1 ))", ( "sighandler_t", ) ),
+   "((unsigned int)-1)" : ( "(CAST( c_uint, -1 ))", () ),
+   "(long long)1" : ( "CAST( c_longlong, 1 )", () ),
+   "(const char *)0" : ( "CAST( c_char_p, 0 )", () ),
+   "(void *)0" : ( "CAST( c_void_p, 0 )", () ),
+   "(struct Foo **)0" : ( "CAST( POINTER( POINTER( struct_Foo ) ), 0 )",
+                          ( "struct_Foo", ) ),
+   "(int)(char)x" : ( "CAST( c_int, CAST( c_char, x ) )", ( "x", ) ),
+   "(A) - 1" : ( "(A) - 1", ( "A", ) ),
+   "sizeof(struct Foo)" : ( "sizeof( struct_Foo )", ( "struct_Foo", ) ),
+   "sizeof (Foo_t) * 2" : ( "sizeof( Foo_t ) * 2", ( "Foo_t", ) ),
+   "sizeof(unsigned long)" : ( "sizeof( c_ulong )", () ),
+}
+
+for text, expected in good.items():
+   result = clean( text, typenames )
+   assert result == expected, f"{text}: expected {expected}, got {result}"
+
+# Things we can't (or shouldn't) express in python.
+bad = [
+   "",
+   "{ 1, 2 }",
+   "08",
+   "'ab'",
+   "1 && 2",
+   "!x",
+   "a ? b : c",
+   "x->y",
+   "a[1]",
+   "1(2)",
+   "A B",
+   "ADD(1,)",
+   "(",
+   "sizeof x",
+   "sizeof(x)",
+   "(void)0",
+   "lambda",
+   "int",
+   "do { } while (0)",
+]
+
+for text in bad:
+   result = clean( text, typenames )
+   assert result == ( None, None ), f"{text}: expected failure, got {result}"
+
+# All our output should be valid python, and evaluate to the same thing as the
+# C.
+assert eval( clean( "(32 + 10) * 2" )[ 0 ] ) == 84
+assert eval( clean( "0x10 | 010" )[ 0 ] ) == 24
+assert eval( clean( "'A' + 1" )[ 0 ] ) == 66
+
+print( "expression tests passed" )
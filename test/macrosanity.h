@@ -26,5 +26,12 @@
 #define ADD(a, b) (a+b)
 #define ADD_42(a) ADD(42, a)
 
+// casts and sizeof are resolved when the module is generated.
+#define UNSIGNED_MINUS_ONE ((unsigned int)-1)
+#define SIGNED_CHAR ((signed char)0xff)
+#define FOO_SIZE (sizeof(struct Foo) * 2)
+#define NULL_FOO ((struct Foo *)0)
+#define FORTY_FOUR (ADD_42(2))
+
 #endif // TEST_MACROS_H
 